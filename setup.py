@@ -28,7 +28,7 @@ setup(
         'Topic :: System :: Systems Administration',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
-    packages=['sy', 'sy.net', 'sy.net.intf'],
+    packages=['sy', 'sy.cmd', 'sy.net', 'sy.net.intf'],
     package_data={
         'sy': ['lib/*']
     },
@@ -0,0 +1,2060 @@
+'''
+:synopsis: Running system commands
+   
+    
+
+.. moduleauthor: Paul Diaconescu <p@afajl.com>
+''' 
+import time
+import os
+import errno
+import fcntl
+import select
+import signal
+import re
+import math
+import binascii
+import threading
+import atexit
+from collections import deque
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    OrderedDict = None
+
+import sy.log
+import sy.util
+
+log = sy.log._new('sy.cmd')
+
+try:
+    import ctypes
+    # the symbols of the C library the interpreter is linked with
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.posix_spawnp
+    _libc.posix_spawnattr_setflags.argtypes = [ctypes.c_void_p, 
+                                               ctypes.c_short]
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+try:
+    # Python 3.5 and later
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+CMD_TIMEOUT=60
+POOL_SIZE=10
+STREAM_ERR_TAIL=8192
+# How children are started: 'posix_spawn', 'fork' or 'auto' which uses 
+# posix_spawn when the C library has it
+SPAWN='auto'
+# posix_spawn file actions, same values as os.POSIX_SPAWN_* in Python 3
+_SPAWN_CLOSE = 1
+_SPAWN_DUP2 = 2
+# posix_spawnattr_setflags flags, same values on Linux and the BSDs
+_SPAWN_SETPGROUP = 0x02
+_SPAWN_SETSIGDEF = 0x04
+# Bytes reserved for the opaque posix_spawn types, more than any libc uses
+_SPAWN_STRUCT = 1024
+# Defaults for the run result cache, see cached_run
+CACHE_TTL=30
+CACHE_SIZE=256
+# Seconds between checks for changed PATH directories made by find
+FIND_RECHECK=1
+# Max bytes written to stdin of a command at a time
+INPUT_CHUNK=65536
+# Signals sent to the process group of a command that is killed and the
+# seconds to wait for it to exit after each one. Children still running 
+# after the last one are left to a background reaper
+KILL_LADDER=((signal.SIGTERM, 2), (signal.SIGKILL, 2))
+# Seconds between checks for an exited child, doubled up to the max
+REAP_INTERVAL=0.001
+REAP_INTERVAL_MAX=0.05
+
+
+class CommandError(Exception):
+    ''' Command failed error 
+    
+    .. attribute:: out
+
+       The stdout collected from the command
+
+    .. attribute:: err
+
+       The stdout collected from the command
+
+    .. attribute:: status
+            
+       The commands exit status
+
+    .. attribute:: cmd
+
+        The command that was run
+    '''
+    def __init__(self, msg, out=None, err=None, status=None, cmd=None):
+        self.out = out
+        self.err = err
+        self.status = status
+        self.cmd = cmd
+        Exception.__init__(self, msg)
+
+class CommandTimeoutError(CommandError):
+    ''' Command failed due to time out. Subclass of :exc:`CommandError`.
+    
+    .. attribute:: timeout
+
+       The timeout that was exceeded
+
+    '''
+ 
+    def __init__(self, msg, timeout=None, *args, **kwargs):
+        self.timeout = timeout
+        CommandError.__init__(self, msg, *args, **kwargs)
+
+class CommandOutputError(CommandError):
+    ''' Command produced more output than allowed by ``max_output`` when 
+    ``truncate='raise'`` was used. Subclass of :exc:`CommandError`.
+    
+    .. attribute:: max_output
+
+       The output limit that was exceeded
+
+    '''
+ 
+    def __init__(self, msg, max_output=None, *args, **kwargs):
+        self.max_output = max_output
+        CommandError.__init__(self, msg, *args, **kwargs)
+
+
+class _OutputOverflow(Exception):
+    ''' Raised by :class:`_subprocess` when a buffer with the ``raise`` 
+    truncate policy is full '''
+
+
+class _buffer(object):
+    ''' Collects output as a list of chunks which are joined when the value
+    is requested, appending to a string would copy everything read so far
+    for every chunk.
+
+    If ``limit`` is set at most that many bytes are kept, ``keep`` decides
+    which: ``head`` keeps the first bytes, ``tail`` the last bytes and 
+    ``raise`` keeps the first bytes and marks the buffer as overflowed.
+    '''
+
+    def __init__(self, limit=None, keep='head'):
+        assert keep in ('head', 'tail', 'raise'), 'Unknown truncate policy: %s' % keep
+        self.limit = limit
+        self.keep = keep
+        self.chunks = deque()
+        self.size = 0
+        self.truncated = False
+
+    def write(self, chunk):
+        limit = self.limit
+        if limit is not None and self.size + len(chunk) > limit:
+            self.truncated = True
+            if self.keep == 'tail':
+                excess = self.size + len(chunk) - limit
+                while excess and self.chunks:
+                    first = self.chunks.popleft()
+                    if len(first) > excess:
+                        self.chunks.appendleft(first[excess:])
+                        self.size -= excess
+                        excess = 0
+                    else:
+                        self.size -= len(first)
+                        excess -= len(first)
+                chunk = chunk[excess:]
+            else:
+                chunk = chunk[:limit - self.size]
+        if chunk:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+
+    def getvalue(self):
+        if len(self.chunks) > 1:
+            value = ''.join(self.chunks)
+            self.chunks = deque([value])
+        elif self.chunks:
+            value = self.chunks[0]
+        else:
+            value = ''
+        return value
+
+ 
+
+class _poller(object):
+    ''' Waits for pipes to become readable with epoll or poll when the
+    platform has them, otherwise with select. Unlike select they work with 
+    file descriptors above FD_SETSIZE (1024), and epoll does not scan all 
+    registered file descriptors on every call.
+    '''
+
+    def __init__(self, fds=()):
+        if hasattr(select, 'epoll'):
+            self._impl = select.epoll()
+            self._events = select.EPOLLIN
+            self._wevents = select.EPOLLOUT
+        elif hasattr(select, 'poll'):
+            self._impl = select.poll()
+            self._events = select.POLLIN
+            self._wevents = select.POLLOUT
+        else:
+            self._impl = None
+        self._fds = set()
+        self._wfds = set()
+        for fd in fds:
+            self.register(fd)
+
+    def register(self, fd, write=False):
+        ''' Wait for ``fd`` to become readable, or writable if ``write``
+        is true '''
+        if self._impl is not None:
+            self._impl.register(fd, write and self._wevents or self._events)
+        if write:
+            self._wfds.add(fd)
+        else:
+            self._fds.add(fd)
+
+    def unregister(self, fd):
+        if self._impl is not None:
+            self._impl.unregister(fd)
+        self._fds.discard(fd)
+        self._wfds.discard(fd)
+
+    def poll(self, timeout=None):
+        ''' Wait at most ``timeout`` seconds, forever if None. Returns the
+        readable and writable file descriptors, pipes at end of file or with
+        a closed reader count as ready.
+        '''
+        while True:
+            try:
+                if self._impl is None:
+                    readable, writable, _ = select.select(
+                            list(self._fds), list(self._wfds), [], timeout)
+                    return readable + writable
+                if hasattr(select, 'epoll') and \
+                        isinstance(self._impl, select.epoll):
+                    if timeout is None:
+                        timeout = -1
+                    events = self._impl.poll(timeout)
+                else:
+                    if timeout is not None:
+                        timeout = int(math.ceil(timeout * 1000))
+                    events = self._impl.poll(timeout)
+                return [fd for fd, event in events]
+            except (select.error, IOError, OSError), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        if hasattr(self._impl, 'close'):
+            self._impl.close()
+
+
+def _input_chunks(input, size):
+    ''' Yield the input for stdin in chunks of at most ``size`` bytes. 
+    ``input`` is a string, a file object or an iterator over strings.
+    '''
+    if isinstance(input, basestring):
+        for i in xrange(0, len(input), size):
+            yield input[i:i + size]
+    elif hasattr(input, 'read'):
+        while True:
+            chunk = input.read(size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in input:
+            if chunk:
+                yield chunk
+
+
+def _remaining(deadline):
+    ''' Seconds left until ``deadline``, None if there is no deadline '''
+    if deadline is None:
+        return None
+    return max(0, deadline - time.time())
+
+
+def _expired(deadline):
+    ''' True if there is a ``deadline`` and it has passed. Pipes that 
+    always have output ready never let poll time out, so loops check 
+    this too.
+    '''
+    return deadline is not None and time.time() >= deadline
+
+
+def _wait(poll, timeout):
+    ''' Call ``poll`` until it returns something else than None, for at 
+    most ``timeout`` seconds. Returns the last result of ``poll``.
+    '''
+    deadline = time.time() + timeout
+    delay = REAP_INTERVAL
+    while True:
+        sts = poll()
+        if sts is not None or time.time() >= deadline:
+            return sts
+        time.sleep(min(delay, _remaining(deadline)))
+        delay = min(delay * 2, REAP_INTERVAL_MAX)
+
+
+def _terminate(process, ladder=None):
+    ''' Send the signals in ``ladder`` (default ``KILL_LADDER``) to the 
+    process until it exits. Returns True if it exited.
+    '''
+    for sig, grace in ladder or KILL_LADDER:
+        process.kill(sig)
+        if _wait(process.poll, grace) is not None:
+            return True
+    return False
+
+
+def _kill_group(group, sig):
+    try:
+        os.kill(-group, sig)
+    except OSError, e:
+        # the group is already gone
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class _reaper(object):
+    ''' Reaps children that did not exit when they were killed in a 
+    background thread, so they do not stay around as zombies and nobody 
+    has to block waiting for them. It can also send them the signals of a
+    kill ladder, so killing does not block either.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # [process group, pids left, signals left, time of next signal]
+        self._children = []
+        self._thread = None
+        self._wake = threading.Event()
+
+    def adopt(self, pids, ladder=(), group=None):
+        ''' Reap ``pids`` in the background, first sending the signals in
+        ``ladder`` to the process ``group`` until they exit '''
+        ladder = list(ladder)
+        next_signal = time.time()
+        if ladder:
+            log.debug('Killing processes {} in the background', 
+                      ', '.join(map(str, pids)))
+            # the first signal now, the thread might be sleeping
+            sig, grace = ladder.pop(0)
+            _kill_group(group, sig)
+            next_signal += grace
+        else:
+            log.warning('Processes {} did not exit, reaping them in the '
+                        'background', ', '.join(map(str, pids)))
+        self._lock.acquire()
+        try:
+            self._children.append([group, set(pids), ladder, next_signal])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, 
+                                                name='sy.cmd reaper')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        delay = REAP_INTERVAL
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._children:
+                    self._thread = None
+                    return
+                children = list(self._children)
+            finally:
+                self._lock.release()
+
+            reaped = []
+            sleep = delay
+            for child in children:
+                group, pids, ladder, next_signal = child
+                for pid in list(pids):
+                    try:
+                        if os.waitpid(pid, os.WNOHANG)[0] != pid:
+                            continue
+                    except OSError, e:
+                        if e.errno != errno.ECHILD:
+                            raise
+                    pids.discard(pid)
+                    reaped.append(pid)
+                if pids and ladder:
+                    now = time.time()
+                    if now >= next_signal:
+                        sig, grace = ladder.pop(0)
+                        _kill_group(group, sig)
+                        child[3] = next_signal = now + grace
+                    sleep = min(sleep, max(0, next_signal - now))
+
+            self._lock.acquire()
+            try:
+                self._children = [child for child in self._children 
+                                  if child[1]]
+            finally:
+                self._lock.release()
+            if reaped:
+                log.debug('Reaped {}', ', '.join(map(str, reaped)))
+                delay = REAP_INTERVAL
+            self._wake.wait(min(sleep, delay))
+            self._wake.clear()
+            delay = min(delay * 2, 1)
+
+    def shutdown(self):
+        ''' Send the last signal of their ladders to the children left and
+        stop the thread, it can not run while the interpreter exits '''
+        self._lock.acquire()
+        try:
+            children, self._children = self._children, []
+            thread = self._thread
+        finally:
+            self._lock.release()
+        for group, pids, ladder, next_signal in children:
+            if ladder:
+                _kill_group(group, ladder[-1][0])
+        if thread is not None:
+            self._wake.set()
+            thread.join()
+
+    def __len__(self):
+        return sum(len(child[1]) for child in self._children)
+
+_abandoned = _reaper()
+atexit.register(_abandoned.shutdown)
+
+
+def _spawn_method(spawn):
+    ''' Resolve the spawn argument to ``fork`` or ``posix_spawn`` '''
+    spawn = spawn or SPAWN
+    if spawn == 'auto':
+        spawn = _libc and 'posix_spawn' or 'fork'
+    if spawn == 'posix_spawn':
+        assert _libc, 'posix_spawn is not available on this platform'
+    else:
+        assert spawn == 'fork', 'Unknown spawn method: %s' % spawn
+    return spawn
+
+
+def _child_signals():
+    ''' Undo the signal setup of Python in a forked child before exec.
+    Python ignores SIGPIPE and ignored signals stay ignored after exec, so
+    a command writing to a closed pipe would get EPIPE errors instead of 
+    quietly exiting, like ``yes`` in ``yes | head -1``.
+    '''
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _cstrings(strings):
+    ''' NULL terminated array of C strings '''
+    strings = list(strings)
+    return (ctypes.c_char_p * (len(strings) + 1))(*strings)
+
+
+def _posix_spawn(argv, file_actions=(), setpgroup=None):
+    ''' Start ``argv`` with posix_spawnp(3), searching PATH like execvp.
+    ``file_actions`` are ``(_SPAWN_DUP2, fd, newfd)`` and 
+    ``(_SPAWN_CLOSE, fd)`` tuples done in order in the child. With 
+    ``setpgroup`` the child joins that process group, 0 makes a new group.
+    SIGPIPE is reset to the default that Python ignores, see 
+    :func:`_child_signals`. Returns the pid of the child, raises OSError if it could not start.
+    '''
+    actions = ctypes.create_string_buffer(_SPAWN_STRUCT)
+    attr = ctypes.create_string_buffer(_SPAWN_STRUCT)
+    sigdefault = ctypes.create_string_buffer(_SPAWN_STRUCT)
+    _libc.sigemptyset(sigdefault)
+    _libc.sigaddset(sigdefault, signal.SIGPIPE)
+    _libc.posix_spawn_file_actions_init(actions)
+    _libc.posix_spawnattr_init(attr)
+    try:
+        for action in file_actions:
+            if action[0] == _SPAWN_DUP2:
+                _libc.posix_spawn_file_actions_adddup2(actions, *action[1:])
+            else:
+                _libc.posix_spawn_file_actions_addclose(actions, action[1])
+        flags = _SPAWN_SETSIGDEF
+        _libc.posix_spawnattr_setsigdefault(attr, sigdefault)
+        if setpgroup is not None:
+            flags |= _SPAWN_SETPGROUP
+            _libc.posix_spawnattr_setpgroup(attr, setpgroup)
+        _libc.posix_spawnattr_setflags(attr, flags)
+        env = ['%s=%s' % item for item in os.environ.iteritems()]
+        pid = ctypes.c_int()
+        err = _libc.posix_spawnp(ctypes.byref(pid), argv[0], actions, attr,
+                                 _cstrings(argv), _cstrings(env))
+    finally:
+        _libc.posix_spawn_file_actions_destroy(actions)
+        _libc.posix_spawnattr_destroy(attr)
+    if err:
+        raise OSError(err, os.strerror(err))
+    return pid.value
+
+
+class _subprocess(object):
+    ''' Class representing a subprocess. ``cmd`` is a shell command string or
+    an argv list that is executed without a shell. Example usage:
+
+        >>> proc = _subprocess('ls')
+        >>> timed_out = proc.read(timeout=10)
+        >>> return_code = proc.cleanup()
+        >>> print proc.outdata, proc.errdata
+        >>> del(proc)
+
+    A process that timed out is killed and reaped with :meth:`abort`.
+
+    If ``stream`` is a callable it is called with every stdout chunk instead
+    of collecting it in ``outdata``, and only the last ``STREAM_ERR_TAIL``
+    bytes of stderr are kept.
+
+    ``max_output`` limits the number of bytes kept from each of stdout and 
+    stderr, ``truncate`` is the policy used when it is exceeded, see 
+    :class:`_buffer`. With ``raise`` the :meth:`read_fd` raises 
+    :exc:`_OutputOverflow`.
+
+    ``spawn`` selects how the child is started, see ``SPAWN``. posix_spawn
+    does not copy the page tables of the parent which makes it much faster 
+    than fork for parents with a large memory footprint. A command that 
+    posix_spawn cannot start is retried with fork so it fails the same way
+    with both.
+
+    If ``stdin`` is true the child reads stdin from a pipe that the parent
+    writes to with ``inw``, otherwise stdin is inherited. ``input`` is fed
+    to that pipe by :meth:`read` with :meth:`write_fd`, see :func:`run` for 
+    what it can be.
+    '''
+
+    # nothing to clean up until the child is started
+    cleaned = True
+
+    def __init__(self, cmd, bufsize=8192, stream=None, max_output=None, 
+                 truncate='head', spawn=None, stdin=False, input=None):
+        spawn = _spawn_method(spawn)
+        self.sts = None
+        self.BUFSIZE = bufsize
+        self.stream = stream
+        self.outr, self.outw = os.pipe()
+        self.errr, self.errw = os.pipe()
+        self.inr = self.inw = None
+        self._input = None
+        try:
+            if stdin or input is not None:
+                self.inr, self.inw = os.pipe()
+            self.pid = self._start(cmd, spawn)
+        except:
+            for fd in (self.outr, self.outw, self.errr, self.errw, 
+                       self.inr, self.inw):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        self.cleaned = False
+        # parent doesnt write, so close
+        os.close(self.outw)
+        os.close(self.errw)
+        if self.inr is not None:
+            os.close(self.inr)
+        if input is not None:
+            # writes must never block the loop that reads the output
+            flags = fcntl.fcntl(self.inw, fcntl.F_GETFL)
+            fcntl.fcntl(self.inw, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._input = _input_chunks(input, INPUT_CHUNK)
+            self._pending = ''
+
+        self._out = _buffer(max_output, truncate)
+        if stream:
+            self._err = _buffer(STREAM_ERR_TAIL, 'tail')
+        else:
+            self._err = _buffer(max_output, truncate)
+        self._outeof = self._erreof = 0
+        self.outbytes = self.errbytes = 0
+        self.utime = self.stime = 0.0
+        self.maxrss = 0
+
+    def _argv(self, cmd):
+        if isinstance(cmd, list):
+            # argv command, exec directly
+            return cmd
+        return ['/bin/sh', '-c', cmd]
+
+    def _start(self, cmd, spawn):
+        if spawn == 'posix_spawn':
+            try:
+                return self._spawn(cmd)
+            except OSError, e:
+                log.debug('posix_spawn failed, using fork: {}', e)
+        pid = os.fork()
+        if pid == 0:
+            self._child(cmd)
+        try:
+            # also in the parent, a kill right after the fork must reach
+            # the group of the child
+            os.setpgid(pid, pid)
+        except OSError, e:
+            # the child is already in its group and has exec'd
+            if e.errno not in (errno.EACCES, errno.ESRCH):
+                raise
+        return pid
+
+    def _child(self, cmd):
+        os.setpgrp() # seperate group so we can kill it
+        _child_signals()
+        os.dup2(self.outw, 1) # stdout to write side of pipe
+        os.dup2(self.errw, 2) # stderr to write side of pipe
+        if self.inr is not None:
+            os.dup2(self.inr, 0) # stdin from read side of pipe
+            map(os.close, (self.inr, self.inw))
+
+        # stdout & stderr connected to pipe, so close all other files
+        map(os.close, (self.outr, self.outw, self.errr, self.errw))
+        try:
+            cmd = self._argv(cmd)
+            os.execvp(cmd[0], cmd)
+        finally:
+            os._exit(1)
+
+    def _spawn(self, cmd):
+        # same setup as _child but done by the posix_spawn file actions
+        file_actions = [
+            (_SPAWN_DUP2, self.outw, 1),
+            (_SPAWN_DUP2, self.errw, 2),
+        ] + [(_SPAWN_CLOSE, fd) 
+             for fd in (self.outr, self.outw, self.errr, self.errw)]
+        if self.inr is not None:
+            file_actions += [
+                (_SPAWN_DUP2, self.inr, 0),
+                (_SPAWN_CLOSE, self.inr),
+                (_SPAWN_CLOSE, self.inw),
+            ]
+        return _posix_spawn(self._argv(cmd), file_actions, setpgroup=0)
+
+    def fds(self):
+        ''' Return the pipes that have not reached end of file '''
+        fds = []
+        if not self._outeof:
+            fds.append(self.outr)
+        if not self._erreof:
+            fds.append(self.errr)
+        return fds
+
+    def read_fd(self, fd):
+        ''' Read a chunk from one of the pipes, returns the chunk which is
+        empty at end of file 
+        '''
+        chunk = os.read(fd, self.BUFSIZE)
+        if fd == self.outr:
+            self.outbytes += len(chunk)
+            if not chunk:
+                self._outeof = 1
+            elif self.stream:
+                self.stream(chunk)
+            else:
+                self._write(self._out, chunk)
+        else:
+            self.errbytes += len(chunk)
+            if not chunk:
+                self._erreof = 1
+            else:
+                self._write(self._err, chunk)
+        return chunk
+
+    def _write(self, buffer, chunk):
+        buffer.write(chunk)
+        if buffer.truncated and buffer.keep == 'raise':
+            raise _OutputOverflow()
+
+    outdata = property(lambda self: self._out.getvalue())
+    errdata = property(lambda self: self._err.getvalue())
+
+    def write_fd(self):
+        ''' Write as much of the input to stdin as the pipe takes without
+        blocking. Returns False when all input is written or the child has 
+        closed its end, stdin should then be closed with :meth:`close_stdin`.
+        '''
+        try:
+            while True:
+                if not self._pending:
+                    try:
+                        self._pending = self._input.next()
+                    except StopIteration:
+                        return False
+                    continue
+                written = os.write(self.inw, self._pending)
+                self._pending = self._pending[written:]
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            if e.errno != errno.EPIPE:
+                raise
+            # the child does not want more input
+            log.debug('Command closed stdin before reading all input')
+            return False
+
+    def read(self, timeout=None):
+        ''' Read stdout and stderr until end of file and write the input
+        to stdin. Returns 1 if ``timeout`` seconds passed before that, 
+        otherwise 0. No timeout if None, a timeout of 0 or less has 
+        already passed.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        poller = _poller(self.fds())
+        writing = self._input is not None and self.inw is not None
+        if writing:
+            poller.register(self.inw, write=True)
+        try:
+            while self.fds() or writing:
+                ready = poller.poll(_remaining(deadline))
+                if not ready or _expired(deadline):
+                    return 1
+                for fd in ready:
+                    if writing and fd == self.inw:
+                        if not self.write_fd():
+                            poller.unregister(fd)
+                            self.close_stdin()
+                            writing = False
+                    elif not self.read_fd(fd):
+                        poller.unregister(fd)
+            return 0
+        finally:
+            poller.close()
+
+    def kill(self, sig=signal.SIGTERM):
+        _kill_group(self.pid, sig)
+
+    def poll(self):
+        ''' Reap the child if it has exited, without blocking. 
+        Returns the wait status or None if the child is still running
+        '''
+        if self.sts is None:
+            pid, sts, rusage = os.wait4(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self.sts = sts
+                _add_rusage(self, rusage)
+        return self.sts
+
+    def close_stdin(self):
+        if self.inw is not None:
+            os.close(self.inw)
+            self.inw = None
+
+    def wait(self, timeout=None):
+        ''' Reap the child, waiting at most ``timeout`` seconds or forever 
+        if None. Returns the wait status or None if it is still running
+        '''
+        if self.sts is None and timeout is None:
+            pid, sts, rusage = os.wait4(self.pid, 0)
+            if pid == self.pid:
+                self.sts = sts
+                _add_rusage(self, rusage)
+        elif self.sts is None:
+            _wait(self.poll, timeout)
+        return self.sts
+
+    def cleanup(self, timeout=None, ladder=()):
+        ''' Close the pipes and reap the child, see :meth:`wait`. A child
+        that is still running after ``timeout`` is left to the background
+        reaper, which first sends it the signals in ``ladder``. Returns 
+        the wait status or None
+        '''
+        self.cleaned = True
+        self.close_stdin()
+        os.close(self.outr)
+        os.close(self.errr)
+        if self.wait(timeout) is None:
+            _abandoned.adopt([self.pid], ladder, self.pid)
+        return self.sts
+
+    def abort(self, ladder=None):
+        ''' Kill the child with the ``KILL_LADDER`` signals and clean up 
+        without blocking longer than the ladder allows
+        '''
+        _terminate(self, ladder)
+        return self.cleanup(0)
+
+    def abandon(self, ladder=None):
+        ''' Clean up without blocking, a child that is still running is 
+        killed with the ``KILL_LADDER`` signals by the background reaper
+        '''
+        return self.cleanup(0, ladder or KILL_LADDER)
+
+    def __del__(self):
+        if not self.cleaned:
+            self.cleanup(0)
+
+class _path_index(object):
+    ''' Names of the files in the search path directories, scanned once.
+    Maps a name to the directories that have it in search order.
+    '''
+
+    def __init__(self, envpath):
+        self.envpath = envpath
+        self.dirs = _search_path(envpath)
+        self.mtimes = self._mtimes()
+        self.checked = time.time()
+        self.names = {}
+        for path in self.dirs:
+            for name in _listdir(path):
+                self.names.setdefault(name, []).append(path)
+
+    def _mtimes(self):
+        mtimes = []
+        for path in self.dirs:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def changed(self):
+        ''' True if a directory was changed since the index was built '''
+        self.checked = time.time()
+        return self._mtimes() != self.mtimes
+
+    def lookup(self, cmd_name):
+        for path in self.names.get(cmd_name, ()):
+            cmd_path = os.path.join(path, cmd_name)
+            if os.access(cmd_path, os.X_OK) and not os.path.isdir(cmd_path):
+                return cmd_path
+        return None
+
+
+def _listdir(path):
+    ''' Return the names of the files in path, or no names if it can not 
+    be read '''
+    try:
+        if _scandir:
+            return [entry.name for entry in _scandir(path) 
+                    if not entry.is_dir()]
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _search_path(envpath):
+    import glob, platform
+    search_path = [path for path in envpath.split(':') if path]
+    default_path = [
+            '/bin', '/sbin', '/usr/bin', '/usr/sbin', '/usr/local/bin', 
+            '/usr/local/sbin'] + sorted(glob.glob('/opt/*/bin'))
+    if platform.system() == 'SunOS':
+        default_path.extend([
+            '/usr/sfw/bin', '/usr/xpg4/bin', '/usr/xpg5/bin', 
+            '/usr/java/bin', '/usr/ccs/bin',
+            ])
+    for path in default_path:
+        if path not in search_path:
+            search_path.append(path)
+    return search_path
+
+
+_find_index = None
+
+def find(cmd_name):
+    ''' Search for the command and return the full path
+
+    >>> import sy
+    >>> sy.cmd.find('ifconfig')
+    '/usr/sbin/ifconfig'
+
+    Searches the directories specified in the environment PATH and a
+    couple of default directories.
+
+    The directories are listed once into an index that is rebuilt when 
+    PATH changes or when one of the directories has changed. Directories 
+    are checked for changes when a command is not found and at most every
+    ``FIND_RECHECK`` seconds otherwise.
+
+    :param cmd_name: Command to search for.
+    ''' 
+    global _find_index
+    index = _find_index
+    envpath = os.environ.get('PATH', '')
+    if index is None or index.envpath != envpath:
+        index = _find_index = _path_index(envpath)
+    elif time.time() - index.checked > FIND_RECHECK and index.changed():
+        index = _find_index = _path_index(envpath)
+
+    cmd_path = index.lookup(cmd_name)
+    if cmd_path is None and index.changed():
+        # installed or removed since the index was built
+        index = _find_index = _path_index(envpath)
+        cmd_path = index.lookup(cmd_name)
+    if cmd_path is None:
+        raise CommandError('Command %s not found in path: %s' % (
+            cmd_name, ':'.join(index.dirs)))
+    return cmd_path
+ 
+def shell_escape(str):
+    ''' Return the string with all unsafe shell character replaced '''
+    return re.sub(r'''([ \t'"\$])''', r'\\\1', str)  
+
+def format_cmd(command, args):
+    r'''Format a shell command using safe escapes and argument substitutions::
+
+        >>> format_cmd('ls -l {} | grep {} | wc', ['foo 1', 'bar$baz'])
+        'ls -l foo\\ 1 | grep bar\\$baz | wc'
+
+    Usually you don't need to call this, it is used to format the command
+    by :func:`run`, and derived :func:`outlines` and :func:`do`
+
+    .. note:: 
+
+        You must escape ``{}`` in commands or pass it as a argument. These 
+        have the same result::
+
+            format_cmd('find . -exec ls \{\} \;')
+            format_cmd('find . -exec ls {} \;', ['{}'])
+
+
+    Taken from iterpipes
+    '''
+
+    if command.count('{}') != len(args):
+        raise TypeError(
+            'Number of arguments do not match the format string %r: %r' %
+             (command, args))
+    fmt = command.replace('%', '%%').replace('{}', '%s')
+    return fmt % tuple(map(shell_escape, args)) 
+
+
+def _display_cmd(command, args):
+    ''' Return the command as a string for logs and error messages '''
+    if isinstance(command, (list, tuple)):
+        return ' '.join(map(shell_escape, command))
+    return format_cmd(command, args)
+
+
+def _prepare(command, args):
+    ''' Return the command to pass to :class:`_subprocess` and the 
+    command as a string for logs and error messages.
+    
+    ``command`` is either a template for :func:`format_cmd` or an argv 
+    list, in which case the program is looked up with :func:`find` unless
+    it contains a ``/``.
+    '''
+    if isinstance(command, (list, tuple)):
+        assert not args, 'Arguments can not be used with an argv command'
+        assert command, 'Missing command'
+        argv = list(command)
+        if '/' not in argv[0]:
+            argv[0] = find(argv[0])
+        return argv, _display_cmd(command, args)
+    escapedcmd = format_cmd(command, args)
+    return escapedcmd, escapedcmd
+
+
+def outlines(command, *args, **kwargs):
+    ''' Spawn a command and return stdout lines. 
+    Same arguments as :func:`do` expects
+    :returns: stdout as list of lines
+    '''
+    out, _ = do(command, *args, **kwargs)
+    return out.splitlines()
+
+
+def iterlines(command, *args, **kwargs):
+    ''' Spawn a command and yield stdout lines as they arrive::
+
+            for line in sy.cmd.iterlines('find {} -type f', '/', timeout=600):
+                print line
+
+    Unlike :func:`outlines` the output is never held in memory, so it works
+    for commands with huge output. Only the last ``STREAM_ERR_TAIL`` bytes 
+    of stderr are kept for the :exc:`CommandError` raised if the command 
+    does not exit with the ``expect`` status. The timeout covers the whole 
+    iteration, including time spent in the loop body. The command is killed
+    if the iteration is stopped early.
+
+    Same arguments as :func:`do` expects
+
+    :returns: iterator over stdout lines without newline characters
+    '''
+    expect = kwargs.pop('expect', 0)
+    timeout = kwargs.pop('timeout', CMD_TIMEOUT)
+    bufsize = kwargs.pop('bufsize', 8192)
+    spawn = kwargs.pop('spawn', None)
+    assert kwargs == {}, 'Unknown keyword arg passed to run: ' + ','.join(kwargs.keys())
+
+    cmd, escapedcmd = _prepare(command, args)
+    log.debug('Spawning: {}', escapedcmd)
+
+    chunks = []
+    start_time = time.time()
+    process = _subprocess(cmd, bufsize=bufsize, stream=chunks.append,
+                          spawn=spawn)
+    timed_out = False
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    partial = ''
+    poller = _poller(process.fds())
+    try:
+        while process.fds():
+            ready = poller.poll(_remaining(deadline))
+            if not ready or _expired(deadline):
+                process.abort()
+                timed_out = True
+                raise _timeout_error(escapedcmd, timeout, partial, 
+                                     process.errdata)
+            for fd in ready:
+                if not process.read_fd(fd):
+                    poller.unregister(fd)
+            if chunks:
+                lines = (partial + ''.join(chunks)).split('\n')
+                del chunks[:]
+                partial = lines.pop()
+                for line in lines:
+                    yield line.rstrip('\r')
+        if process.wait(_remaining(deadline)) is None:
+            # closed its output but did not exit in time
+            process.abort()
+            timed_out = True
+            raise _timeout_error(escapedcmd, timeout, partial, 
+                                 process.errdata)
+        if partial:
+            yield partial.rstrip('\r')
+    finally:
+        poller.close()
+        if not process.cleaned:
+            if process.sts is None:
+                process.abort()
+            else:
+                process.cleanup()
+        status = None
+        if not timed_out and process.sts is not None:
+            status = os.WEXITSTATUS(process.sts)
+        _record(command, escapedcmd, process, start_time, status, timed_out)
+
+    if status != expect:
+        raise _status_error(escapedcmd, expect, status, '', process.errdata)
+ 
+
+def do(command, *args, **kwargs):
+    r'''Spawn a command and returns stdout and stderr. If the command
+    does not exit with the ``expect`` status (default 0) it raises 
+    :exc:`CommandError`.
+
+    See :func:`run` for the other options.
+
+    :arg expect: Expected exit status, default 0 
+    :returns: stdout and stderr as strings
+    '''
+    expect = kwargs.pop('expect', 0)
+
+    status, out, err = run(command, *args, **kwargs)
+
+    if status != expect:
+        raise _status_error(_display_cmd(command, args), expect, status, 
+                            out, err)
+    return out, err
+    
+
+
+def run(command, *args, **kwargs):
+    ''' Execute a command with a timeout and capture output and exit status::
+
+            status, out, err = sy.cmd.run('ls -R {}', '/tmp', timeout=15) 
+
+        The command can also be an argv list, it is then executed directly 
+        without a shell. There is no quoting to get wrong and no shell to 
+        start::
+
+            status, out, err = sy.cmd.run(['ifconfig', name, 'plumb'])
+        
+        Use the convenience function :func:`do` if you want to fire off a
+        command and fail if it doesnt return exit status 0.                        
+        
+        :arg command: Command template or argv list
+        :arg args: Arguments for formatting the command, see :func:`format_cmd`.
+                   Not allowed for argv lists
+        :arg timeout: Seconds until the command times out and raises 
+                      a :exc:`CommandTimeoutError`. The command is then 
+                      killed with the signals in ``sy.cmd.KILL_LADDER``, 
+                      SIGTERM and then SIGKILL. None waits forever, 0 has
+                      already passed
+        :arg stream: Callable that is called with stdout chunks as they 
+                     arrive. Stdout is then not collected and only the tail
+                     of stderr is kept, see :func:`iterlines`
+        :arg max_output: Maximum number of bytes kept from stdout and from
+                         stderr, default is no limit
+        :arg truncate: What to do when ``max_output`` is exceeded. ``head``
+                       (default) keeps the first bytes, ``tail`` keeps the 
+                       last bytes and ``raise`` kills the command and raises
+                       :exc:`CommandOutputError`
+        :arg spawn: How to start the command, ``fork`` or ``posix_spawn``. 
+                    Default is ``sy.cmd.SPAWN``
+        :arg input: Data for stdin of the command, a string, a file object or
+                    an iterator over strings. It is written as the command 
+                    reads it, files and iterators are not read into memory.
+                    Default is to inherit stdin
+        :returns: exit status from the command, stdout and stderr. 
+                  On timeout it raises :exc:`CommandTimeoutError`
+    '''
+    timeout = kwargs.pop('timeout', CMD_TIMEOUT)
+    bufsize = kwargs.pop('bufsize', 8192)
+    stream = kwargs.pop('stream', None)
+    max_output = kwargs.pop('max_output', None)
+    truncate = kwargs.pop('truncate', 'head')
+    spawn = kwargs.pop('spawn', None)
+    input = kwargs.pop('input', None)
+    assert kwargs == {}, 'Unknown keyword arg passed to run: ' + ','.join(kwargs.keys())
+    
+    cmd, escapedcmd = _prepare(command, args)
+    log.debug('Spawning: {}', escapedcmd)
+
+    start_time = time.time()
+    deadline = None
+    if timeout is not None:
+        deadline = start_time + timeout
+    process = _subprocess(cmd, bufsize=bufsize, stream=stream,
+                          max_output=max_output, truncate=truncate, 
+                          spawn=spawn, input=input)
+    try:
+        timed_out = process.read(_remaining(deadline))
+    except _OutputOverflow:
+        process.abort()
+        _record(command, escapedcmd, process, start_time, None)
+        raise _output_error(escapedcmd, process, max_output)
+
+    if not timed_out and process.wait(_remaining(deadline)) is None:
+        # closed its output but did not exit in time
+        timed_out = 1
+
+    if timed_out:
+        # process timed out
+        process.abort()
+        _record(command, escapedcmd, process, start_time, None, timed_out=True)
+        raise _timeout_error(escapedcmd, timeout, process.outdata, 
+                             process.errdata)
+
+    exitstatus = os.WEXITSTATUS( process.cleanup() )
+    out = process.outdata
+    err = process.errdata
+    _record(command, escapedcmd, process, start_time, exitstatus)
+    del(process)
+
+    log.debug('Command result, stdout:{}, stderr:{}, exitstatus:{}', 
+                 out.strip(), err.strip(), exitstatus)
+    return exitstatus, out, err
+
+
+class CommandStats(object):
+    ''' Resource usage of a command, passed to the hooks added with 
+    :func:`add_hook`.
+
+    .. attribute:: template
+
+       The command template, for argv commands the program
+
+    .. attribute:: cmd
+
+       The command that was run
+
+    .. attribute:: status
+
+       Exit status, a list of them for :func:`pipeline` and None if the 
+       command was killed
+
+    .. attribute:: wall
+
+       Seconds from start until the command was reaped
+
+    .. attribute:: utime, stime
+
+       User and system CPU seconds used by the command. 0 for commands run
+       in a :class:`Session`, the shell reaps those
+
+    .. attribute:: maxrss
+
+       Max resident set size as reported by the OS, kilobytes on Linux. 0 
+       for commands run in a :class:`Session`
+
+    .. attribute:: outbytes, errbytes
+
+       Bytes read from stdout and stderr, also the ones not kept
+
+    .. attribute:: timed_out
+
+       True if the command timed out
+    '''
+
+    def __init__(self, template, cmd, status, wall, utime, stime, maxrss,
+                 outbytes, errbytes, timed_out):
+        self.template = template
+        self.cmd = cmd
+        self.status = status
+        self.wall = wall
+        self.utime = utime
+        self.stime = stime
+        self.maxrss = maxrss
+        self.outbytes = outbytes
+        self.errbytes = errbytes
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return '<CommandStats %r status=%r wall=%.3f utime=%.3f stime=%.3f>' % (
+                self.cmd, self.status, self.wall, self.utime, self.stime)
+
+
+_hooks = []
+
+def add_hook(hook):
+    ''' Add a callable that is called with a :class:`CommandStats` when 
+    a command has finished. Exceptions raised by hooks are logged and 
+    ignored. See :class:`Profile` for a hook that aggregates the stats.
+    '''
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    ''' Remove a hook added with :func:`add_hook` '''
+    _hooks.remove(hook)
+
+
+def _template(command):
+    if isinstance(command, (list, tuple)):
+        return command[0]
+    return command
+
+
+def _add_rusage(process, rusage):
+    process.utime += rusage.ru_utime
+    process.stime += rusage.ru_stime
+    process.maxrss = max(process.maxrss, rusage.ru_maxrss)
+
+
+def _record(command, escapedcmd, process, start_time, status, 
+            timed_out=False):
+    ''' Create the stats for a reaped process and pass them to the hooks '''
+    stats = CommandStats(_template(command), escapedcmd, status, 
+                         time.time() - start_time, process.utime, 
+                         process.stime, process.maxrss, process.outbytes, 
+                         process.errbytes, timed_out)
+    log.debug('Command took {} seconds, user {} sys {}', 
+              round(stats.wall, 3), stats.utime, stats.stime)
+    for hook in _hooks[:]:
+        try:
+            hook(stats)
+        except Exception:
+            log.exception('Command stats hook failed')
+    return stats
+
+
+class Profile(object):
+    ''' Hook that sums up :class:`CommandStats` per command template, to 
+    find out which commands a script spends its time on::
+
+        profile = sy.cmd.Profile()
+        sy.cmd.add_hook(profile)
+        provision()
+        sy.cmd.remove_hook(profile)
+        print profile.report()
+
+    .. attribute:: templates
+
+       Dict with the template as key and a dict with ``count``, ``wall``, 
+       ``max_wall``, ``utime``, ``stime``, ``maxrss``, ``outbytes``, 
+       ``errbytes`` and ``timeouts`` as value
+    '''
+
+    def __init__(self):
+        self.templates = {}
+
+    def __call__(self, stats):
+        total = self.templates.get(stats.template)
+        if total is None:
+            total = self.templates[stats.template] = dict(
+                        count=0, wall=0.0, max_wall=0.0, utime=0.0, 
+                        stime=0.0, maxrss=0, outbytes=0, errbytes=0, 
+                        timeouts=0)
+        total['count'] += 1
+        total['wall'] += stats.wall
+        total['max_wall'] = max(total['max_wall'], stats.wall)
+        total['utime'] += stats.utime
+        total['stime'] += stats.stime
+        total['maxrss'] = max(total['maxrss'], stats.maxrss)
+        total['outbytes'] += stats.outbytes
+        total['errbytes'] += stats.errbytes
+        if stats.timed_out:
+            total['timeouts'] += 1
+
+    def report(self, sort='wall'):
+        ''' Return a table with one line per template, sorted by ``sort``
+        which is one of the keys in :attr:`templates` '''
+        lines = ['%8s %10s %10s %10s %10s %10s %8s  %s' % (
+                    'count', 'wall', 'max wall', 'user', 'sys', 'maxrss', 
+                    'timeouts', 'command')]
+        items = self.templates.items()
+        items.sort(key=lambda item: item[1][sort], reverse=True)
+        for template, total in items:
+            lines.append('%8d %10.3f %10.3f %10.3f %10.3f %10d %8d  %s' % (
+                total['count'], total['wall'], total['max_wall'], 
+                total['utime'], total['stime'], total['maxrss'], 
+                total['timeouts'], template))
+        return '\n'.join(lines)
+
+
+def _status_error(escapedcmd, expect, status, out, err):
+    msg = 'Command "%s" did not exit with status %d: %s' % (
+            escapedcmd, expect, err.strip()) 
+    return CommandError(msg, out=out, err=err, status=status, cmd=escapedcmd)
+
+
+def _timeout_error(escapedcmd, timeout, out, err):
+    errormsg = 'Command "%s" timed out after %d secs' % (escapedcmd, timeout)
+    log.error(errormsg)
+    return CommandTimeoutError(errormsg, out=out, err=err, cmd=escapedcmd, 
+                               timeout=timeout)
+
+
+def _output_error(escapedcmd, process, max_output):
+    errormsg = 'Command "%s" produced more than %d bytes of output' % (
+                    escapedcmd, max_output)
+    log.error(errormsg)
+    return CommandOutputError(errormsg, out=process.outdata, 
+                              err=process.errdata, cmd=escapedcmd, 
+                              max_output=max_output)
+
+
+
+class RunCache(object):
+    ''' Cache of results from :func:`run`, used by :func:`cached_run`. 
+
+    Results are kept for ``ttl`` seconds and at most ``maxsize`` results are
+    kept, the least recently used is removed first. Failed commands, ie 
+    timeouts, are not cached. The numbers of cache hits and misses are 
+    kept in the attributes ``hits`` and ``misses``.
+
+    :arg ttl: Seconds a result is valid
+    :arg maxsize: Maximum number of results to keep
+    '''
+
+    def __init__(self, ttl=CACHE_TTL, maxsize=CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        if OrderedDict:
+            self._entries = OrderedDict()
+        else:
+            self._entries = {}
+        self._lock = threading.Lock()
+
+    def _key(self, command, args, kwargs):
+        options = [(k, v) for k, v in kwargs.items() if k != 'timeout']
+        options.sort()
+        return _display_cmd(command, args), tuple(options)
+
+    def run(self, command, *args, **kwargs):
+        ''' Return the cached result of the command or run it. 
+        Same arguments as :func:`run` and ``ttl`` to override the default 
+        time to live for this result.
+        '''
+        ttl = kwargs.pop('ttl', self.ttl)
+        assert 'stream' not in kwargs, 'Streamed output can not be cached'
+        assert isinstance(kwargs.get('input', ''), basestring), \
+                'Only string input can be cached'
+        key = self._key(command, args, kwargs)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                # reinsert as most recently used
+                self._entries[key] = entry
+                log.debug('Cached result for: {}', key[0])
+                return entry[1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        result = run(command, *args, **kwargs)
+
+        self._lock.acquire()
+        try:
+            self._entries[key] = (time.time() + ttl, result)
+            while len(self._entries) > self.maxsize:
+                if OrderedDict:
+                    self._entries.popitem(last=False)
+                else:
+                    oldest = min(self._entries.items(), 
+                                 key=lambda item: item[1][0])
+                    del self._entries[oldest[0]]
+        finally:
+            self._lock.release()
+        return result
+
+    def invalidate(self, command, *args):
+        ''' Remove the cached results for a command, call it after doing 
+        something that changes the output::
+
+            sy.cmd.do('ifconfig {} down', name)
+            sy.cmd.cache.invalidate('ifconfig -a')
+
+        The command and arguments are matched after formatting, results 
+        for all other options are removed.
+        '''
+        display = _display_cmd(command, args)
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                if key[0] == display:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        ''' Remove all cached results and reset the counters '''
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = RunCache()
+
+def cached_run(command, *args, **kwargs):
+    ''' Same as :func:`run` but returns a cached result if the same 
+    command was run within ``ttl`` seconds::
+
+            status, out, err = sy.cmd.cached_run('zoneadm list -p', ttl=10)
+
+    Only use it for commands that do not change anything and whose output
+    can be a bit stale. The cache is ``sy.cmd.cache``, a :class:`RunCache`,
+    use its :meth:`RunCache.invalidate` when the output is known to have 
+    changed.
+
+    :arg ttl: Seconds the result is valid, default ``CACHE_TTL``
+    '''
+    return cache.run(command, *args, **kwargs)
+
+
+class _job(object):
+    ''' A command waiting to be run or running in a :class:`Pool` '''
+
+    def __init__(self, index, command, args, kwargs):
+        self.index = index
+        self.timeout = kwargs.pop('timeout', CMD_TIMEOUT)
+        self.bufsize = kwargs.pop('bufsize', 8192)
+        self.max_output = kwargs.pop('max_output', None)
+        self.truncate = kwargs.pop('truncate', 'head')
+        self.spawn = kwargs.pop('spawn', None)
+        self.stream = kwargs.pop('stream', None)
+        self.input = kwargs.pop('input', None)
+        assert kwargs == {}, 'Unknown keyword arg passed to run: ' + ','.join(kwargs.keys())
+        self.template = command
+        self.cmd, self.escapedcmd = _prepare(command, args)
+        self.process = None
+        self.deadline = None
+
+    def start(self):
+        log.debug('Spawning: {}', self.escapedcmd)
+        self.start_time = time.time()
+        self.process = _subprocess(self.cmd, bufsize=self.bufsize,
+                                   stream=self.stream,
+                                   max_output=self.max_output, 
+                                   truncate=self.truncate, spawn=self.spawn,
+                                   input=self.input)
+        self.input = None
+        if self.timeout is not None:
+            self.deadline = self.start_time + self.timeout
+
+    def fds(self):
+        ''' The pipes to wait for, stdin while there is input left '''
+        fds = self.process.fds()
+        if self.process.inw is not None:
+            fds.append(self.process.inw)
+        return fds
+
+    def finish(self, timed_out=False):
+        ''' Return the result, the child has exited or timed out so this 
+        does not block '''
+        process = self.process
+        if timed_out:
+            process.abandon()
+            log.error('Command "{}" timed out after {} secs', 
+                      self.escapedcmd, self.timeout)
+            status = None
+        else:
+            status = os.WEXITSTATUS( process.cleanup() )
+        _record(self.template, self.escapedcmd, process, self.start_time, 
+                status, timed_out)
+        self.process = None
+        return status, process.outdata, process.errdata
+
+
+class Pool(object):
+    ''' Run many commands concurrently with a bounded number of children::
+
+            pool = sy.cmd.Pool(size=20)
+            for host in hosts:
+                pool.add('ping -c 1 {}', host, timeout=5)
+            for status, out, err in pool.run():
+                print status
+
+        All children are watched from a single poll loop in the calling 
+        thread. Jobs take the same arguments as :func:`run`, stdin is 
+        inherited unless the job has ``input``.
+        
+        A job that times out is killed and gets the exit status ``None``, 
+        the output collected before the timeout is kept. A job that exceeds
+        its ``max_output`` with ``truncate='raise'`` stops the whole pool 
+        with a :exc:`CommandOutputError`.
+        
+        :arg size: Maximum number of commands running at the same time
+    '''
+
+    def __init__(self, size=POOL_SIZE):
+        assert size > 0, 'Pool size must be at least 1'
+        self.size = size
+        self._jobs = []
+
+    def add(self, command, *args, **kwargs):
+        ''' Add a command to the pool, same arguments as :func:`run`. 
+
+        :returns: the index of the job, its position in the result of 
+                  :meth:`run`
+        '''
+        job = _job(len(self._jobs), command, args, kwargs)
+        self._jobs.append(job)
+        return job.index
+
+    def completed(self):
+        ''' Run the added jobs and yield ``index, (status, out, err)`` 
+        as they finish. 
+        
+        Running commands are killed if the generator is closed before 
+        all jobs are done.
+        '''
+        pending = self._jobs[::-1]
+        self._jobs = []
+        active = []
+        # jobs with all output read, waiting for the child to exit
+        exiting = []
+        delay = REAP_INTERVAL
+        fdmap = {}
+        poller = _poller()
+        try:
+            while pending or active:
+                while pending and len(active) < self.size:
+                    job = pending.pop()
+                    job.start()
+                    active.append(job)
+                    for fd in job.fds():
+                        fdmap[fd] = job
+                        poller.register(fd, write=fd == job.process.inw)
+
+                deadlines = [job.deadline for job in active if job.deadline]
+                timeout = None
+                if deadlines:
+                    timeout = _remaining(min(deadlines))
+                if exiting:
+                    # check for exited children now and then
+                    timeout = min(delay, timeout is None and delay or timeout)
+                    delay = min(delay * 2, REAP_INTERVAL_MAX)
+                ready = poller.poll(timeout)
+
+                finished = []
+                for fd in ready:
+                    job = fdmap[fd]
+                    if fd == job.process.inw:
+                        if job.process.write_fd():
+                            continue
+                        del fdmap[fd]
+                        poller.unregister(fd)
+                        job.process.close_stdin()
+                    else:
+                        try:
+                            chunk = job.process.read_fd(fd)
+                        except _OutputOverflow:
+                            active.remove(job)
+                            job.process.abandon()
+                            _record(job.template, job.escapedcmd, 
+                                    job.process, job.start_time, None)
+                            raise _output_error(job.escapedcmd, job.process,
+                                                job.max_output)
+                        if chunk:
+                            continue
+                        del fdmap[fd]
+                        poller.unregister(fd)
+                    if not job.fds():
+                        exiting.append(job)
+
+                for job in exiting[:]:
+                    if job.process.poll() is not None:
+                        exiting.remove(job)
+                        finished.append((job, False))
+                        delay = REAP_INTERVAL
+
+                now = time.time()
+                for job in active:
+                    if job.deadline and now >= job.deadline and \
+                            (job, False) not in finished:
+                        for fd in job.fds():
+                            del fdmap[fd]
+                            poller.unregister(fd)
+                        if job in exiting:
+                            exiting.remove(job)
+                        finished.append((job, True))
+
+                for job, timed_out in finished:
+                    active.remove(job)
+                    yield job.index, job.finish(timed_out)
+        finally:
+            poller.close()
+            for job in active:
+                job.process.abandon()
+
+    def run(self, ordered=True):
+        ''' Run the added jobs and wait for all of them to finish.
+
+        :arg ordered: Return the results in the order the jobs were added,
+                      if False they are returned in the order they finished
+        :returns: list of exit status, stdout and stderr tuples
+        '''
+        results = list(self.completed())
+        if ordered:
+            results.sort()
+        return [result for _, result in results]
+
+
+def run_many(jobs, size=POOL_SIZE, ordered=True):
+    ''' Run a batch of commands concurrently, see :class:`Pool`::
+
+            results = sy.cmd.run_many([
+                ('uname -a',),
+                ('ls {}', ['/tmp']),
+                ('sleep {}', ['10'], {'timeout': 2}),
+            ], size=2)
+
+        :arg jobs: Iterable of ``(command, args, kwargs)`` tuples where 
+                   ``args`` and ``kwargs`` are optional and are passed to 
+                   :func:`run`
+        :arg size: Maximum number of commands running at the same time
+        :arg ordered: Return results in the order of ``jobs``, otherwise in
+                      the order they finished
+        :returns: list of exit status, stdout and stderr tuples
+    '''
+    pool = Pool(size=size)
+    for job in jobs:
+        if isinstance(job, basestring):
+            job = (job,)
+        command, args, kwargs = (tuple(job) + ((), {}))[:3]
+        pool.add(command, *args, **dict(kwargs))
+    return pool.run(ordered=ordered)
+
+
+class _pipeline(object):
+    ''' Processes connected with pipes, all in one process group. The
+    first process reads stdin of the parent. Stdout of the last process and 
+    stderr of every process are read from pipes like in 
+    :class:`_subprocess`.
+    '''
+
+    def __init__(self, argvs, bufsize=8192, stream=None, spawn=None):
+        self.BUFSIZE = bufsize
+        self.stream = stream
+        self.spawn = _spawn_method(spawn)
+        self.cleaned = False
+
+        self.outr, outw = os.pipe()
+        errpipes = [os.pipe() for argv in argvs]
+        links = [os.pipe() for argv in argvs[1:]]
+        self._childfds = [self.outr, outw]
+        for r, w in errpipes + links:
+            self._childfds.extend((r, w))
+
+        self.pids = []
+        self.pgid = 0
+        try:
+            for i, argv in enumerate(argvs):
+                stdin = None
+                if i > 0:
+                    stdin = links[i - 1][0]
+                if i < len(links):
+                    stdout = links[i][1]
+                else:
+                    stdout = outw
+                pid = self._start(argv, stdin, stdout, errpipes[i][1])
+                if not self.pgid:
+                    self.pgid = pid
+                self.pids.append(pid)
+        finally:
+            # parent only reads stdout of the last and stderr of all
+            self.errrs = [r for r, w in errpipes]
+            for fd in self._childfds:
+                if fd != self.outr and fd not in self.errrs:
+                    os.close(fd)
+
+        self._out = _buffer()
+        self._errs = dict((r, _buffer(STREAM_ERR_TAIL, 'tail')) 
+                          for r in self.errrs)
+        self._open = [self.outr] + self.errrs
+        self._sts = {}
+        self.outbytes = self.errbytes = 0
+        self.utime = self.stime = 0.0
+        self.maxrss = 0
+
+    def _start(self, argv, stdin, stdout, stderr):
+        if self.spawn == 'posix_spawn':
+            file_actions = []
+            if stdin is not None:
+                file_actions.append((_SPAWN_DUP2, stdin, 0))
+            file_actions += [
+                (_SPAWN_DUP2, stdout, 1),
+                (_SPAWN_DUP2, stderr, 2),
+            ] + [(_SPAWN_CLOSE, fd) for fd in self._childfds]
+            try:
+                return _posix_spawn(argv, file_actions, setpgroup=self.pgid)
+            except OSError, e:
+                log.debug('posix_spawn failed, using fork: {}', e)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.setpgid(0, self.pgid)
+                _child_signals()
+                if stdin is not None:
+                    os.dup2(stdin, 0)
+                os.dup2(stdout, 1)
+                os.dup2(stderr, 2)
+                map(os.close, self._childfds)
+                os.execv(argv[0], argv)
+            finally:
+                os._exit(1)
+        try:
+            # also set in the parent so the group exists before we go on
+            os.setpgid(pid, self.pgid or pid)
+        except OSError:
+            # the child has already exec'd
+            pass
+        return pid
+
+    def fds(self):
+        return self._open[:]
+
+    def read_fd(self, fd):
+        chunk = os.read(fd, self.BUFSIZE)
+        if fd == self.outr:
+            self.outbytes += len(chunk)
+        else:
+            self.errbytes += len(chunk)
+        if not chunk:
+            self._open.remove(fd)
+        elif fd != self.outr:
+            self._errs[fd].write(chunk)
+        elif self.stream:
+            self.stream(chunk)
+        else:
+            self._out.write(chunk)
+        return chunk
+
+    outdata = property(lambda self: self._out.getvalue())
+    errdata = property(lambda self: [self._errs[fd].getvalue() 
+                                     for fd in self.errrs])
+
+    def kill(self, sig=signal.SIGTERM):
+        _kill_group(self.pgid, sig) # kill whole pipeline
+
+    def _reap(self, options):
+        for pid in self.pids:
+            if pid not in self._sts:
+                reaped, sts, rusage = os.wait4(pid, options)
+                if reaped == pid:
+                    self._sts[pid] = sts
+                    _add_rusage(self, rusage)
+        if len(self._sts) == len(self.pids):
+            return [self._sts[pid] for pid in self.pids]
+        return None
+
+    def poll(self):
+        ''' Reap the stages that have exited. Returns their wait statuses 
+        when all have exited, otherwise None
+        '''
+        return self._reap(os.WNOHANG)
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            return self._reap(0)
+        return _wait(self.poll, timeout)
+
+    def cleanup(self, timeout=None):
+        self.cleaned = True
+        for fd in [self.outr] + self.errrs:
+            os.close(fd)
+        if self.wait(timeout) is None:
+            _abandoned.adopt([pid for pid in self.pids 
+                              if pid not in self._sts], group=self.pgid)
+        self.statuses = []
+        for pid in self.pids:
+            if pid in self._sts:
+                self.statuses.append(os.WEXITSTATUS(self._sts[pid]))
+            else:
+                self.statuses.append(None)
+        return self.statuses
+
+    def abort(self, ladder=None):
+        _terminate(self, ladder)
+        return self.cleanup(0)
+
+
+def pipeline(*stages, **kwargs):
+    ''' Run commands connected with pipes, like ``a | b | c`` in a 
+    shell, but without a shell::
+
+            statuses, out, errs = sy.cmd.pipeline(
+                                        ['bzcat', archive], 
+                                        ['tar', 'tf', '-'], timeout=600)
+
+    The timeout covers the whole pipeline and kills all of its processes
+    on timeout. The :exc:`CommandTimeoutError` gets the stdout of the last
+    stage and the stderr of all stages.
+
+    :arg stages: argv lists, programs are looked up with :func:`find`. A 
+                 stage can also be a shell command string which is run 
+                 with ``/bin/sh``
+    :arg timeout: Seconds until the pipeline times out
+    :arg stream: Callable that is called with stdout chunks of the last
+                 stage as they arrive instead of collecting them
+    :arg spawn: How to start the commands, see :func:`run`
+    :returns: list of exit statuses, stdout of the last stage and a list
+              with the last ``STREAM_ERR_TAIL`` bytes of stderr from every 
+              stage
+    '''
+    timeout = kwargs.pop('timeout', CMD_TIMEOUT)
+    bufsize = kwargs.pop('bufsize', 8192)
+    stream = kwargs.pop('stream', None)
+    spawn = kwargs.pop('spawn', None)
+    assert kwargs == {}, 'Unknown keyword arg passed to pipeline: ' + ','.join(kwargs.keys())
+    assert stages, 'Missing command'
+
+    argvs = []
+    escapedcmds = []
+    template = ' | '.join(map(_template, stages))
+    for stage in stages:
+        cmd, escapedcmd = _prepare(stage, ())
+        if not isinstance(cmd, list):
+            cmd = ['/bin/sh', '-c', cmd]
+        argvs.append(cmd)
+        escapedcmds.append(escapedcmd)
+    escapedcmd = ' | '.join(escapedcmds)
+    log.debug('Spawning: {}', escapedcmd)
+
+    start_time = time.time()
+    process = _pipeline(argvs, bufsize=bufsize, stream=stream, spawn=spawn)
+    deadline = None
+    if timeout is not None:
+        deadline = start_time + timeout
+    poller = _poller(process.fds())
+    try:
+        while process.fds():
+            ready = poller.poll(_remaining(deadline))
+            if not ready or _expired(deadline):
+                break
+            for fd in ready:
+                if not process.read_fd(fd):
+                    poller.unregister(fd)
+    finally:
+        poller.close()
+
+    if process.fds() or process.wait(_remaining(deadline)) is None:
+        process.abort()
+        _record(template, escapedcmd, process, start_time, None, 
+                timed_out=True)
+        raise _timeout_error(escapedcmd, timeout, process.outdata, 
+                             ''.join(process.errdata))
+
+    statuses = process.cleanup()
+    log.debug('Pipeline exit statuses: {}', statuses)
+    _record(template, escapedcmd, process, start_time, statuses)
+    return statuses, process.outdata, process.errdata
+
+
+class _session_usage(object):
+    ''' What :func:`_record` knows about a command run in a 
+    :class:`Session` '''
+    utime = stime = 0.0
+    maxrss = 0
+
+    def __init__(self, out, err):
+        self.outbytes = len(out)
+        self.errbytes = len(err)
+
+
+class Session(object):
+    ''' A long lived shell that runs commands one after the other::
+
+            session = sy.cmd.Session()
+            for pkg in packages:
+                status, out, err = session.run('pkginfo {}', pkg, timeout=5)
+            session.close()
+
+        Starting a new shell for every command is expensive compared to 
+        running tiny commands, a session only pays for it once. The 
+        commands run in the same shell so ``cd`` and variable assignments
+        persist between them. Stdin of the commands is ``/dev/null``.
+
+        The output of each command is followed by a line with a random 
+        marker and the exit status, which is how the session knows that 
+        the command is done. 
+
+        On timeout the shell and everything started from it is killed and 
+        a new shell is started for the next command. If a command exits 
+        the shell its exit status is returned and a new shell is started 
+        for the next command.
+
+        Sessions can be used with the ``with`` statement to close them.
+
+        :arg shell: Path to the shell, default ``/bin/sh``
+    '''
+
+    def __init__(self, shell='/bin/sh', bufsize=8192, spawn=None):
+        self.shell = shell
+        self.bufsize = bufsize
+        self.spawn = spawn
+        self.process = None
+        self._marker = '__SY_SESSION_%s__' % binascii.hexlify(os.urandom(8))
+        self._out_end = re.compile(r'\n%s (\d+)\n\Z' % self._marker)
+        self._err_end = '\n%s\n' % self._marker
+
+    def _start(self):
+        log.debug('Starting session shell: {}', self.shell)
+        self.process = _subprocess('exec ' + shell_escape(self.shell), 
+                                   bufsize=self.bufsize, spawn=self.spawn,
+                                   stdin=True)
+
+    def _stop(self, kill=False):
+        process, self.process = self.process, None
+        # the shell exits when stdin is closed
+        process.close_stdin()
+        if kill:
+            return process.abort()
+        return process.cleanup()
+
+    def _write(self, data):
+        while data:
+            written = os.write(self.process.inw, data)
+            data = data[written:]
+
+    def run(self, command, *args, **kwargs):
+        ''' Run a command in the session. Same arguments and return 
+        value as :func:`run`.
+        '''
+        timeout = kwargs.pop('timeout', CMD_TIMEOUT)
+        assert kwargs == {}, 'Unknown keyword arg passed to run: ' + ','.join(kwargs.keys())
+
+        escapedcmd = format_cmd(command, args)
+        log.debug('Session running: {}', escapedcmd)
+
+        if self.process is not None and self.process.poll() is not None:
+            self._stop()
+        if self.process is None:
+            self._start()
+        process = self.process
+
+        start_time = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = start_time + timeout
+        try:
+            self._write('{ %s\n} </dev/null\n'
+                        '__sy_status=$?\n'
+                        "printf '\\n%s %%d\\n' $__sy_status\n"
+                        "printf '\\n%s\\n' >&2\n" % (
+                            escapedcmd, self._marker, self._marker))
+        except OSError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            # the shell died, the read below sees end of file
+
+        waiting = [process.outr, process.errr]
+        poller = _poller(waiting)
+        try:
+            status, out, err = self._read(process, escapedcmd, timeout, 
+                                          deadline, poller, waiting)
+        except CommandTimeoutError, e:
+            _record(command, escapedcmd, _session_usage(e.out, e.err), 
+                    start_time, None, timed_out=True)
+            raise
+        finally:
+            poller.close()
+        _record(command, escapedcmd, _session_usage(out, err), start_time, 
+                status)
+        return status, out, err
+
+    def _read(self, process, escapedcmd, timeout, deadline, poller, waiting):
+        chunks = {process.outr: [], process.errr: []}
+        tails = {process.outr: '', process.errr: ''}
+        status = None
+        while waiting:
+            ready = poller.poll(_remaining(deadline))
+            if not ready or _expired(deadline):
+                self._stop(kill=True)
+                raise _timeout_error(escapedcmd, timeout, 
+                                     ''.join(chunks[process.outr]),
+                                     ''.join(chunks[process.errr]))
+            for fd in ready:
+                chunk = os.read(fd, self.bufsize)
+                if not chunk:
+                    # the command exited the shell
+                    status = os.WEXITSTATUS(self._stop())
+                    return (status, ''.join(chunks[process.outr]), 
+                            ''.join(chunks[process.errr]))
+                chunks[fd].append(chunk)
+                tail = tails[fd] = (tails[fd] + chunk)[-len(self._marker) - 16:]
+                if fd == process.outr:
+                    match = self._out_end.search(tail)
+                    if match:
+                        status = int(match.group(1))
+                        end = len(match.group(0))
+                        waiting.remove(fd)
+                        poller.unregister(fd)
+                elif tail.endswith(self._err_end):
+                    waiting.remove(fd)
+                    poller.unregister(fd)
+
+        out = ''.join(chunks[process.outr])[:-end]
+        err = ''.join(chunks[process.errr])[:-len(self._err_end)]
+        log.debug('Command result, stdout:{}, stderr:{}, exitstatus:{}', 
+                  out.strip(), err.strip(), status)
+        return status, out, err
+
+    def do(self, command, *args, **kwargs):
+        ''' Run a command in the session. Same arguments and return value
+        as :func:`do`.
+        '''
+        expect = kwargs.pop('expect', 0)
+        status, out, err = self.run(command, *args, **kwargs)
+        if status != expect:
+            raise _status_error(format_cmd(command, args), expect, status, 
+                                out, err)
+        return out, err
+
+    def close(self):
+        ''' Exit the shell '''
+        if self.process is not None:
+            self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,276 @@
+'''
+:synopsis: Running system commands from an asyncio event loop
+
+The functions in this module take the same arguments as their counterparts
+in :mod:`sy.cmd` but return a :class:`asyncio.Future` instead of blocking.
+With ``trollius`` a coroutine waits for it with ``yield From()``::
+
+    import trollius
+    from trollius import From, Return
+
+    @trollius.coroutine
+    def listing():
+        status, out, err = yield From(
+                sy.cmd.aio.run('ls -R {}', '/tmp', timeout=15))
+        raise Return(out)
+
+    loop = trollius.get_event_loop()
+    out = loop.run_until_complete(listing())
+
+Or without a coroutine, with a callback that the running loop calls::
+
+    future = sy.cmd.aio.run('ls -R {}', '/tmp', timeout=15)
+    future.add_done_callback(lambda future: log.info(future.result()[1]))
+
+Output is read by reader callbacks on the event loop and children are reaped
+by the child watcher of the event loop policy, so thousands of commands can be
+in flight on one thread. Like for asyncio subprocesses the watcher must be 
+attached to the loop, which the default loop of the main thread is. Other 
+loops need ``asyncio.get_child_watcher().attach_loop(loop)``. The watcher
+reaps the commands, so the CPU time and max RSS passed to the hooks of 
+:func:`sy.cmd.add_hook` are 0.
+
+Cancelling a future kills the command, with the signals in 
+``sy.cmd.KILL_LADDER``.
+
+Requires :mod:`asyncio` or its Python 2 backport ``trollius``.
+
+.. moduleauthor: Paul Diaconescu <p@afajl.com>
+'''
+import os
+import time
+import errno
+import fcntl
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import sy.log
+import sy.cmd
+from sy.cmd import _prepare, _display_cmd, _subprocess, _OutputOverflow, \
+                   _status_error, _timeout_error, _output_error, _record
+
+log = sy.log._new('sy.cmd.aio')
+
+
+def _future(loop):
+    create_future = getattr(loop, 'create_future', None)
+    if create_future:
+        return create_future()
+    return asyncio.Future(loop=loop)
+
+
+def _then(future, loop, func):
+    ''' Return a new future with the result of ``func`` applied to the
+    result of ``future``. Errors are passed through and cancelling the new
+    future cancels ``future``.
+    '''
+    result = _future(loop)
+
+    def done(future):
+        if result.done():
+            return
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            try:
+                result.set_result(func(future.result()))
+            except Exception, e:
+                result.set_exception(e)
+
+    def cancelled(result):
+        if result.cancelled():
+            future.cancel()
+
+    future.add_done_callback(done)
+    result.add_done_callback(cancelled)
+    return result
+
+
+class _command(object):
+    ''' A running command driven by callbacks from the event loop.
+    Sets the result or exception of ``future`` when the output is read and
+    the child watcher has reaped the child.
+    '''
+
+    def __init__(self, loop, future, command, cmd, escapedcmd, timeout, 
+                 bufsize, stream, max_output, truncate, spawn, input):
+        self.loop = loop
+        self.future = future
+        self.command = command
+        self.escapedcmd = escapedcmd
+        self.timeout = timeout
+        self.max_output = max_output
+        self.error = None
+        self.timer = None
+        self.aborted = False
+        self.timed_out = False
+        self.start_time = time.time()
+
+        self.process = _subprocess(cmd, bufsize=bufsize, stream=stream,
+                                   max_output=max_output, truncate=truncate,
+                                   spawn=spawn, input=input)
+        for fd in self.process.fds():
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            loop.add_reader(fd, self._read, fd)
+        if self.process.inw is not None:
+            loop.add_writer(self.process.inw, self._write)
+        if timeout is not None:
+            self.timer = loop.call_later(timeout, self._timed_out)
+        future.add_done_callback(self._future_done)
+        # last, it calls _exited right away if the child is already gone
+        asyncio.get_child_watcher().add_child_handler(self.process.pid, 
+                                                      self._exited)
+
+    def _read(self, fd):
+        try:
+            chunk = self.process.read_fd(fd)
+        except _OutputOverflow:
+            self._abort(_output_error(self.escapedcmd, self.process,
+                                      self.max_output))
+            return
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._abort(e)
+            return
+        if not chunk:
+            self.loop.remove_reader(fd)
+            self._finish()
+
+    def _write(self):
+        if not self.process.write_fd():
+            self._close_stdin()
+
+    def _close_stdin(self):
+        if self.process.inw is not None:
+            self.loop.remove_writer(self.process.inw)
+            self.process.close_stdin()
+
+    def _exited(self, pid, returncode):
+        # the watcher has reaped the child, make a wait status of what it 
+        # got so the process is never waited for again
+        if returncode < 0:
+            self.process.sts = -returncode
+        else:
+            self.process.sts = returncode << 8
+        self._finish()
+
+    def _timed_out(self):
+        self.timer = None
+        self.timed_out = True
+        self._abort(_timeout_error(self.escapedcmd, self.timeout,
+                                   self.process.outdata,
+                                   self.process.errdata))
+
+    def _future_done(self, future):
+        if future.cancelled() and not self.process.cleaned:
+            log.debug('Command "{}" cancelled', self.escapedcmd)
+            self._abort(None)
+
+    def _abort(self, error):
+        if self.error is None:
+            self.error = error
+        self.aborted = True
+        for fd in self.process.fds():
+            self.loop.remove_reader(fd)
+        self._close_stdin()
+        self._escalate(0)
+        self._finish()
+
+    def _escalate(self, step):
+        ''' Send the signal of ``step`` in the kill ladder and schedule 
+        the next one if the command has not exited after the grace time
+        '''
+        if self.process.sts is not None:
+            return
+        ladder = sy.cmd.KILL_LADDER
+        sig, grace = ladder[step]
+        self.process.kill(sig)
+        if step + 1 < len(ladder):
+            self.loop.call_later(grace, self._escalate, step + 1)
+
+    def _finish(self):
+        ''' Set the result once the child is reaped and its output read '''
+        if self.process.cleaned or self.process.sts is None or \
+                (self.process.fds() and not self.aborted):
+            return
+        if self.timer:
+            self.timer.cancel()
+        self._close_stdin()
+        self.process.cleanup()
+        status = None
+        if self.error is None and not self.future.done():
+            status = os.WEXITSTATUS(self.process.sts)
+        _record(self.command, self.escapedcmd, self.process, self.start_time,
+                status, self.timed_out)
+        if self.future.done():
+            return
+        if self.error is not None:
+            self.future.set_exception(self.error)
+        else:
+            out = self.process.outdata
+            err = self.process.errdata
+            log.debug('Command result, stdout:{}, stderr:{}, exitstatus:{}',
+                      out.strip(), err.strip(), status)
+            self.future.set_result((status, out, err))
+
+
+def run(command, *args, **kwargs):
+    ''' Start a command and return a future for the exit status, stdout and
+    stderr. Same arguments as :func:`sy.cmd.run`.
+
+    :arg loop: Event loop to run the command on, default is the current loop
+    :returns: future with the exit status from the command, stdout and
+              stderr. On timeout the future gets a
+              :exc:`sy.cmd.CommandTimeoutError`
+    '''
+    loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+    timeout = kwargs.pop('timeout', sy.cmd.CMD_TIMEOUT)
+    bufsize = kwargs.pop('bufsize', 8192)
+    stream = kwargs.pop('stream', None)
+    max_output = kwargs.pop('max_output', None)
+    truncate = kwargs.pop('truncate', 'head')
+    spawn = kwargs.pop('spawn', None)
+    input = kwargs.pop('input', None)
+    assert kwargs == {}, 'Unknown keyword arg passed to run: ' + ','.join(kwargs.keys())
+
+    cmd, escapedcmd = _prepare(command, args)
+    log.debug('Spawning: {}', escapedcmd)
+
+    future = _future(loop)
+    _command(loop, future, command, cmd, escapedcmd, timeout, bufsize,
+             stream, max_output, truncate, spawn, input)
+    return future
+
+
+def do(command, *args, **kwargs):
+    ''' Start a command and return a future for stdout and stderr. If the
+    command does not exit with the ``expect`` status (default 0) the future
+    gets a :exc:`sy.cmd.CommandError`. Same arguments as :func:`sy.cmd.do`.
+    '''
+    expect = kwargs.pop('expect', 0)
+    loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+
+    def check(result):
+        status, out, err = result
+        if status != expect:
+            raise _status_error(_display_cmd(command, args), expect, status,
+                                out, err)
+        return out, err
+
+    return _then(run(command, loop=loop, *args, **kwargs), loop, check)
+
+
+def outlines(command, *args, **kwargs):
+    ''' Start a command and return a future for the stdout lines.
+    Same arguments as :func:`do` expects.
+    '''
+    loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+    return _then(do(command, loop=loop, *args, **kwargs), loop,
+                 lambda result: result[0].splitlines())
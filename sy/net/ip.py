@@ -47,7 +47,7 @@ def port_is_open(ipaddress, port, timeout=1):
 
 def _hostfile_dict():
     hosts = {}
-    for line in sy.path.lines('/etc/hosts'):
+    for line in sy.path.iterlines('/etc/hosts'):
         if line.startswith('#'):
             continue
         hostentry = line.split()
@@ -90,7 +90,7 @@ def add_hostentry(ipaddress, hostname, append_hostname=False):
 
 def _netmask_dict():
     netmasks = {}
-    for line in sy.path.lines('/etc/inet/netmasks'):
+    for line in sy.path.iterlines('/etc/inet/netmasks'):
         if line.startswith('#'):
             continue
         netmask = line.split()
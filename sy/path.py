@@ -1,469 +1,2388 @@
-"""
-
-:synopsis: Simplify operations on files and directories
-
-.. moduleauthor: Paul Diaconescu <p@afajl.com>
-"""
-
-
-import os
-import re
-import grp, pwd
-import codecs
-import fcntl
-import tempfile
-import os.path
-import stat
-import sys
-import shutil
-import tarfile
-import zipfile
-
-import sy.log
-import sy.cmd
-
-log = sy.log._new('sy.path')
- 
-
-try:
-    from hashlib import md5
-except ImportError:
-    import md5
-    md5 = md5.new
-
-import sy
-
-from sy._internal import _missing
-
-# _______________________________
-# write files
-
-def dump(path, content, append=False, binary=False, encoding=None, 
-         newline=os.linesep):
-    ''' Dump content to a file.
-
-    Writes content to file, overwriting if the file exists. 
-    Use :func:`append` to add to the of the file.
-
-    :arg binary: Write binary data to the file
-    :arg encoding: If content is unicode, specifies how it should be encoded 
-                     in the file. Raises an assertion error if specified for
-                     non-unicode content
-    :arg newline: Convert all newlines types (Windows or Mac) to this. Default ``\\n`` on Unix.
-                  If set to None, the content is written without changing any newlines. 
-
-    '''
-
-    if not binary:
-        if isinstance(content, unicode):
-            if newline is not None:
-                # Convert all standard end-of-line sequences to
-                # ordinary newline characters.
-                content = (content.replace(u'\r\n', u'\n')
-                                .replace(u'\r\x85', u'\n')
-                                .replace(u'\r', u'\n')
-                                .replace(u'\x85', u'\n')
-                                .replace(u'\u2028', u'\n'))
-                content = content.replace(u'\n', newline)       
-            if encoding is None:
-                encoding = sys.getdefaultencoding()
-            bytes = content.encode(encoding, 'strict')
-        else:
-            assert encoding is None
-            if newline is not None:
-                content = (content.replace('\r\n', '\n')
-                            .replace('\r', '\n'))
-                bytes = content.replace('\n', newline)  
-            else:
-                bytes = content
-    if hasattr(path, 'write'):
-        # got an open filehandle
-        fh = path
-    else:
-        if append:
-            openmode = 'ab'
-        else: 
-            openmode = 'wb'
-        fh = open(path, openmode)
- 
-    try:
-        fh.write(bytes)
-    finally:
-        fh.close()
-
-def append(*args, **kwargs):
-    ''' Append content to file. Same arguments as to :func:`dump` ''' 
-    kwargs['append'] = True
-    dump(*args, **kwargs)
-
-        
-def extract(archive, dir):
-    ''' Unpack a tar or zip file to the specified directory.
-
-    Tarfiles compressed with gzip, bzip2 or compress are uncompressed.
-
-    :arg archive: Path to the archive
-    :arg dir: Directory where the archive will be uncompressed
-    '''
-    if not os.path.exists(archive):
-        raise RuntimeError('Archive cannot be found at %s' % archive)
-
-    # we can not use the extract functions from the tarfile and zipfile
-    # modules since it is not supported on python 2.4
-    if tarfile.is_tarfile(archive):
-        archive_file = os.path.basename(archive)
-        decompressor_table = {
-            'gzcat': ('gz', 'tgz'),
-            'bzcat': ('bz', 'bz2', 'tbz', 'tbz2'),
-            'zcat' : ('tar.z', 'tz', 'tar.Z'),
-        }
-
-        streamer = 'cat'
-        for cmd, file_endings in decompressor_table.items():
-            for file_ending in file_endings:
-                if archive_file.endswith(file_ending):
-                    streamer = cmd
-        sy.cmd.do('{} {} | (cd {}; tar xf -)', streamer, archive, dir)
-    elif zipfile.is_zipfile(archive):
-        sy.cmd.do('unzip {} -d {}', archive, dir)
-
- 
-# _______________________________
-# read files
-
-def _open_read(path, encoding=None, binary=False):
-    if binary or encoding is None:
-        if binary:
-            mode = 'rb'
-        else:
-            mode = 'rU' # convert '\r\n' and '\r' to \n
-        return open(path, mode)
-    else:
-        # Encoded
-        return codecs.open(path, 'r', encoding, 'strict')
-
-
-def slurp(path, encoding=None, binary=False):
-    ''' Return a file as a string 
-    
-    :arg path: Path to file
-    :arg encoding: The encoding of the file. 
-                   Default is None which returns the file as a 8-bit string
-                   which works well for latin1 and asci. 
-    :arg binary: Treat the file as a binary, no conversions will be made
-    '''
-    f = _open_read(path, encoding=encoding, binary=binary)
-    try:
-        c = f.read()
-    finally:
-        f.close()
-    if encoding:
-        # unicode
-        return (c.replace(u'\r\n', u'\n')
-                 .replace(u'\r\x85', u'\n')
-                 .replace(u'\r', u'\n')
-                 .replace(u'\x85', u'\n')
-                 .replace(u'\u2028', u'\n'))
-    else:
-        # binary or 8-bit text (opened with 'U' which converts newlines)
-        return c
-
-
-def lines(path, encoding=None, newline=True):
-    ''' Return list of lines from file. 
-    
-    :arg newline: If true, keep newline characters for every line. 
-                 Default is True.  All newline characters (``\\r``, ``\\r\\n``) 
-                 are replaced by ``\\n``. 
-    Same arguments as to :func:`slurp` 
-    '''
-
-    return slurp(path, encoding=encoding).splitlines(newline) 
-
-
-def contains(path, pattern, encoding=None):
-    ''' Returns True if the file contains a line that matches the string or 
-        compiled pattern.
-
-        :arg path: Path to the file
-        :arg pattern: String or compiled pattern 
-    '''
-    if not hasattr(pattern, 'search'):
-        pattern = re.compile(pattern)
-    f = _open_read(path, encoding=encoding)
-    try:
-        for line in f:
-            if pattern.search(line):
-                return True
-    finally:
-        f.close()
-    return False
-
-
-
-def md5sum(path, hex=True):
-    ''' Calculate md5 sum for a file.
-
-    :arg hex: Return the digest in hexadecimal suitable for writing to 
-                text files. Default True.
-    '''
-    f = open(path, 'rb')
-    try:
-        m = md5()
-        while True:
-            d = f.read(8192)
-            if not d:
-                break
-            m.update(d)
-    finally:
-        f.close()
-    if hex:
-        return m.hexdigest()
-    else:
-        return m.digest()
-
-
-
-
-
-# _______________________________
-# replace content in file
-
-def remove_lines(path, matching, encoding=None):
-    ''' Remove lines from the ``path`` that matches ``matching``
-
-        .. note:: 
-            The line will match if the pattern is anywhere on the line. 
-            See :func:`re.search` in the standard library.
- 
-        :arg path: Path to the file
-        :arg matching: String to search for (or compiled regular expression)
-        :returns: Number of lines removed
-    '''
-    if not hasattr(matching, 'search'):
-        matching = re.compile(matching)
-
-    def filter(original_f, new_f):
-        nr_removed = 0
-        for line in original_f:
-            if matching.search(line):
-                nr_removed += 1
-                continue
-            new_f.write(line)
-        return nr_removed
-
-    return _replace_file(path, filter, encoding=encoding)
-
-def replace_lines(path, matching, replacement, encoding=None):
-    ''' Replace lines that contain the string ``matching`` with ``replacement``
-
-        .. note:: 
-            The line will match if the pattern is anywhere on the line. 
-            See :func:`re.search` in the standard library.
-
-        :arg path: Path to the file
-        :arg matching: String or compiled regular expression.
-        :arg replacement: Line to replace with, newline character will 
-            automatically be added if missing.
-        :returns: Number of lines replaced
-    '''
-    if not hasattr(matching, 'search'):
-        matching = re.compile(matching)
-
-    if not replacement.endswith('\n'):
-        replacement += '\n'
-
-    def filter(original_f, new_f):
-        nr_replaced = 0
-        for line in original_f:
-            if matching.search(line):
-                new_f.write(replacement)
-                nr_replaced += 1
-            else:
-                new_f.write(line)
-        return nr_replaced
-
-    return _replace_file(path, filter, encoding=encoding)
-
-
-def replace(path, match, replacement, encoding=None):
-    ''' Replace all occurances of ``match`` with ``replacement``. 
-    Using :func:`re.sub`, backreferences in the replacement will work as
-    normal::
-
-        # change login of all users to 'leif'
-        rx = re.compile(r'^\w+:(.*)', re.MULTILINE)
-        replace('/etc/passwd', rx, r'leif:\\1') 
-
-    .. note:: 
-        Make sure your replacement uses a raw string (``r''``) if it contains 
-        backreferences.
-
-
-    :arg path: Path to the file
-    :arg match: String to match
-    :arg replacement: String to replace match with
-    :returns: Number of replacements made
-    '''
-    if not hasattr(match, 'sub'):
-        match = re.compile(match, re.MULTILINE)
-
-    def filter(original_f, new_f):
-        sub, nr_subs = match.subn(replacement, original_f.read())
-        new_f.write(sub)
-        return nr_subs
-    return _replace_file(path, filter, encoding=encoding)
- 
-
-
-def _replace_file(path, filter_func, encoding=None):
-    ''' This builder function replaces the content of the path
-    with the output of the filter. The filter is passed the original file as 
-    file object. Example usage::
-
-        def filter(original_file, new_file):
-            # replace all lines starting with XXX with YYY
-            nr_replacements = 0
-            for line in original_file: 
-                if line.startswith('XXX'):
-                    new_file.write.write('YYY\n')
-                    nr_replacements += 1
-                else:
-                    new_file.write.write(line)
-            return nr_replacements
-
-        _replace_file(/etc/hosts', filter)
-
-    Anything returned from the `filter_func` will be returned by this function
-
-    See :func:`replace_lines` for an example
-    '''
-
-    # expand path and get target of eventual symlink
-    path = os.path.realpath( expandpath(path) )
-
-    # open and lock original file
-    if encoding:
-        original_file = codes.open(path, 'r+', encoding, 'strict')
-    else:
-        original_file = open(path, 'r+')
-    fcntl.lockf(original_file.fileno(), fcntl.LOCK_EX)
-
-    # get a temp file in the same directory as original file
-    _, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), 
-                                      prefix=os.path.basename(path),
-                                      suffix='.replacement')
-    try:
-        tmp_file = open(tmppath, 'wb')
-        filter_ret = filter_func(original_file, tmp_file)
-        tmp_file.close()
-    finally:
-        if not tmp_file.closed:
-            tmp_file.close()
-        original_file.close()
-
-    try:
-        # stat the original file so we can copy permissions
-        pathst = os.stat(path)
-        os.chmod(tmppath, pathst.st_mode)
-        chown(tmppath, owner=pathst.st_uid, group=pathst.st_gid)
-     
-        # this should be an atomic operation on sane filesystems
-        os.rename(tmppath, path)
-    finally:
-        if os.path.exists(tmppath):
-            os.remove(tmppath)
-    return filter_ret
-  
-
-
- 
-# _______________________________
-# path operations
-
-def expandpath(path):
-    ''' Clean up path.
-    Expands environment vars like $JAVA_HOME, does tilde expansion for paths 
-    like "~/.bashrc" and normalizes the path
-    '''
-    return os.path.normpath(os.path.expanduser(os.path.expandvars(path)))
-
-    
-
-def chown(path, owner, group):
-    ''' Change owner and group of a file or directory.
-
-    If owner or group is None it is left unchanged. If both are set to None
-    this function does nothing.
-
-    If you use username or groupname that user or group must exist on the
-    current system.
-
-    :arg owner: Uid or username of the new owner. 
-    :arg group: Gid or groupname of the new owner. 
-    '''
-    
-
-    if owner is None:
-        uid = -1    # dont modify
-    elif isinstance(owner, int):
-        uid = owner
-    else: 
-        # convert username to uid
-        uid = pwd.getpwnam(owner).pw_uid
-
-    if group is None:
-        gid = -1    # dont modify
-    if isinstance(group, int):
-        gid = group
-    else: 
-        # convert group name to gid
-        gid = grp.getgrnam(group).gr_gid
-
-    log.debug('Chowning "{}" to uid={} and gid={}', path, uid, gid)
-    os.chown(path, uid, gid)
-
-def owner(path, uid=False):
-    ''' Return username that owns the file or directory.
-
-    :arg uid: If True return the uid as an integer
-    '''
-    st = os.lstat(path)
-    uid = st.st_uid
-    if uid:
-        return uid
-    return pwd.getpwuid(uid).pw_name
-
-def group(path, gid=False):
-    ''' Return the name of the group that owns the file or directory.
-
-    :arg gid: If True return the gid as an integer
-    '''
-    st = os.lstat(path)
-    gid = st.st_gid
-    if gid:
-        return gid
-    return grp.getgrgid(gid).gr_name
-    
-def mode(path):
-    ''' Permission mode of the file or directory.
-
-    :returns: octal representation of the mode, ie 0644
-    '''
-    st = os.lstat(path)
-    return oct(stat.S_IMODE(st.st_mode))
-    
-
-def rmtree(path, force=False):
-    ''' Removes a directory and everything below it.
-
-    :arg force: Ignores all errors, like rm -rf
-    '''
-    try:
-        shutil.rmtree(path)
-    except:
-        if not force:
-            raise
-
-#def directory_tail(path, files='*', dirs='', method='timestamp'):
-    #pass
+"""
+
+:synopsis: Simplify operations on files and directories
+
+.. moduleauthor: Paul Diaconescu <p@afajl.com>
+"""
+
+
+import os
+import re
+import errno
+import sre_parse
+import grp, pwd
+import codecs
+import fcntl
+import mmap
+import tempfile
+import io
+import binascii
+import threading
+import Queue
+import os.path
+import stat
+import sys
+import shutil
+import itertools
+import fnmatch
+import time
+import collections
+import json
+import tarfile
+import zipfile
+
+import sy.log
+import sy.cmd
+import sy.exception
+
+log = sy.log._new('sy.path')
+
+# Bytes read at a time when comparing file content
+_COMPARE_SIZE = 1024 * 1024
+# Bytes read at a time from the end of the file by tail
+_TAIL_BLOCK = 64 * 1024
+# Encodings where a newline byte is always a newline
+_ASCII_NEWLINES = ('utf-8', 'ascii', 'iso8859-1', 'cp1252')
+
+# Bytes read at a time when calculating checksums
+_HASH_BLOCK = 1024 * 1024
+
+# Bytes copied at a time when extracting archives
+_EXTRACT_BLOCK = 1024 * 1024
+
+# Files up to this size are read once to both hash and zip them by pack
+_ZIP_READ_ONCE = 8 * 1024 * 1024
+
+# Bytes copied at a time by copy when the kernel can not copy the file
+_COPY_BLOCK = 1024 * 1024
+
+# Default number of threads used by checksums
+HASH_WORKERS = 4
+
+# Default number of threads used by sync_tree
+COPY_WORKERS = 4
+ 
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+    import md5
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    # Python 3.5 and later
+    _scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+_sendfile = getattr(os, 'sendfile', None)
+if _sendfile is None:
+    try:
+        # the pysendfile backport
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        pass
+
+import sy
+
+from sy._internal import _missing
+
+
+def _in_threads(func, items, workers, name):
+    ''' Call ``func`` for each item using up to ``workers`` threads, 
+    the calling thread being one of them. No new items are started after
+    an error and the first error is raised when all threads are done.
+    '''
+    items = list(items)
+    errors = []
+    pending = iter(items)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            lock.acquire()
+            try:
+                if errors:
+                    return
+                try:
+                    item = pending.next()
+                except StopIteration:
+                    return
+            finally:
+                lock.release()
+            try:
+                func(item)
+            except Exception:
+                lock.acquire()
+                errors.append(sys.exc_info())
+                lock.release()
+                return
+
+    threads = []
+    for i in range(min(workers, len(items)) - 1):
+        thread = threading.Thread(target=work, name='sy.path ' + name)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    work()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+# _______________________________
+# write files
+
+def dump(path, content, append=False, binary=False, encoding=None, 
+         newline=os.linesep):
+    ''' Dump content to a file.
+
+    Writes content to file, overwriting if the file exists. 
+    Use :func:`append` to add to the of the file.
+
+    If the file already has the content it is not written, so the 
+    modification time is kept and nothing watching the file wakes up.
+
+    :arg binary: Write binary data to the file
+    :arg encoding: If content is unicode, specifies how it should be encoded 
+                     in the file. Raises an assertion error if specified for
+                     non-unicode content
+    :arg newline: Convert all newlines types (Windows or Mac) to this. Default ``\\n`` on Unix.
+                  If set to None, the content is written without changing any newlines. 
+    :returns: True if the file was changed
+
+    '''
+
+    if not binary:
+        if isinstance(content, unicode):
+            if newline is not None:
+                # Convert all standard end-of-line sequences to
+                # ordinary newline characters.
+                content = (content.replace(u'\r\n', u'\n')
+                                .replace(u'\r\x85', u'\n')
+                                .replace(u'\r', u'\n')
+                                .replace(u'\x85', u'\n')
+                                .replace(u'\u2028', u'\n'))
+                content = content.replace(u'\n', newline)       
+            if encoding is None:
+                encoding = sys.getdefaultencoding()
+            bytes = content.encode(encoding, 'strict')
+        else:
+            assert encoding is None
+            if newline is not None:
+                content = (content.replace('\r\n', '\n')
+                            .replace('\r', '\n'))
+                bytes = content.replace('\n', newline)  
+            else:
+                bytes = content
+    if hasattr(path, 'write'):
+        # got an open filehandle
+        fh = path
+    else:
+        if append:
+            if not bytes:
+                return False
+            openmode = 'ab'
+        else: 
+            if _file_equals(path, bytes):
+                log.debug('"{}" is unchanged', path)
+                return False
+            openmode = 'wb'
+        fh = open(path, openmode)
+ 
+    try:
+        fh.write(bytes)
+    finally:
+        fh.close()
+    return True
+
+def append(*args, **kwargs):
+    ''' Append content to file. Same arguments as to :func:`dump` ''' 
+    kwargs['append'] = True
+    return dump(*args, **kwargs)
+
+
+def _file_equals(path, data):
+    ''' True if the file has exactly the bytes in ``data`` '''
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+        f = open(path, 'rb')
+    except (OSError, IOError):
+        return False
+    try:
+        pos = 0
+        while pos < len(data):
+            chunk = f.read(_COMPARE_SIZE)
+            if not chunk or chunk != data[pos:pos + len(chunk)]:
+                return False
+            pos += len(chunk)
+        return not f.read(1)
+    finally:
+        f.close()
+
+
+def _files_equal(path1, path2):
+    ''' True if the two files have the same content '''
+    if os.stat(path1).st_size != os.stat(path2).st_size:
+        return False
+    f1 = open(path1, 'rb')
+    try:
+        f2 = open(path2, 'rb')
+        try:
+            while True:
+                chunk = f1.read(_COMPARE_SIZE)
+                if chunk != f2.read(_COMPARE_SIZE):
+                    return False
+                if not chunk:
+                    return True
+        finally:
+            f2.close()
+    finally:
+        f1.close()
+
+        
+def extract(archive, dir, members=None, workers=1):
+    ''' Unpack a tar or zip file to the specified directory.
+
+    Archives are read with :mod:`tarfile` and :mod:`zipfile` and the 
+    members are streamed to disk. Tarfiles compressed with gzip, bzip2, xz
+    (if the Python :mod:`tarfile` supports it) and zstd (if the 
+    ``zstandard`` module is installed) are uncompressed on the fly. 
+    Tarfiles compressed with compress, or xz and zstd when not supported 
+    in Python, are uncompressed by ``zcat``, ``xzcat`` or ``zstdcat`` and
+    read from a pipe.
+
+    Members with absolute names, ``..`` in the name, links pointing outside
+    of ``dir`` or that would be written through such a link raise a 
+    :exc:`RuntimeError`. Members before it in the archive are already
+    extracted.
+
+    :arg archive: Path to the archive
+    :arg dir: Directory where the archive will be uncompressed, it is 
+              created if missing
+    :arg members: Only extract members with names matching one of these 
+                  shell patterns, or a function called with the name of 
+                  each member returning True for members to extract. 
+                  Names are without leading ``./``. 
+    :arg workers: Number of threads uncompressing the members of a zip 
+                  file, tarfiles are always read by one thread
+    :returns: List with the names of the extracted members
+    '''
+    if not os.path.exists(archive):
+        raise RuntimeError('Archive cannot be found at %s' % archive)
+
+    wanted = members
+    if members is not None and not callable(members):
+        patterns = list(members)
+        wanted = lambda name: [p for p in patterns 
+                               if fnmatch.fnmatchcase(name, p)]
+
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    root = os.path.realpath(dir)
+
+    f = open(archive, 'rb')
+    try:
+        tar = _open_tar(archive, f)
+        if tar is not None:
+            try:
+                return _extract_tar(tar, root, wanted)
+            finally:
+                tar.close()
+    finally:
+        f.close()
+
+    if zipfile.is_zipfile(archive):
+        return _extract_zip(archive, root, wanted, workers)
+
+    decompressor_table = {
+        'zcat'   : ('.Z', '.z', '.tz', '.taz'),
+        'xzcat'  : ('.xz', '.txz'),
+        'zstdcat': ('.zst', '.tzst'),
+    }
+    for cmd, file_endings in decompressor_table.items():
+        if archive.endswith(file_endings):
+            return _extract_piped(cmd, archive, root, wanted)
+    raise RuntimeError('Unknown archive format of %s' % archive)
+
+
+def _extract_piped(cmd, archive, root, wanted):
+    ''' Extract a tarfile that ``cmd`` uncompresses to a pipe '''
+    log.debug('Uncompressing "{}" with {}', archive, cmd)
+    stream = _command_output([cmd, archive])
+    try:
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        try:
+            extracted = _extract_tar(tar, root, wanted)
+        finally:
+            tar.close()
+        status = stream.close()
+    finally:
+        stream.abort()
+    if status != 0:
+        raise sy.cmd._status_error(' '.join([cmd, archive]), 0, status, 
+                                   '', stream.process.errdata)
+    return extracted
+
+
+class _command_output(object):
+    ''' Read only file with the stdout of the command ``argv``. Stderr is
+    read at the same time so the command never blocks on a full pipe, the
+    last of it is kept in ``process.errdata``.
+    '''
+
+    def __init__(self, argv):
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self.process = sy.cmd._subprocess(argv, stream=self._chunks.append)
+        self._poller = sy.cmd._poller(self.process.fds())
+
+    def _fill(self, size):
+        while self.process.fds() and (size < 0 or self._buffered < size):
+            for fd in self._poller.poll():
+                chunk = self.process.read_fd(fd)
+                if not chunk:
+                    self._poller.unregister(fd)
+                elif fd == self.process.outr:
+                    self._buffered += len(chunk)
+
+    def read(self, size=-1):
+        self._fill(size)
+        data = ''.join(self._chunks)
+        self._chunks.clear()
+        if 0 <= size < len(data):
+            self._chunks.append(data[size:])
+            data = data[:size]
+        self._buffered -= len(data)
+        return data
+
+    def close(self):
+        ''' Read what is left of the output and reap the command, returns
+        its exit status '''
+        while self.process.fds():
+            self.read(_EXTRACT_BLOCK)
+        self._poller.close()
+        return os.WEXITSTATUS(self.process.cleanup())
+
+    def abort(self):
+        ''' Kill the command if it was not closed '''
+        if not self.process.cleaned:
+            self._poller.close()
+            self.process.abort()
+
+
+def _open_tar(archive, f):
+    ''' Return a :class:`tarfile.TarFile` reading from ``f`` or None if 
+    it is not a tarfile that Python can uncompress '''
+    if archive.endswith(('.zst', '.tzst')):
+        if zstandard is None:
+            return None
+        stream = zstandard.ZstdDecompressor().stream_reader(f)
+        return tarfile.open(fileobj=stream, mode='r|')
+    try:
+        return tarfile.open(fileobj=f, mode='r:*')
+    except (tarfile.ReadError, tarfile.CompressionError):
+        return None
+
+
+def _member_name(name):
+    ''' Normalize the name of an archive member, refuse names that would
+    end up outside of the target directory '''
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if name.startswith('/') or '..' in parts:
+        raise RuntimeError('Refusing to extract "%s", the path is not '
+                           'relative to the target directory' % name)
+    return '/'.join(parts)
+
+
+def _inside(root, path):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def _member_target(root, name, checked):
+    ''' Return the path where the member ``name`` is written. Refuses
+    members in directories that are links to outside of ``root``, 
+    directories already checked are kept in the set ``checked``.
+    '''
+    target = os.path.join(root, name)
+    parent = os.path.dirname(target)
+    if parent not in checked:
+        if not _inside(root, os.path.realpath(parent)):
+            raise RuntimeError('Refusing to extract "%s" through a link to '
+                               'outside of %s' % (name, root))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        checked.add(parent)
+    return target
+
+
+def _check_link(root, name, target, linkname):
+    if not _inside(root, os.path.realpath(
+                    os.path.join(os.path.dirname(target), linkname))):
+        raise RuntimeError('Refusing to extract "%s", it links to "%s" '
+                           'outside of %s' % (name, linkname, root))
+
+
+def _unlink_existing(target):
+    if os.path.islink(target) or (os.path.lexists(target) and 
+                                  not os.path.isdir(target)):
+        os.unlink(target)
+
+
+def _write_member(src, target):
+    _unlink_existing(target)
+    dst = open(target, 'wb')
+    try:
+        shutil.copyfileobj(src, dst, _EXTRACT_BLOCK)
+    finally:
+        dst.close()
+
+
+def _extract_tar(tar, root, wanted):
+    extracted = []
+    directories = []
+    checked = set()
+    is_root = os.geteuid() == 0
+
+    for member in tar:
+        name = _member_name(member.name)
+        if not name or (wanted is not None and not wanted(name)):
+            continue
+        target = _member_target(root, name, checked)
+
+        if member.isdir():
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            # set the mode last, the directory might not be writable
+            directories.append((target, member))
+        elif member.isfile():
+            src = tar.extractfile(member)
+            try:
+                _write_member(src, target)
+            finally:
+                src.close()
+        elif member.issym():
+            _check_link(root, name, target, member.linkname)
+            _unlink_existing(target)
+            os.symlink(member.linkname, target)
+            checked.clear()
+        elif member.islnk():
+            source = os.path.join(root, _member_name(member.linkname))
+            if not _inside(root, os.path.realpath(source)):
+                raise RuntimeError('Refusing to extract "%s", it links to '
+                                   '"%s" outside of %s' % 
+                                   (name, member.linkname, root))
+            _unlink_existing(target)
+            os.link(source, target)
+        elif member.isfifo():
+            _unlink_existing(target)
+            os.mkfifo(target)
+        elif member.ischr() or member.isblk():
+            _unlink_existing(target)
+            kind = member.ischr() and stat.S_IFCHR or stat.S_IFBLK
+            os.mknod(target, member.mode | kind, 
+                     os.makedev(member.devmajor, member.devminor))
+        else:
+            log.debug('Skipping "{}" of unknown type', name)
+            continue
+
+        if is_root:
+            os.lchown(target, _tar_id(pwd.getpwnam, member.uname, member.uid),
+                      _tar_id(grp.getgrnam, member.gname, member.gid))
+        if not member.issym() and not member.isdir():
+            os.chmod(target, member.mode & 07777)
+            os.utime(target, (member.mtime, member.mtime))
+        extracted.append(name)
+
+    directories.reverse()
+    for target, member in directories:
+        os.chmod(target, member.mode & 07777)
+        os.utime(target, (member.mtime, member.mtime))
+    return extracted
+
+
+def _tar_id(getent, name, default):
+    try:
+        return getent(name)[2]
+    except KeyError:
+        return default
+
+
+def _extract_zip(archive, root, wanted, workers):
+    extracted = []
+    directories = []
+    files = []
+    checked = set()
+
+    zf = zipfile.ZipFile(archive)
+    try:
+        # create directories and links first, then the files can be 
+        # uncompressed in any order
+        for info in zf.infolist():
+            name = _member_name(info.filename)
+            if not name or (wanted is not None and not wanted(name)):
+                continue
+            target = _member_target(root, name, checked)
+            mode = info.external_attr >> 16
+            if info.create_system != 3:
+                mode = 0
+
+            if info.filename.endswith('/'):
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                directories.append((target, mode, info))
+            elif stat.S_ISLNK(mode):
+                linkname = zf.read(info)
+                _check_link(root, name, target, linkname)
+                _unlink_existing(target)
+                os.symlink(linkname, target)
+                checked.clear()
+            else:
+                files.append((name, mode, info))
+            extracted.append(name)
+    finally:
+        zf.close()
+
+    # check the files after all links are in place
+    checked.clear()
+    files = [(_member_target(root, name, checked), mode, info) 
+             for name, mode, info in files]
+
+    local = threading.local()
+    opened = []
+
+    def write(item):
+        target, mode, info = item
+        if not hasattr(local, 'zf'):
+            local.zf = zipfile.ZipFile(archive)
+            opened.append(local.zf)
+        src = local.zf.open(info)
+        try:
+            _write_member(src, target)
+        finally:
+            src.close()
+        _zip_attributes(target, mode, info)
+
+    try:
+        _in_threads(write, files, workers, 'extract')
+    finally:
+        for zf in opened:
+            zf.close()
+
+    directories.reverse()
+    for target, mode, info in directories:
+        _zip_attributes(target, mode, info)
+    return extracted
+
+
+def _zip_attributes(target, mode, info):
+    if mode & 07777:
+        os.chmod(target, mode & 07777)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(target, (mtime, mtime))
+
+
+def pack(dir, archive, compression=_missing, manifest=None):
+    ''' Pack a directory tree to a tar or zip file. 
+
+    Files are streamed into the archive, nothing is staged on disk. The 
+    archive is written to a temporary file that replaces ``archive`` when 
+    it is complete. Names in the archive are relative to ``dir``.
+
+    With a ``manifest`` only files that changed since the previous pack 
+    with the same manifest are packed. The manifest keeps the size, 
+    modification time and md5 sum of every file. A file with the same size
+    and modification time is skipped without being read, a file with a new
+    modification time but the same checksum is also skipped. Directories 
+    and links are always packed. Files that are in the old manifest but 
+    not in the new one have been removed.
+
+    :arg dir: Directory to pack
+    :arg archive: Path to the archive, a name ending with ``.zip`` creates
+                  a zip file, otherwise a tarfile is created
+    :arg compression: ``gz``, ``bz2``, ``xz`` or None for an uncompressed 
+                      tarfile. Default is to pick it from the ending of 
+                      ``archive``, like ``.tar.gz`` or ``.tbz2``. 
+                      Ignored for zip files which are always deflated. 
+                      ``xz`` needs a :mod:`tarfile` that supports it, 
+                      otherwise :exc:`sy.exception.Error` is raised
+    :arg manifest: Path to a manifest file, it is created if it does not
+                   exist and updated when the archive is written
+    :returns: List with the names of the members written to the archive
+    '''
+    is_zip = archive.endswith('.zip')
+    if compression is _missing:
+        compression = None
+        for ending, kind in (('gz', 'gz'), ('bz2', 'bz2'), ('tbz', 'bz2'), 
+                             ('xz', 'xz')):
+            if archive.endswith(ending):
+                compression = kind
+    if not is_zip and compression is not None and \
+            compression not in tarfile.TarFile.OPEN_METH:
+        raise sy.exception.Error(
+                'Can not pack %s, %s compression is not supported by the '
+                'tarfile module of this Python' % (archive, compression))
+
+    previous = {}
+    if manifest is not None and os.path.exists(manifest):
+        # names are kept as latin-1 so any bytes survive json
+        for name, entry in json.loads(slurp(manifest)).items():
+            previous[name.encode('latin-1')] = entry
+
+    entries, current = _pack_entries(dir, previous, manifest)
+
+    # checksums of the packed files, calculated as they are read
+    sums = None
+    if manifest is not None:
+        sums = {}
+    fd, tmp = _new_temp(archive)
+    os.close(fd)
+    try:
+        if is_zip:
+            _pack_zip(tmp, entries, sums)
+        else:
+            _pack_tar(tmp, entries, compression, sums)
+    except:
+        os.unlink(tmp)
+        raise
+    os.rename(tmp, archive)
+    log.debug('Packed {} members of "{}" to "{}"', len(entries), dir, 
+              archive)
+
+    if manifest is not None:
+        for member, digest in sums.items():
+            current[member][2] = digest
+        fd, tmp = _new_temp(manifest)
+        os.write(fd, json.dumps(current, sort_keys=True, 
+                                encoding='latin-1'))
+        os.close(fd)
+        os.rename(tmp, manifest)
+    return [name for name, path, st in entries]
+
+
+def _new_temp(path, mode=0666):
+    ''' Create a temporary file next to ``path`` to rename over it when
+    done. Unlike :func:`tempfile.mkstemp`, which always uses 0600, the 
+    file is created with ``mode`` less the umask, like a new file would be.
+    Returns an open file descriptor and the name of the file.
+    '''
+    dir, name = os.path.split(os.path.abspath(path))
+    while True:
+        tmp = os.path.join(dir, '.%s.%s' % (
+                    name, binascii.hexlify(os.urandom(4))))
+        try:
+            return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 
+                           mode), tmp
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _pack_entries(dir, previous, manifest):
+    ''' Return the members to pack as a sorted list of (name, path, stat)
+    and the new manifest. Files that are unchanged since the ``previous``
+    manifest are left out. Only files with a new modification time but 
+    the same size are hashed here, the checksums of the files to pack are
+    left as None for the packing to fill in.
+    '''
+    entries = []
+    current = {}
+    touched = []
+
+    for dirpath, dirnames, filenames in os.walk(dir):
+        rel = os.path.relpath(dirpath, dir)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if rel == '.':
+                member = name
+            else:
+                member = rel + '/' + name
+            st = os.lstat(path)
+            old = previous.get(member)
+            if not stat.S_ISREG(st.st_mode) or old is None or \
+                    old[0] != st.st_size:
+                entries.append((member, path, st))
+            elif old[1] == st.st_mtime:
+                current[member] = old
+            else:
+                # only the content can tell if it changed
+                touched.append((member, path, st))
+
+    if manifest is not None:
+        sums = checksums([path for member, path, st in touched])
+        for member, path, st in touched:
+            if sums[path] == previous[member][2]:
+                current[member] = [st.st_size, st.st_mtime, sums[path]]
+            else:
+                entries.append((member, path, st))
+        for member, path, st in entries:
+            if stat.S_ISREG(st.st_mode):
+                current[member] = [st.st_size, st.st_mtime, None]
+
+    entries.sort()
+    return entries, current
+
+
+class _hashing_reader(object):
+    ''' File wrapper that hashes what is read from it '''
+
+    def __init__(self, f):
+        self._f = f
+        self.hash = _new_hash('md5')
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _pack_tar(path, entries, compression, sums):
+    mode = 'w:' + (compression or '')
+    kwargs = {}
+    if compression == 'gz':
+        # same as gzip and tar czf, level 9 is a lot slower for little gain
+        kwargs['compresslevel'] = 6
+    tar = tarfile.open(path, mode, **kwargs)
+    try:
+        for member, filepath, st in entries:
+            info = tar.gettarinfo(filepath, member)
+            if info is None:
+                log.debug('Skipping "{}", sockets can not be packed', filepath)
+                continue
+            if info.isreg():
+                f = open(filepath, 'rb')
+                try:
+                    if sums is None:
+                        tar.addfile(info, f)
+                    else:
+                        reader = _hashing_reader(f)
+                        tar.addfile(info, reader)
+                        sums[member] = reader.hash.hexdigest()
+                finally:
+                    f.close()
+            else:
+                tar.addfile(info)
+    finally:
+        tar.close()
+
+
+def _pack_zip(path, entries, sums):
+    zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        for member, filepath, st in entries:
+            if stat.S_ISLNK(st.st_mode):
+                info = zipfile.ZipInfo(member, 
+                                       time.localtime(st.st_mtime)[:6])
+                info.create_system = 3
+                info.external_attr = st.st_mode << 16
+                zf.writestr(info, os.readlink(filepath))
+            elif stat.S_ISREG(st.st_mode) and sums is not None:
+                _zip_hashed(zf, filepath, member, st, sums)
+            elif stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode):
+                zf.write(filepath, member)
+            else:
+                log.debug('Skipping "{}", only files, directories and links '
+                          'can be packed in zip files', filepath)
+    finally:
+        zf.close()
+
+
+def _zip_hashed(zf, filepath, member, st, sums):
+    ''' Zip a file and put its checksum in ``sums``. zipfile only streams
+    files it opens itself, so files larger than ``_ZIP_READ_ONCE`` are 
+    read a second time for the checksum.
+    '''
+    if st.st_size > _ZIP_READ_ONCE:
+        zf.write(filepath, member)
+        sums[member] = checksum(filepath)
+        return
+    data = slurp(filepath, binary=True)
+    info = zipfile.ZipInfo(member, time.localtime(st.st_mtime)[:6])
+    info.create_system = 3
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    zf.writestr(info, data)
+    m = _new_hash('md5')
+    m.update(data)
+    sums[member] = m.hexdigest()
+
+ 
+# _______________________________
+# read files
+
+def _open_read(path, encoding=None, binary=False):
+    if binary or encoding is None:
+        if binary:
+            mode = 'rb'
+        else:
+            mode = 'rU' # convert '\r\n' and '\r' to \n
+        return open(path, mode)
+    else:
+        # Encoded
+        return codecs.open(path, 'r', encoding, 'strict')
+
+
+def slurp(path, encoding=None, binary=False):
+    ''' Return a file as a string 
+    
+    :arg path: Path to file
+    :arg encoding: The encoding of the file. 
+                   Default is None which returns the file as a 8-bit string
+                   which works well for latin1 and asci. 
+    :arg binary: Treat the file as a binary, no conversions will be made
+    '''
+    f = _open_read(path, encoding=encoding, binary=binary)
+    try:
+        c = f.read()
+    finally:
+        f.close()
+    if encoding:
+        # unicode
+        return _unicode_newlines(c)
+    else:
+        # binary or 8-bit text (opened with 'U' which converts newlines)
+        return c
+
+
+def _tail_lines(data, whole, encoding):
+    ''' Return the lines in the end of a file. Unless the ``data`` is 
+    the ``whole`` file the first line is dropped since it is most likely 
+    cut, None is returned if there is no line break to cut at.
+    '''
+    cr = data.find('\r')
+    cut = data.find('\n')
+    if cr >= 0 and (cut < 0 or cr < cut):
+        cut = cr
+    if whole:
+        text = data
+    elif cut < 0:
+        return None
+    else:
+        text = data[cut + 1:]
+    if encoding:
+        text = text.decode(encoding)
+        if not whole and data[cut] == '\r' and text[:1] in (u'\n', u'\x85'):
+            text = text[1:]
+        return _unicode_newlines(text).splitlines(True)
+    if not whole and data[cut] == '\r' and text[:1] == '\n':
+        text = text[1:]
+    return text.replace('\r\n', '\n').replace('\r', '\n').splitlines(True)
+
+
+def _unicode_newlines(c):
+    ''' Convert all unicode end-of-line sequences to ``\\n`` '''
+    return (c.replace(u'\r\n', u'\n')
+             .replace(u'\r\x85', u'\n')
+             .replace(u'\r', u'\n')
+             .replace(u'\x85', u'\n')
+             .replace(u'\u2028', u'\n'))
+
+
+def lines(path, encoding=None, newline=True):
+    ''' Return list of lines from file. 
+    
+    :arg newline: If true, keep newline characters for every line. 
+                 Default is True.  All newline characters (``\\r``, ``\\r\\n``) 
+                 are replaced by ``\\n``. 
+    Same arguments as to :func:`slurp` 
+    '''
+    return list(iterlines(path, encoding=encoding, newline=newline))
+
+
+def iterlines(path, encoding=None, newline=True):
+    ''' Return an iterator over the lines in a file. Only one line at a 
+    time is kept in memory, use it instead of :func:`lines` for big files::
+
+        for line in sy.path.iterlines('/var/log/messages'):
+            if 'error' in line:
+                print line
+
+    Same arguments as :func:`lines`
+    '''
+    f = _open_read(path, encoding=encoding)
+    try:
+        if not encoding:
+            # opened with 'U' which converts newlines
+            for line in f:
+                if not newline and line.endswith('\n'):
+                    line = line[:-1]
+                yield line
+            return
+
+        after_cr = False
+        for line in f:
+            if after_cr and line == u'\x85':
+                # \r\x85 is one newline
+                after_cr = False
+                continue
+            after_cr = line.endswith(u'\r')
+            line = _unicode_newlines(line)
+            if not newline:
+                line = line.splitlines()[0]
+            yield line
+    finally:
+        f.close()
+
+
+def head(path, n=10, encoding=None, newline=True):
+    ''' Return the first ``n`` lines of a file. The rest of the file is not
+    read. Same arguments as :func:`lines`
+    '''
+    it = iterlines(path, encoding=encoding, newline=newline)
+    try:
+        return list(itertools.islice(it, n))
+    finally:
+        it.close()
+
+
+def tail(path, n=10, encoding=None, newline=True):
+    ''' Return the last ``n`` lines of a file. The file is read backwards 
+    from the end until there are enough lines, so this is fast for big 
+    files. Same arguments as :func:`lines`
+    '''
+    if n <= 0:
+        return []
+    if encoding and codecs.lookup(encoding).name not in _ASCII_NEWLINES:
+        # newline bytes can not be found without decoding from the start
+        return list(collections.deque(
+                        iterlines(path, encoding=encoding, newline=newline), n))
+
+    f = open(path, 'rb')
+    try:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ''
+        while True:
+            size = min(_TAIL_BLOCK, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+            found = _tail_lines(data, pos == 0, encoding)
+            if found is not None and (pos == 0 or len(found) >= n):
+                break
+    finally:
+        f.close()
+
+    found = found[-n:]
+    if not newline:
+        found = [line.splitlines()[0] for line in found]
+    return found
+
+
+def contains(path, pattern, encoding=None):
+    ''' Returns True if the file contains a line that matches the string or 
+        compiled pattern.
+
+        Files that are not decoded are searched in memory mapped and only 
+        the lines with a match are looked at, which is much faster on big
+        files than going through every line.
+
+        :arg path: Path to the file
+        :arg pattern: String or compiled pattern 
+    '''
+    for _ in _matching_lines(path, pattern, encoding, linenos=False):
+        return True
+    return False
+
+
+def count(path, pattern, encoding=None):
+    ''' Return the number of lines that match the string or compiled 
+    pattern. Same arguments as :func:`contains`
+    '''
+    nr_lines = 0
+    for _ in _matching_lines(path, pattern, encoding, linenos=False):
+        nr_lines += 1
+    return nr_lines
+
+
+def find_all(path, pattern, encoding=None):
+    ''' Return the line numbers, starting at 1, of the lines that match 
+    the string or compiled pattern. Same arguments as :func:`contains`
+    '''
+    return [lineno for lineno, _ in _matching_lines(path, pattern, encoding)]
+
+
+def _matching_lines(path, pattern, encoding=None, linenos=True):
+    ''' Yield the line number and line of every line that matches. The 
+    line numbers are None if ``linenos`` is false and the file is mapped.
+    '''
+    if encoding is None and _mappable(pattern):
+        data = _map(path)
+        if data is not None and _lone_cr(data):
+            # old Mac line endings, only the line reader splits on them
+            data.close()
+            data = None
+        if data is not None:
+            try:
+                for match in _mapped_matching_lines(data, pattern, linenos):
+                    yield match
+            finally:
+                data.close()
+            return
+
+    if not hasattr(pattern, 'search'):
+        pattern = re.compile(pattern)
+    f = _open_read(path, encoding=encoding)
+    try:
+        lineno = 0
+        for line in f:
+            lineno += 1
+            if pattern.search(line):
+                yield lineno, line
+    finally:
+        f.close()
+
+
+def _mappable(pattern):
+    ''' True if the pattern can be searched for in the mapped bytes of a 
+    file with the same result as line by line '''
+    source = getattr(pattern, 'pattern', pattern)
+    if isinstance(source, unicode):
+        return False
+    # these look past the end of the line when searching all of the file
+    for end_of_line in ('$', '\\Z', '(?=', '(?!'):
+        if end_of_line in source:
+            return False
+    # only matches at the start of the file when searching all of it
+    return '\\A' not in source
+
+
+def _map(path):
+    ''' Return the content of ``path`` mapped in memory, or None if it can
+    not be mapped. Only regular files with a size are mapped, files in 
+    /proc and /sys say they are empty and pipes can not be mapped.
+    '''
+    st = os.stat(path)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return None
+    f = open(path, 'rb')
+    try:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return None
+    finally:
+        f.close()
+
+
+def _lone_cr(data):
+    ''' True if ``data`` has a ``\\r`` that is not part of ``\\r\\n`` '''
+    return data.find('\r') >= 0 and \
+           re.search('\r(?!\n)', data) is not None
+
+
+def _mapped_matching_lines(data, pattern, linenos=True):
+    ''' Search the mapped file for candidates with a regex or ``find`` 
+    for literal strings, and check the line of every candidate with the
+    pattern. A line that is not a match is skipped, so patterns that match
+    across lines in the mapped file still give the same result as searching
+    line by line.
+    '''
+    literal = None
+    if not hasattr(pattern, 'search'):
+        if re.search(r'[.^$*+?{}\[\]\\|()]', pattern):
+            pattern = re.compile(pattern)
+        else:
+            literal = pattern
+    if literal is None:
+        # ^ and $ match at every line like they do on a single line
+        candidates = re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+
+    size = len(data)
+    lineno = None
+    if linenos:
+        lineno = 1
+    counted = pos = 0
+    while pos < size:
+        if literal is not None:
+            found = data.find(literal, pos)
+        else:
+            match = candidates.search(data, pos)
+            if match is None:
+                return
+            found = match.start()
+        if found < 0 or found == size and data[-1] == '\n':
+            # nothing found or an empty match after the last line
+            return
+        start = data.rfind('\n', 0, found) + 1
+        end = data.find('\n', found) + 1 or size
+        line = data[start:end]
+        if '\r' in line:
+            # like the universal newlines used when reading lines, there 
+            # are no lone \r, see _lone_cr
+            line = line.replace('\r\n', '\n')
+        if linenos:
+            lineno += data[counted:start].count('\n')
+            counted = start
+        if literal is not None and literal in line or \
+                literal is None and pattern.search(line):
+            yield lineno, line
+        pos = end
+
+
+
+def md5sum(path, hex=True, cache=None):
+    ''' Calculate md5 sum for a file.
+
+    :arg hex: Return the digest in hexadecimal suitable for writing to 
+                text files. Default True.
+    :arg cache: A :class:`ChecksumCache` or True to use 
+                ``sy.path.checksum_cache``, see :func:`checksum`
+    '''
+    return checksum(path, 'md5', hex=hex, cache=cache)
+
+
+def _new_hash(algorithm):
+    if hashlib is None:
+        if algorithm != 'md5':
+            raise ValueError('unsupported hash type ' + algorithm)
+        return md5.new()
+    return hashlib.new(algorithm)
+
+
+def checksum(path, algorithm='md5', hex=True, cache=None):
+    ''' Calculate a checksum for a file with any algorithm supported by 
+    :mod:`hashlib`, like ``sha256`` or ``blake2b`` on newer Pythons::
+
+        sy.path.checksum('/etc/passwd', 'sha256')
+
+    :arg algorithm: Name of the hash algorithm, default ``md5``
+    :arg hex: Return the digest in hexadecimal. Default True.
+    :arg cache: A :class:`ChecksumCache` to get the checksum from when the
+                file has not changed since it was last calculated, or True
+                to use ``sy.path.checksum_cache``. Default is no cache.
+    '''
+    if cache is True:
+        cache = checksum_cache
+
+    f = io.open(path, 'rb', buffering=0)
+    try:
+        st = os.fstat(f.fileno())
+        if cache is not None:
+            digest = cache.get(st, algorithm)
+            if digest is not None:
+                if hex:
+                    return binascii.hexlify(digest)
+                return digest
+
+        m = _new_hash(algorithm)
+        buf = bytearray(min(_HASH_BLOCK, max(st.st_size, 1)))
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            m.update(view[:n])
+    finally:
+        f.close()
+
+    digest = m.digest()
+    if cache is not None:
+        cache.set(st, algorithm, digest)
+    if hex:
+        return m.hexdigest()
+    return digest
+
+
+def checksums(paths, algorithm='md5', hex=True, cache=None, 
+              workers=HASH_WORKERS):
+    ''' Calculate checksums for many files using a pool of threads, the
+    hashing itself runs in parallel since :mod:`hashlib` does not hold the 
+    interpreter lock::
+
+        sums = sy.path.checksums(glob.glob('/opt/app/lib/*.jar'), 'sha256')
+
+    If a file can not be read the first error is raised after all threads 
+    are done.
+
+    :arg paths: List of files 
+    :arg workers: Number of threads, default ``HASH_WORKERS``
+    :returns: Dictionary with the checksum for each path
+    
+    The other arguments are the same as for :func:`checksum`.
+    '''
+    result = {}
+    def work(path):
+        result[path] = checksum(path, algorithm, hex=hex, cache=cache)
+    _in_threads(work, paths, workers, 'checksums')
+    return result
+
+
+class ChecksumCache(object):
+    ''' Checksums of files that are not calculated again until the file 
+    changes. A file is considered unchanged if its device, inode, size 
+    and modification time are the same. The numbers of cache hits and 
+    misses are kept in the attributes ``hits`` and ``misses``.
+
+    Pass it as the ``cache`` argument to :func:`checksum`, 
+    :func:`checksums` or :func:`md5sum`::
+
+        cache = sy.path.ChecksumCache()
+        for i in range(10):
+            sy.path.checksums(files, cache=cache)
+    '''
+
+    def __init__(self):
+        self.hits = self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _version(self, st):
+        mtime = getattr(st, 'st_mtime_ns', None) or st.st_mtime
+        return st.st_size, mtime
+
+    def get(self, st, algorithm):
+        ''' Return the binary digest for the file with stat result ``st``
+        or None if it is not cached or has changed
+        '''
+        self._lock.acquire()
+        try:
+            entry = self._entries.get((st.st_dev, st.st_ino, algorithm))
+            if entry is not None and entry[0] == self._version(st):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def set(self, st, algorithm, digest):
+        ''' Remember the binary digest for the file with stat result 
+        ``st`` '''
+        self._lock.acquire()
+        try:
+            self._entries[(st.st_dev, st.st_ino, algorithm)] = \
+                    (self._version(st), digest)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        ''' Remove all checksums and reset the counters '''
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+checksum_cache = ChecksumCache()
+
+
+
+
+
+# _______________________________
+# copy files
+
+def copy(src, dst, skip=None, preserve=True):
+    ''' Copy a file. 
+
+    The content is copied by the kernel with ``copy_file_range`` or 
+    ``sendfile`` when possible, without passing through Python. The copy 
+    is written to a temporary file that replaces ``dst`` when complete.
+
+    :arg dst: Path of the copy or a directory to copy the file to
+    :arg skip: Leave ``dst`` untouched if it has the same size and 
+               modification time (to the second, like rsync) as ``src`` 
+               with ``mtime``, or the same size and md5 sum with 
+               ``checksum``. Default is to always copy.
+    :arg preserve: Copy the mode, owner and modification time. The owner
+                   is only copied when running as root. Default True.
+    :returns: True if the file was copied
+    '''
+    assert skip in (None, 'mtime', 'checksum'), 'Unknown skip: ' + str(skip)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        st = os.fstat(fin)
+        if skip and _same_file(src, st, dst, skip):
+            log.debug('"{}" is unchanged', dst)
+            return False
+
+        # without preserve the mode is that of src less the umask, like cp
+        fout, tmppath = _new_temp(dst, stat.S_IMODE(st.st_mode) & 0777)
+        try:
+            try:
+                _copy_data(fin, fout, st.st_size)
+            finally:
+                os.close(fout)
+            if preserve:
+                _copy_stat(st, tmppath)
+            os.rename(tmppath, dst)
+        except:
+            os.remove(tmppath)
+            raise
+    finally:
+        os.close(fin)
+    return True
+
+
+def _same_file(src, st, dst, skip):
+    try:
+        dstst = os.stat(dst)
+    except OSError:
+        return False
+    if not stat.S_ISREG(dstst.st_mode) or dstst.st_size != st.st_size:
+        return False
+    if skip == 'mtime':
+        return int(dstst.st_mtime) == int(st.st_mtime)
+    return checksum(src) == checksum(dst)
+
+
+def _copy_data(fin, fout, size):
+    ''' Copy from file descriptor ``fin`` to ``fout``, in the kernel 
+    if supported for the files and in blocks through Python if not '''
+    offset = 0
+    for func in (_copy_file_range, _sendfile):
+        if func is None:
+            continue
+        try:
+            while offset < size:
+                count = min(size - offset, 1 << 30)
+                if func is _copy_file_range:
+                    n = func(fin, fout, count, offset, offset)
+                else:
+                    n = func(fout, fin, offset, count)
+                if not n:
+                    break
+                offset += n
+            break
+        except OSError, e:
+            if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, 
+                               errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+
+    # the rest of the file, or all of it if not copied in the kernel
+    os.lseek(fin, offset, os.SEEK_SET)
+    os.lseek(fout, offset, os.SEEK_SET)
+    while True:
+        data = os.read(fin, _COPY_BLOCK)
+        if not data:
+            break
+        while data:
+            data = data[os.write(fout, data):]
+
+
+def _copy_stat(st, path, link=False):
+    ''' Set the mode, modification time and owner from ``st`` on ``path``
+    '''
+    if os.geteuid() == 0:
+        if link:
+            os.lchown(path, st.st_uid, st.st_gid)
+        else:
+            chown(path, owner=st.st_uid, group=st.st_gid)
+    if not link:
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+
+def sync_tree(src, dst, skip='mtime', workers=COPY_WORKERS):
+    ''' Make ``dst`` a copy of the directory tree ``src``, copying only
+    the files that differ. Files are copied by :func:`copy` in a pool of 
+    threads, which mostly helps trees with many small files or on network
+    filesystems.
+
+    Directories, files and symbolic links are copied with their mode, 
+    modification time and owner (if running as root). Other files are 
+    skipped. Nothing is removed from ``dst`` except members of another
+    type than in ``src``, like a directory where ``src`` has a file. Those
+    are replaced.
+
+    :arg skip: Files with the same size and modification time are left 
+               untouched with ``mtime``, with the same size and md5 sum 
+               with ``checksum``. With None all files are copied.
+    :arg workers: Number of threads copying files, default 
+                  ``COPY_WORKERS``
+    :returns: List with the paths relative to ``src`` of the copied files 
+              and links
+    '''
+    copied = []
+    files = []
+    directories = []
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target = os.path.normpath(os.path.join(dst, rel))
+        if rel != '.':
+            _remove_other_type(target, stat.S_IFDIR)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        # set the mode and time last, the files change the modification time
+        directories.append((target, os.stat(dirpath)))
+
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            member = os.path.normpath(os.path.join(rel, name))
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                _remove_other_type(os.path.join(target, name), stat.S_IFLNK)
+                if _sync_link(path, os.path.join(target, name), st):
+                    copied.append(member)
+            elif stat.S_ISREG(st.st_mode):
+                _remove_other_type(os.path.join(target, name), stat.S_IFREG)
+                files.append(member)
+            elif not stat.S_ISDIR(st.st_mode):
+                log.debug('Skipping "{}", only files, directories and links '
+                          'are copied', path)
+
+    def work(member):
+        if copy(os.path.join(src, member), os.path.join(dst, member), 
+                skip=skip):
+            copied.append(member)
+    _in_threads(work, files, workers, 'sync_tree')
+
+    directories.reverse()
+    for target, st in directories:
+        _copy_stat(st, target)
+    copied.sort()
+    return copied
+
+
+def _remove_other_type(target, kind):
+    ''' Remove ``target`` unless it is of the file type ``kind``, like 
+    ``stat.S_IFDIR``. Symbolic links are removed, not followed. '''
+    try:
+        st = os.lstat(target)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if stat.S_IFMT(st.st_mode) == kind:
+        return
+    log.debug('Replacing "{}" which is of another type in the source', 
+              target)
+    if stat.S_ISDIR(st.st_mode):
+        rmtree(target)
+    else:
+        os.unlink(target)
+
+
+def _sync_link(path, target, st):
+    linkname = os.readlink(path)
+    if os.path.islink(target):
+        if os.readlink(target) == linkname:
+            return False
+        os.unlink(target)
+    elif os.path.lexists(target):
+        os.unlink(target)
+    os.symlink(linkname, target)
+    _copy_stat(st, target, link=True)
+    return True
+
+
+# _______________________________
+# replace content in file
+
+def remove_lines(path, matching, encoding=None):
+    ''' Remove lines from the ``path`` that matches ``matching``
+
+        .. note:: 
+            The line will match if the pattern is anywhere on the line. 
+            See :func:`re.search` in the standard library.
+ 
+        :arg path: Path to the file
+        :arg matching: String to search for (or compiled regular expression)
+        :returns: Number of lines removed
+    '''
+    return edit(path, [('remove', matching)], encoding=encoding)[0]
+
+def replace_lines(path, matching, replacement, encoding=None):
+    ''' Replace lines that contain the string ``matching`` with ``replacement``
+
+        .. note:: 
+            The line will match if the pattern is anywhere on the line. 
+            See :func:`re.search` in the standard library.
+
+        :arg path: Path to the file
+        :arg matching: String or compiled regular expression.
+        :arg replacement: Line to replace with, newline character will 
+            automatically be added if missing.
+        :returns: Number of lines replaced
+    '''
+    return edit(path, [('replace_line', matching, replacement)], 
+                encoding=encoding)[0]
+
+
+def edit(path, rules, encoding=None):
+    ''' Make several changes to a file in one pass. The file is read and 
+    written once no matter how many rules there are::
+
+        sy.path.edit('/etc/system', [
+            ('remove', r'^set noexec_user_stack'),
+            ('replace_line', r'^set shmsys:', 'set shmsys:shminfo_shmmax=4G'),
+            ('replace', r'nfs3', 'nfs4'),
+            ('ensure', 'set rlim_fd_max=65536', r'^set rlim_fd_max='),
+            ('append', '* edited by sy'),
+        ])
+
+    Every line is passed through the rules in order, so a rule sees the 
+    line as changed by the rules before it. A removed line is not seen by
+    the rules after. The rules are:
+
+    ``('remove', matching)``
+        Remove lines that match, like :func:`remove_lines`
+
+    ``('replace_line', matching, line)``
+        Replace lines that match with ``line``, like :func:`replace_lines`
+
+    ``('replace', match, replacement)``
+        Replace all occurances of ``match`` within each line, like 
+        :func:`replace` does on a whole file
+
+    ``('append', line)``
+        Add ``line`` at the end of the file
+
+    ``('ensure', line)`` or ``('ensure', line, matching)``
+        Make sure the file has ``line``. Lines that match ``matching`` are
+        replaced with ``line`` and if no line is equal to ``line`` it is 
+        added at the end of the file
+
+    Patterns are strings or compiled regular expressions and match anywhere 
+    on the line, see :func:`re.search`. Newlines are added to lines that 
+    miss them.
+
+    :arg path: Path to the file
+    :arg rules: List of rules
+    :returns: List with the number of lines or occurances changed by each 
+              rule
+    '''
+    compiled = [_edit_rule(rule) for rule in rules]
+
+    def filter(original_f, new_f):
+        counts = [0] * len(compiled)
+        present = [False] * len(compiled)
+        last = ''
+        for line in original_f:
+            for i, (action, rx, text) in enumerate(compiled):
+                if action == 'remove':
+                    if rx.search(line):
+                        counts[i] += 1
+                        line = None
+                        break
+                elif action == 'replace':
+                    line, nr_subs = rx.subn(text, line)
+                    counts[i] += nr_subs
+                elif action == 'replace_line':
+                    if rx.search(line):
+                        line = text
+                        counts[i] += 1
+                elif action == 'ensure':
+                    if line.rstrip('\r\n') == text[:-1]:
+                        present[i] = True
+                    elif rx is not None and rx.search(line):
+                        line = text
+                        counts[i] += 1
+                        present[i] = True
+            if line is not None:
+                new_f.write(line)
+                last = line
+
+        for i, (action, rx, text) in enumerate(compiled):
+            if action == 'append' or (action == 'ensure' and not present[i]):
+                if last and not last.endswith('\n'):
+                    new_f.write('\n')
+                new_f.write(text)
+                last = text
+                counts[i] += 1
+        return counts
+
+    return _replace_file(path, filter, encoding=encoding)
+
+
+def _edit_rule(rule):
+    ''' Return the action, compiled pattern and text of a rule for 
+    :func:`edit` '''
+    action = rule[0]
+    if action in ('remove', 'append'):
+        assert len(rule) == 2, 'Bad rule: %r' % (rule,)
+    elif action in ('replace', 'replace_line'):
+        assert len(rule) == 3, 'Bad rule: %r' % (rule,)
+    else:
+        assert action == 'ensure', 'Unknown rule: %r' % (rule,)
+        assert len(rule) in (2, 3), 'Bad rule: %r' % (rule,)
+
+    if action == 'remove':
+        pattern, text = rule[1], None
+    elif action == 'append':
+        pattern, text = None, rule[1]
+    elif action == 'ensure':
+        text = rule[1]
+        pattern = len(rule) == 3 and rule[2] or None
+    else:
+        pattern, text = rule[1], rule[2]
+
+    if pattern is not None and not hasattr(pattern, 'search'):
+        pattern = re.compile(pattern)
+    if action != 'replace' and text is not None and not text.endswith('\n'):
+        text += '\n'
+    return action, pattern, text
+
+
+def replace(path, match, replacement, encoding=None, window=None, 
+            overlap=4096):
+    ''' Replace all occurances of ``match`` with ``replacement``. 
+    Using :func:`re.sub`, backreferences in the replacement will work as
+    normal::
+
+        # change login of all users to 'leif'
+        rx = re.compile(r'^\w+:(.*)', re.MULTILINE)
+        replace('/etc/passwd', rx, r'leif:\\1') 
+
+    Large files can be replaced in windows, the memory used is then 
+    bounded by ``window`` and ``overlap`` instead of the file size::
+
+        replace('/var/log/huge.log', r'password=\S+', 'password=XXX', 
+                window=1024*1024)
+
+    .. note:: 
+        Make sure your replacement uses a raw string (``r''``) if it contains 
+        backreferences.
+
+
+    :arg path: Path to the file
+    :arg match: String to match
+    :arg replacement: String to replace match with
+    :arg window: Read and replace the file this many bytes at a time instead
+                 of reading all of it into memory
+    :arg overlap: Bytes kept between windows. Matches shorter than this 
+                  give the same result as without a window
+    :returns: Number of replacements made
+    '''
+    if not hasattr(match, 'sub'):
+        match = re.compile(match, re.MULTILINE)
+
+    def filter(original_f, new_f):
+        if window:
+            return _sub_windows(match, replacement, original_f, new_f, 
+                                window, overlap)
+        sub, nr_subs = match.subn(replacement, original_f.read())
+        new_f.write(sub)
+        return nr_subs
+    return _replace_file(path, filter, encoding=encoding)
+
+
+def _sub_windows(match, replacement, original_f, new_f, window, overlap):
+    ''' Like :func:`re.subn` but reads ``original_f`` in windows and 
+    writes the result to ``new_f``. 
+
+    The last ``overlap`` bytes of each window are searched again together
+    with the next window, so matches are only cut off if they are longer 
+    than that. The same number of bytes before the unsearched data are kept
+    so anchors and lookbehind assertions see what came before.
+    '''
+    if callable(replacement):
+        expand = replacement
+    elif '\\' not in replacement:
+        expand = lambda m: replacement
+    else:
+        # parse the backreferences once instead of for every match
+        template = sre_parse.parse_template(replacement, match)
+        expand = lambda m: sre_parse.expand_template(template, m)
+
+    nr_subs = 0
+    buf = original_f.read(0)
+    start = 0    # where the data that is not written yet begins in buf
+    last_end = None
+    eof = False
+    while not eof:
+        chunk = original_f.read(window)
+        eof = not chunk
+        buf += chunk
+        if eof:
+            limit = len(buf)
+        else:
+            limit = len(buf) - overlap
+            if limit <= start:
+                continue
+
+        pos = start
+        parts = []
+        for m in match.finditer(buf, start):
+            if not eof and (m.start() >= limit or m.end() >= len(buf)):
+                # might match differently with more data, search again 
+                # with the next window
+                limit = min(limit, m.start())
+                break
+            if m.start() == m.end() == last_end:
+                # re.sub skips empty matches next to the previous match
+                continue
+            parts.append(buf[pos:m.start()])
+            parts.append(expand(m))
+            nr_subs += 1
+            pos = last_end = m.end()
+
+        cut = max(pos, limit)
+        parts.append(buf[pos:cut])
+        new_f.write(buf[:0].join(parts))
+        keep = max(0, cut - overlap)
+        buf = buf[keep:]
+        start = cut - keep
+        if last_end is not None:
+            last_end -= keep
+    return nr_subs
+ 
+
+
+def _replace_file(path, filter_func, encoding=None):
+    ''' This builder function replaces the content of the path
+    with the output of the filter. The filter is passed the original file as 
+    file object. Example usage::
+
+        def filter(original_file, new_file):
+            # replace all lines starting with XXX with YYY
+            nr_replacements = 0
+            for line in original_file: 
+                if line.startswith('XXX'):
+                    new_file.write.write('YYY\n')
+                    nr_replacements += 1
+                else:
+                    new_file.write.write(line)
+            return nr_replacements
+
+        _replace_file(/etc/hosts', filter)
+
+    Anything returned from the `filter_func` will be returned by this function
+
+    The file is left untouched if the filter returns 0 or a list of zeros, 
+    or if the new content is the same as the old.
+
+    See :func:`replace_lines` for an example
+    '''
+
+    # expand path and get target of eventual symlink
+    path = os.path.realpath( expandpath(path) )
+
+    # open and lock original file
+    if encoding:
+        original_file = codecs.open(path, 'r+', encoding, 'strict')
+    else:
+        original_file = open(path, 'r+')
+    fcntl.lockf(original_file.fileno(), fcntl.LOCK_EX)
+
+    # get a temp file in the same directory as original file
+    _, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), 
+                                      prefix=os.path.basename(path),
+                                      suffix='.replacement')
+    try:
+        if encoding:
+            tmp_file = codecs.open(tmppath, 'wb', encoding, 'strict')
+        else:
+            tmp_file = open(tmppath, 'wb')
+        filter_ret = filter_func(original_file, tmp_file)
+        tmp_file.close()
+    finally:
+        if not tmp_file.closed:
+            tmp_file.close()
+        original_file.close()
+
+    if _unchanged(filter_ret) or _files_equal(path, tmppath):
+        log.debug('"{}" is unchanged', path)
+        os.remove(tmppath)
+        return filter_ret
+
+    try:
+        # stat the original file so we can copy permissions
+        pathst = os.stat(path)
+        os.chmod(tmppath, pathst.st_mode)
+        chown(tmppath, owner=pathst.st_uid, group=pathst.st_gid)
+     
+        # this should be an atomic operation on sane filesystems
+        os.rename(tmppath, path)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+    return filter_ret
+  
+
+
+ 
+def _unchanged(filter_ret):
+    ''' True if the return value of a filter says nothing was changed '''
+    if isinstance(filter_ret, (list, tuple)):
+        return filter_ret and not [nr for nr in filter_ret if nr]
+    return filter_ret == 0 and not isinstance(filter_ret, bool)
+
+ 
+# _______________________________
+# walk directory trees
+
+class _DirEntry(object):
+    ''' The parts of :class:`os.DirEntry` used by :func:`walk`, for 
+    Pythons without scandir '''
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, dir, name):
+        self.name = name
+        self.path = os.path.join(dir, name)
+        self._lstat = os.lstat(self.path)
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def __repr__(self):
+        return '<_DirEntry %r>' % self.name
+
+
+def _list_entries(path, prefetch=False):
+    ''' Return the entries of directory ``path``. With ``prefetch`` the
+    stat results are fetched now, entries that disappear are left out. 
+    '''
+    if _scandir is None:
+        entries = []
+        for name in os.listdir(path):
+            try:
+                entries.append(_DirEntry(path, name))
+            except OSError:
+                pass
+        return entries
+
+    entries = list(_scandir(path))
+    if prefetch:
+        found = []
+        for entry in entries:
+            try:
+                entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            found.append(entry)
+        entries = found
+    return entries
+
+
+def _matcher(top, patterns):
+    ''' Return a function matching entries against shell patterns. 
+    Patterns with a ``/`` match the path relative to ``top``, the others 
+    the name.
+    '''
+    if patterns is None:
+        return None
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    names = [p for p in patterns if '/' not in p]
+    paths = [p for p in patterns if '/' in p]
+    prefix = len(top.rstrip(os.sep)) + 1
+
+    def match(entry):
+        for pattern in names:
+            if fnmatch.fnmatchcase(entry.name, pattern):
+                return True
+        if paths:
+            rel = entry.path[prefix:]
+            for pattern in paths:
+                if fnmatch.fnmatchcase(rel, pattern):
+                    return True
+        return False
+    return match
+
+
+class _dir_readers(object):
+    ''' Threads reading directories for :func:`walk`. Only the thread 
+    that creates it may call the methods.
+    '''
+
+    def __init__(self, workers):
+        self.outstanding = 0
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='sy.path walk')
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            path, depth = task
+            try:
+                result = (path, depth, _list_entries(path, prefetch=True), 
+                          None)
+            except OSError, e:
+                result = (path, depth, None, e)
+            self._results.put(result)
+
+    def put(self, path, depth):
+        self.outstanding += 1
+        self._tasks.put((path, depth))
+
+    def get(self):
+        ''' Return (path, depth, entries, error) for the next directory 
+        read '''
+        result = self._results.get()
+        self.outstanding -= 1
+        return result
+
+    def stop(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+
+
+def walk(top, include=None, exclude=None, prune=None, maxdepth=None, 
+         workers=1, onerror=None):
+    ''' Go through all files and directories below ``top``. Yields an 
+    :class:`os.DirEntry` for each, or an object with the same ``name``, 
+    ``path``, ``stat()``, ``is_dir()``, ``is_file()`` and ``is_symlink()``
+    on Pythons without scandir. The stat result is cached in the entry::
+
+        for entry in sy.path.walk('/var/log', include='*.gz', 
+                                  exclude=['.snapshot']):
+            if entry.stat().st_mtime < time.time() - 30*86400:
+                os.remove(entry.path)
+
+    Entries of a directory are yielded before the entries of its 
+    subdirectories. Links to directories are not followed.
+
+    Patterns are shell patterns matched against the name of the entry, or 
+    against the path relative to ``top`` if the pattern contains a ``/``.
+    As in :mod:`fnmatch` a ``*`` also matches ``/``.
+
+    :arg include: Only yield entries matching one of these patterns, 
+                  directories are still walked through
+    :arg exclude: Skip entries matching one of these patterns, excluded 
+                  directories are not walked through 
+    :arg prune: Function called with the entry of each directory, return 
+                True to not walk through it
+    :arg maxdepth: Go at most this many levels below ``top``, 1 only yields
+                   the entries in ``top``
+    :arg workers: Number of threads reading directories. The stat results 
+                  are fetched by the threads, which speeds up walking 
+                  network filesystems. Entries are not yielded in any 
+                  particular order when more than 1.
+    :arg onerror: Function called with the :exc:`OSError` if a directory
+                  can not be read, the default is to skip it like 
+                  :func:`os.walk`
+    '''
+    included = _matcher(top, include)
+    excluded = _matcher(top, exclude)
+
+    def select(entries, depth):
+        ''' Return the entries to yield and the directories to walk '''
+        found = []
+        subdirs = []
+        for entry in entries:
+            if excluded is not None and excluded(entry):
+                continue
+            if entry.is_dir(follow_symlinks=False) and \
+                    (maxdepth is None or depth < maxdepth) and \
+                    not (prune is not None and prune(entry)):
+                subdirs.append((entry.path, depth + 1))
+            if included is None or included(entry):
+                found.append(entry)
+        return found, subdirs
+
+    if workers > 1:
+        readers = _dir_readers(workers)
+        readers.put(top, 1)
+        try:
+            while readers.outstanding:
+                path, depth, entries, error = readers.get()
+                if error is not None:
+                    if onerror is not None:
+                        onerror(error)
+                    continue
+                found, subdirs = select(entries, depth)
+                # keep the threads busy while the entries are used
+                for subdir, subdepth in subdirs:
+                    readers.put(subdir, subdepth)
+                for entry in found:
+                    yield entry
+        finally:
+            readers.stop()
+        return
+
+    stack = [(top, 1)]
+    while stack:
+        path, depth = stack.pop()
+        try:
+            entries = _list_entries(path)
+        except OSError, e:
+            if onerror is not None:
+                onerror(e)
+            continue
+        found, subdirs = select(entries, depth)
+        for entry in found:
+            yield entry
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+
+def du(top, depth=0, apparent=False, exclude=None, workers=1):
+    ''' Disk usage of a directory tree, like ``du``. Files with several
+    hard links are only counted once.
+
+    :arg depth: Also sum up the directories this many levels below 
+                ``top``, like ``du -d``
+    :arg apparent: Count the size of the files instead of the disk blocks 
+                   used, like ``du --apparent-size``
+    :arg exclude: Shell patterns of files and directories to leave out, 
+                  see :func:`walk`
+    :arg workers: Number of threads reading directories, see :func:`walk`
+    :returns: Dictionary with the bytes used by ``top`` and the 
+              directories down to ``depth``
+    '''
+    def usage(st):
+        if apparent:
+            return st.st_size
+        return st.st_blocks * 512
+
+    totals = {top: usage(os.lstat(top))}
+    linked = set()
+    prefix = len(top.rstrip(os.sep)) + 1
+
+    for entry in walk(top, exclude=exclude, workers=workers):
+        st = entry.stat(follow_symlinks=False)
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if st.st_nlink > 1 and not is_dir:
+            if (st.st_dev, st.st_ino) in linked:
+                continue
+            linked.add((st.st_dev, st.st_ino))
+        size = usage(st)
+        totals[top] += size
+        if not depth:
+            continue
+
+        # add to the directories within depth holding the entry, and the 
+        # entry itself if it is such a directory
+        parts = entry.path[prefix:].split(os.sep)
+        if not is_dir:
+            parts.pop()
+        path = top
+        for part in parts[:depth]:
+            path = os.path.join(path, part)
+            totals[path] = totals.get(path, 0) + size
+    return totals
+
+
+def expandpath(path):
+    ''' Clean up path.
+    Expands environment vars like $JAVA_HOME, does tilde expansion for paths 
+    like "~/.bashrc" and normalizes the path
+    '''
+    return os.path.normpath(os.path.expanduser(os.path.expandvars(path)))
+
+    
+
+def chown(path, owner, group=None):
+    ''' Change owner and group of a file or directory.
+
+    If owner or group is None it is left unchanged. If both are set to None
+    this function does nothing.
+
+    If you use username or groupname that user or group must exist on the
+    current system.
+
+    :arg owner: Uid or username of the new owner. 
+    :arg group: Gid or groupname of the new owner. 
+    '''
+    
+
+    if owner is None:
+        uid = -1    # dont modify
+    elif isinstance(owner, int):
+        uid = owner
+    else: 
+        # convert username to uid
+        uid = pwd.getpwnam(owner).pw_uid
+
+    if group is None:
+        gid = -1    # dont modify
+    elif isinstance(group, int):
+        gid = group
+    else: 
+        # convert group name to gid
+        gid = grp.getgrnam(group).gr_gid
+
+    log.debug('Chowning "{}" to uid={} and gid={}', path, uid, gid)
+    os.chown(path, uid, gid)
+
+def owner(path, uid=False):
+    ''' Return username that owns the file or directory.
+
+    :arg uid: If True return the uid as an integer
+    '''
+    st = os.lstat(path)
+    uid = st.st_uid
+    if uid:
+        return uid
+    return pwd.getpwuid(uid).pw_name
+
+def group(path, gid=False):
+    ''' Return the name of the group that owns the file or directory.
+
+    :arg gid: If True return the gid as an integer
+    '''
+    st = os.lstat(path)
+    gid = st.st_gid
+    if gid:
+        return gid
+    return grp.getgrgid(gid).gr_name
+    
+def mode(path):
+    ''' Permission mode of the file or directory.
+
+    :returns: octal representation of the mode, ie 0644
+    '''
+    st = os.lstat(path)
+    return oct(stat.S_IMODE(st.st_mode))
+    
+
+class RemoveStats(object):
+    ''' What :func:`rmtree` removed.
+
+    .. attribute:: files, dirs
+
+       Number of files and directories removed, links count as files
+
+    .. attribute:: bytes
+
+       Bytes of disk freed, files with other hard links are not counted
+
+    .. attribute:: errors
+
+       List of (path, :exc:`OSError`) for what could not be removed
+    '''
+
+    def __init__(self):
+        self.files = self.dirs = self.bytes = 0
+        self.errors = []
+
+    def __repr__(self):
+        return 'RemoveStats(files=%d, dirs=%d, bytes=%d, errors=%d)' % (
+                self.files, self.dirs, self.bytes, len(self.errors))
+
+
+class _rate_limit(object):
+    ''' Spaces out calls to :meth:`wait` to at most ``rate`` a second over
+    all threads '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            now = time.time()
+            at = max(self.next, now)
+            self.next = at + self.interval
+        finally:
+            self._lock.release()
+        if at > now:
+            time.sleep(at - now)
+
+
+def rmtree(path, force=False, workers=1, rate=None):
+    ''' Removes a directory and everything below it. 
+
+    Everything that can be removed is removed, errors do not stop the 
+    removal of the rest of the tree. Running it again after a failure 
+    continues where it stopped. Directories are read and files removed 
+    by path with ``workers`` threads::
+
+        stats = sy.path.rmtree('/export/cache', workers=8, rate=5000)
+        log.info('Freed {} bytes in {} files', stats.bytes, stats.files)
+
+    :arg force: Do not raise on errors, like rm -rf
+    :arg workers: Number of threads removing files, more than one mostly 
+                  helps on network filesystems and with many directories
+    :arg rate: Remove at most this many files a second, to not take all
+               the I/O capacity on a busy host. None or 0 is no limit
+    :returns: :class:`RemoveStats` with what was removed and the errors
+    :raises: The first :exc:`OSError` after removing everything else, 
+             unless ``force``
+    '''
+    stats = RemoveStats()
+    try:
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise OSError(errno.ENOTDIR, 'Not a directory', path)
+    except OSError, e:
+        stats.errors.append((path, e))
+    else:
+        remover = _tree_remover(stats, _rate_limit(rate) if rate else None)
+        remover.run(path, workers)
+
+    if stats.errors:
+        for failed, error in stats.errors:
+            log.debug('Failed to remove "{}": {}', failed, error)
+        if not force:
+            raise stats.errors[0][1]
+    return stats
+
+
+class _tree_remover(object):
+    ''' Removes a directory tree with a pool of threads, one directory 
+    at a time. A directory is removed when its files are and all its 
+    subdirectories have been removed.
+    '''
+
+    def __init__(self, stats, limit):
+        self.stats = stats
+        self.limit = limit
+        # path -> [subdirectories left, parent, failed]
+        self.dirs = {}
+        self._lock = threading.Lock()
+        self._tasks = Queue.Queue()
+
+    def run(self, top, workers):
+        self.dirs[top] = [None, None, False]
+        self._tasks.put(top)
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='sy.path rmtree')
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        self._tasks.join()
+        for thread in threads:
+            self._tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            path = self._tasks.get()
+            if path is None:
+                return
+            try:
+                self._remove_dir(path)
+            except Exception, e:
+                self._error(path, e)
+            self._tasks.task_done()
+
+    def _error(self, path, error):
+        self._lock.acquire()
+        try:
+            self.stats.errors.append((path, error))
+        finally:
+            self._lock.release()
+
+    def _remove_dir(self, path):
+        ''' Remove the files in ``path`` and queue the subdirectories '''
+        files = freed = 0
+        failed = False
+        subdirs = []
+        try:
+            files, freed, failed = self._unlink(path, _list_entries(path), 
+                                                subdirs)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                self._error(path, e)
+                failed = True
+
+        self._lock.acquire()
+        try:
+            self.stats.files += files
+            self.stats.bytes += freed
+            entry = self.dirs[path]
+            entry[0] = len(subdirs)
+            entry[2] = entry[2] or failed
+            for subdir in subdirs:
+                self.dirs[subdir] = [None, path, False]
+        finally:
+            self._lock.release()
+
+        for subdir in subdirs:
+            self._tasks.put(subdir)
+        if not subdirs:
+            self._finish(path)
+
+    def _unlink(self, path, entries, subdirs):
+        files = freed = 0
+        failed = False
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(os.path.join(path, entry.name))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if self.limit is not None:
+                    self.limit.wait()
+                os.unlink(entry.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self._error(os.path.join(path, entry.name), e)
+                    failed = True
+                continue
+            files += 1
+            if st.st_nlink == 1:
+                freed += st.st_blocks * 512
+        return files, freed, failed
+
+    def _finish(self, path):
+        ''' Remove the empty directory ``path`` and the parents that are 
+        done '''
+        while path is not None:
+            self._lock.acquire()
+            try:
+                left, parent, failed = self.dirs.pop(path)
+            finally:
+                self._lock.release()
+
+            if not failed:
+                try:
+                    os.rmdir(path)
+                    self._lock.acquire()
+                    self.stats.dirs += 1
+                    self._lock.release()
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        self._error(path, e)
+                        failed = True
+
+            if parent is None:
+                return
+            self._lock.acquire()
+            try:
+                entry = self.dirs[parent]
+                entry[0] -= 1
+                entry[2] = entry[2] or failed
+                if entry[0]:
+                    return
+            finally:
+                self._lock.release()
+            path = parent
+
+#def directory_tail(path, files='*', dirs='', method='timestamp'):
+    #pass
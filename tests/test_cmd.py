@@ -1,4 +1,8 @@
 from nose.tools import assert_raises, eq_
+from nose.plugins.skip import SkipTest
+import os
+import time
+import signal
 import sy.cmd
 
 echocmd = 'echo stdout; echo stderr > /dev/fd/2'
@@ -79,6 +83,40 @@ def test_run_timeout():
         eq_(e.timeout, 1)
         eq_(e.cmd, cmd)
 
+def test_run_timeout_near_zero():
+    # the deadline has passed before the output is read
+    start = time.time()
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 
+                  'sleep 2; echo done', timeout=0.0005)
+    assert time.time() - start < 1
+
+def test_run_timeout_zero():
+    # 0 has already passed, None is no timeout
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 'echo hi', 
+                  timeout=0)
+    assert_raises(sy.cmd.CommandTimeoutError, list, 
+                  sy.cmd.iterlines('echo hi', timeout=0))
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.pipeline, 
+                  ['echo', 'hi'], ['cat'], timeout=0)
+    session = sy.cmd.Session()
+    try:
+        assert_raises(sy.cmd.CommandTimeoutError, session.run, 'echo hi', 
+                      timeout=0)
+    finally:
+        session.close()
+    eq_(sy.cmd.run_many([('sleep 1', [], {'timeout': 0})])[0][0], None)
+    eq_(sy.cmd.run('echo hi', timeout=None), (0, 'hi\n', ''))
+
+def test_timeout_endless_output():
+    start = time.time()
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 'yes', 
+                  timeout=0.3, max_output=1024)
+    assert_raises(sy.cmd.CommandTimeoutError, list, 
+                  sy.cmd.iterlines('yes', timeout=0.3))
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.pipeline, 
+                  ['yes'], ['cat'], timeout=0.3, stream=lambda chunk: None)
+    assert time.time() - start < 5
+
 def test_run_timeout_block():
     errcmd = lambda: sy.cmd.run('cat', timeout=1)
     assert_raises(sy.cmd.CommandTimeoutError, errcmd)
@@ -122,3 +160,518 @@ def test_do_bad_keyword():
     except AssertionError, e:
         eq_(str(e), 'Unknown keyword arg passed to run: bad_keyword')
 
+
+# _______________________________________________________________________
+# Pool and run_many
+
+def test_run_many_ordered():
+    results = sy.cmd.run_many([
+        ('sleep 0.3; echo {}', ['first']),
+        ('echo {}', ['second']),
+        ('%s; exit 2' % echocmd,),
+    ], size=3)
+    eq_(results, [(0, 'first\n', ''), 
+                  (0, 'second\n', ''), 
+                  (2, 'stdout\n', 'stderr\n')])
+
+def test_run_many_completion_order():
+    results = sy.cmd.run_many([
+        ('sleep 0.3; echo {}', ['first']),
+        ('echo {}', ['second']),
+    ], size=2, ordered=False)
+    eq_([out for _, out, _ in results], ['second\n', 'first\n'])
+
+def test_pool_concurrent():
+    pool = sy.cmd.Pool(size=4)
+    for i in range(4):
+        pool.add('sleep 0.5')
+    start = time.time()
+    eq_([status for status, _, _ in pool.run()], [0] * 4)
+    assert time.time() - start < 1.5, 'Jobs should run concurrently'
+
+def test_pool_timeout():
+    pool = sy.cmd.Pool(size=2)
+    pool.add('echo first; sleep 5', timeout=1)
+    pool.add('echo {}', 'second')
+    eq_(pool.run(), [(None, 'first\n', ''), (0, 'second\n', '')])
+
+def test_pool_input_stream():
+    chunks = []
+    pool = sy.cmd.Pool(size=3)
+    pool.add('wc -c', input='x' * 200000)
+    pool.add('cat', input=iter(['a', 'b']))
+    pool.add('echo streamed', stream=chunks.append)
+    eq_(pool.run(), [(0, '200000\n', ''), (0, 'ab', ''), (0, '', '')])
+    eq_(''.join(chunks), 'streamed\n')
+
+def test_pool_input_timeout():
+    pool = sy.cmd.Pool()
+    pool.add('sleep 5', input='x' * 200000, timeout=0.3)
+    eq_(pool.run(), [(None, '', '')])
+
+# _______________________________________________________________________
+# streaming
+
+def test_iterlines():
+    lines = sy.cmd.iterlines('echo first; sleep 0.1; printf "second\\nthird"')
+    eq_(list(lines), ['first', 'second', 'third'])
+
+def test_iterlines_fail():
+    try:
+        list(sy.cmd.iterlines('%s; exit 3' % echocmd))
+        assert False, 'Bad exit status should raise'
+    except sy.cmd.CommandError, e:
+        eq_(e.status, 3)
+        eq_(e.err, 'stderr\n')
+
+def test_iterlines_err_tail():
+    cmd = 'yes error | head -c %d >&2; exit 1' % (sy.cmd.STREAM_ERR_TAIL * 4)
+    try:
+        list(sy.cmd.iterlines(cmd))
+        assert False, 'Bad exit status should raise'
+    except sy.cmd.CommandError, e:
+        eq_(len(e.err), sy.cmd.STREAM_ERR_TAIL)
+
+def test_iterlines_timeout():
+    lines = sy.cmd.iterlines('echo first; sleep 5', timeout=1)
+    eq_(lines.next(), 'first')
+    assert_raises(sy.cmd.CommandTimeoutError, lines.next)
+
+def test_run_stream():
+    chunks = []
+    status, out, err = sy.cmd.run(echocmd, stream=chunks.append)
+    eq_(status, 0)
+    eq_(''.join(chunks), 'stdout\n')
+    eq_(out, '')
+    eq_(err, 'stderr\n')
+
+# _______________________________________________________________________
+# output limits
+
+bigcmd = 'yes 0123456789 | head -c 100000'
+
+def test_run_big_output():
+    status, out, err = sy.cmd.run(bigcmd)
+    eq_(len(out), 100000)
+    eq_(out, '0123456789\n' * 9090 + '0123456789')
+
+def test_run_max_output_head():
+    status, out, err = sy.cmd.run(bigcmd, max_output=15)
+    eq_(status, 0)
+    eq_(out, '0123456789\n0123')
+
+def test_run_max_output_tail():
+    status, out, err = sy.cmd.run(bigcmd, max_output=15, truncate='tail')
+    eq_(out, '6789\n0123456789')
+
+def test_run_max_output_raise():
+    try:
+        sy.cmd.run('yes', max_output=1000, truncate='raise')
+        assert False, 'Too much output should raise'
+    except sy.cmd.CommandOutputError, e:
+        eq_(e.max_output, 1000)
+        eq_(len(e.out), 1000)
+
+# _______________________________________________________________________
+# spawn methods
+
+def test_run_spawn_fork():
+    status, out, err = sy.cmd.run(echocmd, spawn='fork')
+    eq_((status, out, err), (0, 'stdout\n', 'stderr\n'))
+
+def test_run_spawn_posix_spawn():
+    if not sy.cmd._libc:
+        assert_raises(AssertionError, sy.cmd.run, echocmd, spawn='posix_spawn')
+        return
+    status, out, err = sy.cmd.run('%s; exit 2' % echocmd, spawn='posix_spawn')
+    eq_((status, out, err), (2, 'stdout\n', 'stderr\n'))
+    status, out, err = sy.cmd.run(['echo', 'argv'], spawn='posix_spawn')
+    eq_((status, out), (0, 'argv\n'))
+    status, out, err = sy.cmd.run('cat', input='in', spawn='posix_spawn')
+    eq_((status, out), (0, 'in'))
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 'sleep 5', 
+                  timeout=1, spawn='posix_spawn')
+
+def test_run_spawn_posix_spawn_pipeline():
+    if not sy.cmd._libc:
+        raise SkipTest('posix_spawn is not available')
+    status, out, err = sy.cmd.pipeline(['echo', 'piped'], ['cat'], 
+                                       spawn='posix_spawn')
+    eq_(out, 'piped\n')
+
+def test_run_spawn_missing():
+    # posix_spawn falls back to fork so both fail the same way
+    results = [sy.cmd.run(['/dev/null'], spawn=spawn)[0]
+               for spawn in ('fork', 'posix_spawn')]
+    eq_(results[0], results[1])
+    assert results[0] != 0
+
+def test_run_spawn_bad():
+    fds = len(os.listdir('/dev/fd'))
+    assert_raises(AssertionError, sy.cmd.run, echocmd, spawn='clone')
+    eq_(len(os.listdir('/dev/fd')), fds)
+
+# _______________________________________________________________________
+# Session
+
+def test_session_run():
+    session = sy.cmd.Session()
+    eq_(session.run('%s; false' % echocmd), (1, 'stdout\n', 'stderr\n'))
+    eq_(session.run('printf {}', 'no newline'), (0, 'no newline', ''))
+    eq_(session.run('true'), (0, '', ''))
+    session.close()
+
+def test_session_state():
+    session = sy.cmd.Session()
+    session.do('cd /etc; FOO=bar')
+    eq_(session.do('pwd; echo $FOO'), ('/etc\nbar\n', ''))
+    session.close()
+
+def test_session_exit():
+    session = sy.cmd.Session()
+    eq_(session.run('echo bye; exit 4'), (4, 'bye\n', ''))
+    eq_(session.run('echo hello'), (0, 'hello\n', ''))
+    session.close()
+
+def test_session_timeout():
+    session = sy.cmd.Session()
+    session.do('cd /etc')
+    try:
+        session.run('echo first; sleep 5', timeout=1)
+        assert False, 'There should be a timeout'
+    except sy.cmd.CommandTimeoutError, e:
+        eq_(e.out, 'first\n')
+    # a new shell is started
+    eq_(session.do('pwd')[0], os.getcwd() + '\n')
+    session.close()
+
+def test_session_do_fail():
+    session = sy.cmd.Session()
+    assert_raises(sy.cmd.CommandError, session.do, 'exit 1')
+    session.close()
+
+# _______________________________________________________________________
+# argv commands
+
+def test_run_argv():
+    status, out, err = sy.cmd.run(['echo', 'a b', '$HOME', ';', '{}'])
+    eq_((status, out, err), (0, 'a b $HOME ; {}\n', ''))
+
+def test_run_argv_path():
+    eq_(sy.cmd.run(['/bin/ls', '-d', '/tmp']), (0, '/tmp\n', ''))
+
+def test_run_argv_args():
+    assert_raises(AssertionError, sy.cmd.run, ['ls', '{}'], '/tmp')
+
+def test_run_argv_not_found():
+    assert_raises(sy.cmd.CommandError, sy.cmd.run, ['sy_no_such_command'])
+
+def test_do_argv_fail():
+    try:
+        sy.cmd.do(['ls', '/sy no such file'])
+        assert False, 'Bad exit status should fail'
+    except sy.cmd.CommandError, e:
+        eq_(e.cmd, 'ls /sy\\ no\\ such\\ file')
+        assert e.status != 0
+
+# _______________________________________________________________________
+# pipeline
+
+def test_pipeline():
+    statuses, out, errs = sy.cmd.pipeline(['printf', 'b\\na\\nc\\n'], 
+                                          ['sort'], ['head', '-2'])
+    eq_(statuses, [0, 0, 0])
+    eq_(out, 'a\nb\n')
+    eq_(errs, ['', '', ''])
+
+def test_pipeline_status_and_stderr():
+    statuses, out, errs = sy.cmd.pipeline(['ls', '/sy_no_such_file'],
+                                          '%s; exit 3' % echocmd)
+    assert statuses[0] != 0
+    eq_(statuses[1], 3)
+    eq_(out, 'stdout\n')
+    assert 'sy_no_such_file' in errs[0]
+    eq_(errs[1], 'stderr\n')
+
+def test_pipeline_closed_pipe():
+    # yes is killed by SIGPIPE like in a shell instead of failing on EPIPE
+    for spawn in ('fork', 'posix_spawn'):
+        if spawn == 'posix_spawn' and not sy.cmd._libc:
+            continue
+        statuses, out, errs = sy.cmd.pipeline(['yes'], ['head', '-1'], 
+                                              spawn=spawn)
+        eq_(statuses, [0, 0])
+        eq_(out, 'y\n')
+        eq_(errs, ['', ''])
+
+def test_run_closed_pipe():
+    eq_(sy.cmd.run('yes | head -1', spawn='fork'), (0, 'y\n', ''))
+
+def test_pipeline_timeout():
+    start = time.time()
+    try:
+        sy.cmd.pipeline(['echo', 'first'], ['sleep', '5'], ['cat'], timeout=1)
+        assert False, 'There should be a timeout'
+    except sy.cmd.CommandTimeoutError, e:
+        eq_(e.cmd, 'echo first | sleep 5 | cat')
+    assert time.time() - start < 3, 'All stages should be killed'
+
+def test_pipeline_stream():
+    chunks = []
+    statuses, out, errs = sy.cmd.pipeline(['echo', 'a'], ['cat'], 
+                                          stream=chunks.append)
+    eq_(''.join(chunks), 'a\n')
+    eq_(out, '')
+
+# _______________________________________________________________________
+# poll loop
+
+def test_run_timeout_trickle():
+    start = time.time()
+    cmd = 'for i in 1 2 3 4 5 6; do echo $i; sleep 0.9; done'
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, cmd, timeout=1)
+    assert time.time() - start < 1.5, 'Timeout should be a deadline'
+
+def test_run_high_fds():
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 1200:
+        raise SkipTest('Can not open enough files to test high file '
+                       'descriptors')
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1200), hard))
+    fds = [os.open('/dev/null', os.O_RDONLY) for i in range(1100)]
+    try:
+        eq_(sy.cmd.run(echocmd), (0, 'stdout\n', 'stderr\n'))
+        eq_(sy.cmd.run_many([(echocmd,)]), [(0, 'stdout\n', 'stderr\n')])
+    finally:
+        map(os.close, fds)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+# _______________________________________________________________________
+# cached_run
+
+def test_cached_run():
+    sy.cmd.cache.clear()
+    cmd = 'date +%N; echo {}'
+    first = sy.cmd.cached_run(cmd, 'a')
+    eq_(sy.cmd.cached_run(cmd, 'a'), first)
+    assert sy.cmd.cached_run(cmd, 'b') != first
+    eq_((sy.cmd.cache.hits, sy.cmd.cache.misses), (1, 2))
+
+    sy.cmd.cache.invalidate(cmd, 'a')
+    assert sy.cmd.cached_run(cmd, 'a') != first
+    eq_(sy.cmd.cache.misses, 3)
+
+def test_cached_run_ttl():
+    sy.cmd.cache.clear()
+    first = sy.cmd.cached_run('date +%N', ttl=0.2)
+    time.sleep(0.3)
+    assert sy.cmd.cached_run('date +%N') != first
+
+def test_run_cache_lru():
+    cache = sy.cmd.RunCache(maxsize=2)
+    cache.run('echo {}', 'a')
+    cache.run('echo {}', 'b')
+    cache.run('echo {}', 'a')
+    cache.run('echo {}', 'c')
+    eq_(len(cache), 2)
+    cache.run('echo {}', 'a')
+    eq_(cache.hits, 2)
+    cache.run('echo {}', 'b')
+    eq_(cache.misses, 4)
+
+# _______________________________________________________________________
+# stats hooks
+
+def test_stats_hook():
+    stats = []
+    sy.cmd.add_hook(stats.append)
+    try:
+        sy.cmd.run('echo {}; echo err >&2', 'hello')
+        sy.cmd.run(['true'])
+        sy.cmd.pipeline(['echo', 'a'], ['cat'])
+        list(sy.cmd.iterlines('echo a'))
+        sy.cmd.run_many([('exit 3',)])
+    finally:
+        sy.cmd.remove_hook(stats.append)
+
+    eq_([s.template for s in stats], 
+        ['echo {}; echo err >&2', 'true', 'echo | cat', 'echo a', 'exit 3'])
+    eq_([s.status for s in stats], [0, 0, [0, 0], 0, 3])
+    eq_((stats[0].outbytes, stats[0].errbytes), (6, 4))
+    eq_(stats[0].cmd, "echo hello; echo err >&2")
+    assert stats[0].wall > 0
+    assert stats[0].maxrss > 0
+    eq_(stats[2].outbytes, 2)
+
+def test_stats_hook_timeout():
+    stats = []
+    sy.cmd.add_hook(stats.append)
+    try:
+        assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 'sleep 5', 
+                      timeout=0.2)
+    finally:
+        sy.cmd.remove_hook(stats.append)
+    eq_(len(stats), 1)
+    assert stats[0].timed_out
+    eq_(stats[0].status, None)
+
+def test_stats_hook_error_ignored():
+    def broken(stats):
+        raise ValueError('broken')
+    sy.cmd.add_hook(broken)
+    try:
+        eq_(sy.cmd.run('echo a'), (0, 'a\n', ''))
+    finally:
+        sy.cmd.remove_hook(broken)
+
+def test_profile():
+    profile = sy.cmd.Profile()
+    sy.cmd.add_hook(profile)
+    try:
+        for arg in ('a', 'b', 'c'):
+            sy.cmd.run('echo {}', arg)
+        sy.cmd.run('true')
+    finally:
+        sy.cmd.remove_hook(profile)
+    eq_(profile.templates['echo {}']['count'], 3)
+    eq_(profile.templates['echo {}']['outbytes'], 6)
+    eq_(profile.templates['true']['count'], 1)
+    report = profile.report().splitlines()
+    eq_(len(report), 3)
+    assert report[1].endswith('echo {}') or report[2].endswith('echo {}')
+
+def test_stats_hook_session():
+    stats = []
+    sy.cmd.add_hook(stats.append)
+    try:
+        session = sy.cmd.Session()
+        session.run('echo {}', 'a')
+        session.run('exit 3')
+        assert_raises(sy.cmd.CommandTimeoutError, session.run, 'sleep 5', 
+                      timeout=0.2)
+        session.close()
+    finally:
+        sy.cmd.remove_hook(stats.append)
+    eq_([s.template for s in stats], ['echo {}', 'exit 3', 'sleep 5'])
+    eq_([s.status for s in stats], [0, 3, None])
+    eq_([s.timed_out for s in stats], [False, False, True])
+    eq_(stats[0].cmd, 'echo a')
+    eq_(stats[0].outbytes, 2)
+    assert stats[2].wall >= 0.1
+
+# _______________________________________________________________________
+# find
+
+def test_find():
+    path = sy.cmd.find('sh')
+    assert path.endswith('/sh')
+    assert os.access(path, os.X_OK)
+    assert_raises(sy.cmd.CommandError, sy.cmd.find, 'no-such-command-xyz')
+
+def test_find_new_command():
+    import shutil, tempfile
+    tmpdir = tempfile.mkdtemp()
+    oldpath = os.environ.get('PATH', '')
+    os.environ['PATH'] = tmpdir + ':' + oldpath
+    try:
+        assert_raises(sy.cmd.CommandError, sy.cmd.find, 'sy-test-cmd')
+        cmd = os.path.join(tmpdir, 'sy-test-cmd')
+        open(cmd, 'w').write('#!/bin/sh\necho found\n')
+        os.chmod(cmd, 0755)
+        eq_(sy.cmd.find('sy-test-cmd'), cmd)
+        eq_(sy.cmd.run(['sy-test-cmd']), (0, 'found\n', ''))
+        os.remove(cmd)
+        assert_raises(sy.cmd.CommandError, sy.cmd.find, 'sy-test-cmd')
+    finally:
+        os.environ['PATH'] = oldpath
+        shutil.rmtree(tmpdir)
+    assert_raises(sy.cmd.CommandError, sy.cmd.find, 'sy-test-cmd')
+
+# _______________________________________________________________________
+# input
+
+def test_run_input():
+    eq_(sy.cmd.run('tr a-z A-Z', input='hello\n'), (0, 'HELLO\n', ''))
+    eq_(sy.cmd.run(['cat'], input=iter(['a', '', 'b\n'])), (0, 'ab\n', ''))
+    eq_(sy.cmd.do('wc -c', input=''), ('0\n', ''))
+
+def test_run_input_file():
+    import tempfile
+    tmp = tempfile.TemporaryFile()
+    tmp.write('line\n' * 1000)
+    tmp.seek(0)
+    eq_(sy.cmd.outlines('sort -u', input=tmp), ['line'])
+
+def test_run_input_large():
+    # more than the pipe buffers in both directions, deadlocks if stdin is
+    # written before stdout is read
+    data = 'x' * (4 * 1024 * 1024)
+    status, out, err = sy.cmd.run('cat', input=data, timeout=10)
+    eq_(status, 0)
+    eq_(len(out), len(data))
+
+def test_run_input_not_read():
+    eq_(sy.cmd.run('echo done', input='x' * (1024 * 1024), timeout=10), 
+        (0, 'done\n', ''))
+
+def test_run_input_timeout():
+    def forever():
+        while True:
+            yield 'x' * 1024
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 'sleep 5', 
+                  input=forever(), timeout=0.5)
+
+# _______________________________________________________________________
+# killing
+
+def test_run_timeout_ignores_term():
+    ladder = sy.cmd.KILL_LADDER
+    sy.cmd.KILL_LADDER = ((signal.SIGTERM, 0.5), (signal.SIGKILL, 1))
+    try:
+        start = time.time()
+        assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 
+                      'trap "" TERM; while :; do sleep 0.1; done', 
+                      timeout=0.5)
+        assert time.time() - start < 3, 'Should be killed with SIGKILL'
+    finally:
+        sy.cmd.KILL_LADDER = ladder
+
+def test_run_timeout_closed_output():
+    # exits the read loop at end of file but must not wait forever
+    start = time.time()
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.run, 
+                  'exec >&- 2>&-; sleep 30', timeout=0.5)
+    assert time.time() - start < 5
+
+def test_pipeline_timeout_closed_output():
+    start = time.time()
+    assert_raises(sy.cmd.CommandTimeoutError, sy.cmd.pipeline, 
+                  'exec >&- 2>&-; sleep 30', ['cat'], timeout=0.5)
+    assert time.time() - start < 5
+
+def test_pool_closed_output():
+    # a job that closes its output but keeps running must not hold up
+    # the others, neither waiting for it nor killing it
+    pool = sy.cmd.Pool(size=3)
+    pool.add('exec >&- 2>&-; sleep 2')
+    pool.add('exec >&- 2>&-; trap "" TERM; sleep 30', timeout=0.3)
+    pool.add('sleep 0.1; echo fast')
+    start = time.time()
+    results = pool.completed()
+    eq_(results.next(), (2, (0, 'fast\n', '')))
+    assert time.time() - start < 1
+    eq_(results.next(), (1, (None, '', '')))
+    assert time.time() - start < 1
+    eq_(results.next(), (0, (0, '', '')))
+
+def test_reaper():
+    import subprocess
+    pid = subprocess.Popen(['sleep', '0.1']).pid
+    sy.cmd._abandoned.adopt([pid])
+    for i in range(50):
+        if not len(sy.cmd._abandoned):
+            break
+        time.sleep(0.1)
+    eq_(len(sy.cmd._abandoned), 0)
+    assert_raises(OSError, os.waitpid, pid, os.WNOHANG)
@@ -0,0 +1,109 @@
+from nose.tools import assert_raises, eq_
+from nose.plugins.skip import SkipTest
+
+try:
+    import sy.cmd.aio
+    from sy.cmd.aio import asyncio
+except ImportError:
+    raise SkipTest('asyncio or trollius is not installed')
+
+import sy.cmd
+
+echocmd = 'echo stdout; echo stderr > /dev/fd/2'
+
+
+class TestAio(object):
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.get_child_watcher().attach_loop(self.loop)
+
+    def teardown(self):
+        asyncio.get_child_watcher().attach_loop(None)
+        self.loop.close()
+
+    def _wait(self, *futures):
+        return self.loop.run_until_complete(
+                    asyncio.gather(loop=self.loop, *futures))
+
+    def test_run(self):
+        result, = self._wait(sy.cmd.aio.run('%s; exit 3' % echocmd, 
+                                            loop=self.loop))
+        eq_(result, (3, 'stdout\n', 'stderr\n'))
+
+    def test_run_concurrent(self):
+        futures = [sy.cmd.aio.run('sleep 0.5; echo {}', str(i), loop=self.loop)
+                   for i in range(50)]
+        start = self.loop.time()
+        results = self._wait(*futures)
+        assert self.loop.time() - start < 5, 'Commands should run concurrently'
+        eq_([out for _, out, _ in results], 
+            ['%d\n' % i for i in range(50)])
+
+    def test_run_timeout(self):
+        future = sy.cmd.aio.run('echo first; sleep 5', timeout=1, 
+                                loop=self.loop)
+        try:
+            self._wait(future)
+            assert False, 'There should be a timeout'
+        except sy.cmd.CommandTimeoutError, e:
+            eq_(e.out, 'first\n')
+            eq_(e.timeout, 1)
+
+    def test_do(self):
+        result, = self._wait(sy.cmd.aio.do(echocmd, loop=self.loop))
+        eq_(result, ('stdout\n', 'stderr\n'))
+
+    def test_do_fail(self):
+        future = sy.cmd.aio.do(echocmd, expect=1, loop=self.loop)
+        try:
+            self._wait(future)
+            assert False, 'Bad exit status should fail'
+        except sy.cmd.CommandError, e:
+            eq_(str(e), 
+                'Command "%s" did not exit with status 1: stderr' % echocmd)
+            eq_(e.status, 0)
+
+    def test_outlines(self):
+        result, = self._wait(sy.cmd.aio.outlines('echo {}; echo {}', 'a', 'b', 
+                                                 loop=self.loop))
+        eq_(result, ['a', 'b'])
+
+    def test_cancel(self):
+        future = sy.cmd.aio.run('sleep 5', loop=self.loop)
+        self.loop.call_later(0.2, future.cancel)
+        start = self.loop.time()
+        assert_raises(asyncio.CancelledError, self._wait, future)
+        assert self.loop.time() - start < 2
+
+    def test_run_input_stream(self):
+        chunks = []
+        result, streamed = self._wait(
+                sy.cmd.aio.run('wc -c', input='x' * 200000, loop=self.loop),
+                sy.cmd.aio.run('echo {}', 'a', stream=chunks.append, 
+                               loop=self.loop))
+        eq_(result, (0, '200000\n', ''))
+        eq_(streamed, (0, '', ''))
+        eq_(''.join(chunks), 'a\n')
+
+    def test_run_signaled(self):
+        # the status of a killed command is 0 like with sy.cmd.run
+        result, = self._wait(sy.cmd.aio.run('echo a; kill -9 $$', 
+                                            loop=self.loop))
+        eq_(result, (0, 'a\n', ''))
+
+    def test_run_many_quick(self):
+        futures = [sy.cmd.aio.run('true', loop=self.loop) 
+                   for i in range(200)]
+        start = self.loop.time()
+        eq_(self._wait(*futures), [(0, '', '')] * 200)
+        assert self.loop.time() - start < 5
+
+    def test_stats_hook(self):
+        stats = []
+        sy.cmd.add_hook(stats.append)
+        try:
+            self._wait(sy.cmd.aio.run('echo {}', 'a', loop=self.loop))
+        finally:
+            sy.cmd.remove_hook(stats.append)
+        eq_([(s.template, s.status, s.outbytes) for s in stats], 
+            [('echo {}', 0, 2)])
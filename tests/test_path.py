@@ -2,10 +2,19 @@ import codecs
 import re
 import os, os.path
 import tempfile
+import hashlib
+import errno
+import time
+import threading
+import tarfile
+import json
+from StringIO import StringIO
+from nose.plugins.skip import SkipTest
 from nose.tools import eq_, with_setup, assert_raises
 
 
 import sy.path
+import sy.exception
 import util
 
 
@@ -63,6 +72,12 @@ def test_encoding():
         eq_(sy.path.slurp(p, encoding=enc), 2*expected_nohang)
         eq_(sy.path.lines(p, encoding=enc), 2*expected_lines_retain_nohang)
         eq_(sy.path.lines(p, encoding=enc, newline=False), 2*expected_lines)
+        eq_(list(sy.path.iterlines(p, encoding=enc)), 
+            2*expected_lines_retain_nohang)
+        eq_(sy.path.head(p, 2, encoding=enc, newline=False), 
+            expected_lines[:2])
+        eq_(sy.path.tail(p, 3, encoding=enc), 
+            expected_lines_retain_nohang[-3:])
 
     test('utf8')
     test('utf-16be')
@@ -105,6 +120,235 @@ def test_dump_newline():
     eq_(sy.path.slurp(p, binary=True), '\r\n')
  
 
+def test_dump_unchanged():
+    p = util.tmppath()
+    assert sy.path.dump(p, 'same\n')
+    before = os.stat(p)
+    assert not sy.path.dump(p, 'same\n')
+    assert not sy.path.append(p, '')
+    eq_(os.stat(p).st_mtime, before.st_mtime)
+    assert sy.path.dump(p, 'samf\n')
+    assert sy.path.append(p, 'more\n')
+    eq_(sy.path.slurp(p), 'samf\nmore\n')
+
+def test_copy():
+    src = util.tmppath()
+    dst = util.tmppath()
+    sy.path.dump(src, 'x' * 100000)
+    os.chmod(src, 0640)
+    os.utime(src, (1000, 1000))
+    assert sy.path.copy(src, dst)
+    eq_(sy.path.slurp(dst), 'x' * 100000)
+    eq_(sy.path.mode(dst), '0640')
+    eq_(os.stat(dst).st_mtime, 1000)
+    assert not sy.path.copy(src, dst, skip='mtime')
+    assert not sy.path.copy(src, dst, skip='checksum')
+    assert sy.path.copy(src, dst)
+
+def test_copy_no_preserve_mode():
+    src = util.tmppath()
+    dst = util.tmppath()
+    os.remove(dst)
+    sy.path.dump(src, 'x')
+    os.chmod(src, 0754)
+    umask = os.umask(027)
+    try:
+        assert sy.path.copy(src, dst, preserve=False)
+    finally:
+        os.umask(umask)
+    eq_(sy.path.mode(dst), '0750')
+
+def test_chown_owner_only():
+    p = util.tmppath()
+    st = os.stat(p)
+    sy.path.chown(p, st.st_uid)
+    sy.path.chown(p, None, None)
+    eq_(os.stat(p).st_gid, st.st_gid)
+
+def test_copy_in_kernel():
+    src = util.tmppath()
+    dst = util.tmppath()
+    sy.path.dump(src, 'abc' * 100000)
+    calls = []
+    def copy_file_range(fin, fout, count, offset_src, offset_dst):
+        # copies a little at a time, then fails like across filesystems
+        calls.append(offset_src)
+        if len(calls) > 3:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        data = os.read(fin, 1000)
+        return os.write(fout, data)
+    saved = sy.path._copy_file_range, sy.path._sendfile
+    sy.path._copy_file_range, sy.path._sendfile = copy_file_range, None
+    try:
+        sy.path.copy(src, dst)
+    finally:
+        sy.path._copy_file_range, sy.path._sendfile = saved
+    eq_(calls, [0, 1000, 2000, 3000])
+    eq_(sy.path.slurp(dst), 'abc' * 100000)
+
+def test_sync_tree():
+    src = tempfile.mkdtemp(prefix='test_path')
+    dst = tempfile.mkdtemp(prefix='test_path')
+    try:
+        os.makedirs(os.path.join(src, 'a', 'b'))
+        for i in range(20):
+            sy.path.dump(os.path.join(src, 'a', str(i)), str(i))
+        os.symlink('a', os.path.join(src, 'link'))
+        os.chmod(os.path.join(src, 'a', 'b'), 0700)
+
+        copied = sy.path.sync_tree(src, dst, workers=3)
+        eq_(len(copied), 21)
+        eq_(sy.path.slurp(os.path.join(dst, 'a', '7')), '7')
+        eq_(os.readlink(os.path.join(dst, 'link')), 'a')
+        eq_(sy.path.mode(os.path.join(dst, 'a', 'b')), '0700')
+
+        eq_(sy.path.sync_tree(src, dst), [])
+        sy.path.dump(os.path.join(src, 'a', '7'), 'seven')
+        eq_(sy.path.sync_tree(src, dst, skip='checksum'), ['a/7'])
+    finally:
+        sy.path.rmtree(src)
+        sy.path.rmtree(dst)
+
+def test_sync_tree_type_change():
+    src = tempfile.mkdtemp(prefix='test_path')
+    dst = tempfile.mkdtemp(prefix='test_path')
+    outside = tempfile.mkdtemp(prefix='test_path')
+    try:
+        sy.path.dump(os.path.join(src, 'was_dir'), 'file')
+        os.makedirs(os.path.join(src, 'was_file'))
+        sy.path.dump(os.path.join(src, 'was_file', 'in'), 'in')
+        os.symlink('was_dir', os.path.join(src, 'was_dir_link'))
+        sy.path.dump(os.path.join(src, 'was_link'), 'file')
+
+        os.makedirs(os.path.join(dst, 'was_dir', 'sub'))
+        sy.path.dump(os.path.join(dst, 'was_file'), 'old')
+        os.makedirs(os.path.join(dst, 'was_dir_link'))
+        # never written through
+        os.symlink(outside, os.path.join(dst, 'was_link'))
+
+        sy.path.sync_tree(src, dst)
+        eq_(sy.path.slurp(os.path.join(dst, 'was_dir')), 'file')
+        eq_(sy.path.slurp(os.path.join(dst, 'was_file', 'in')), 'in')
+        eq_(os.readlink(os.path.join(dst, 'was_dir_link')), 'was_dir')
+        assert not os.path.islink(os.path.join(dst, 'was_link'))
+        eq_(sy.path.slurp(os.path.join(dst, 'was_link')), 'file')
+        eq_(os.listdir(outside), [])
+    finally:
+        for d in (src, dst, outside):
+            sy.path.rmtree(d)
+
+class TestWalk(object):
+    def setup(self):
+        self.top = tempfile.mkdtemp(prefix='test_path')
+        for d in ('a/b/c', 'a/skip', 'd'):
+            os.makedirs(os.path.join(self.top, d))
+        for f in ('a/1.txt', 'a/b/2.log', 'a/b/c/3.txt', 'a/skip/4.txt', 
+                  'd/5.txt'):
+            sy.path.dump(os.path.join(self.top, f), f)
+
+    def teardown(self):
+        sy.path.rmtree(self.top)
+
+    def _walk(self, **kwargs):
+        prefix = len(self.top) + 1
+        return sorted(e.path[prefix:] 
+                      for e in sy.path.walk(self.top, **kwargs))
+
+    def test_walk(self):
+        everything = ['a', 'a/1.txt', 'a/b', 'a/b/2.log', 'a/b/c', 
+                      'a/b/c/3.txt', 'a/skip', 'a/skip/4.txt', 'd', 
+                      'd/5.txt']
+        eq_(self._walk(), everything)
+        eq_(self._walk(workers=3), everything)
+        entry = [e for e in sy.path.walk(self.top) if e.name == '5.txt'][0]
+        eq_(entry.stat().st_size, 7)
+        assert entry.is_file() and not entry.is_dir()
+
+    def test_walk_filters(self):
+        eq_(self._walk(include='*.txt', exclude=['skip']), 
+            ['a/1.txt', 'a/b/c/3.txt', 'd/5.txt'])
+        eq_(self._walk(include='a/*/*.txt', workers=2), 
+            ['a/b/c/3.txt', 'a/skip/4.txt'])
+        eq_(self._walk(maxdepth=1), ['a', 'd'])
+        eq_(self._walk(prune=lambda e: e.name == 'b', include='*.*'), 
+            ['a/1.txt', 'a/skip/4.txt', 'd/5.txt'])
+
+    def test_walk_error(self):
+        errors = []
+        eq_(list(sy.path.walk(self.top + '/none', onerror=errors.append)), 
+            [])
+        eq_(errors[0].errno, errno.ENOENT)
+
+    def test_du(self):
+        os.link(os.path.join(self.top, 'a', '1.txt'), 
+                os.path.join(self.top, 'a', 'hard'))
+        sizes = sy.path.du(self.top, depth=1, apparent=True, 
+                           exclude='*.log')
+        dirsize = os.lstat(self.top).st_size
+        eq_(sorted(sizes), [self.top, self.top + '/a', self.top + '/d'])
+        eq_(sizes[self.top + '/d'], dirsize + 7)
+        eq_(sizes[self.top], 
+            dirsize * 6 + len('a/1.txt') + len('a/b/c/3.txt') + 
+            len('a/skip/4.txt') + len('d/5.txt'))
+        assert sy.path.du(self.top, workers=2)[self.top] > 0
+
+def _rmtree_tree():
+    top = tempfile.mkdtemp(prefix='test_path')
+    for i in range(5):
+        os.makedirs(os.path.join(top, str(i), 'sub'))
+        for j in range(4):
+            sy.path.dump(os.path.join(top, str(i), 'sub', str(j)), 'x' * 5000)
+    os.symlink('/etc', os.path.join(top, 'link'))
+    os.link(os.path.join(top, '0', 'sub', '0'), os.path.join(top, 'hard'))
+    return top
+
+def test_rmtree():
+    for workers in (1, 3):
+        top = _rmtree_tree()
+        stats = sy.path.rmtree(top, workers=workers)
+        assert not os.path.exists(top)
+        eq_((stats.files, stats.dirs, stats.errors), (22, 11, []))
+        # the hard linked file is only freed when the last link goes
+        assert stats.bytes >= 19 * 5000
+    assert os.path.exists('/etc/passwd')
+
+def test_rmtree_errors():
+    top = tempfile.mkdtemp(prefix='test_path')
+    os.rmdir(top)
+    assert_raises(OSError, sy.path.rmtree, top)
+    eq_(len(sy.path.rmtree(top, force=True).errors), 1)
+    assert_raises(OSError, sy.path.rmtree, '/etc/passwd')
+
+def test_rmtree_rate():
+    top = _rmtree_tree()
+    start = time.time()
+    eq_(sy.path.rmtree(top, workers=2, rate=100).files, 22)
+    assert time.time() - start >= 0.2
+
+def test_rmtree_rate_zero():
+    # 0 is no limit, not a division by zero
+    top = _rmtree_tree()
+    eq_(sy.path.rmtree(top, rate=0).files, 22)
+    assert not os.path.exists(top)
+
+def test_head_tail():
+    p = util.tmppath()
+    sy.path.dump(p, ''.join('line %d\n' % i for i in range(10000)), 
+                 newline=None)
+    eq_(sy.path.head(p, 2), ['line 0\n', 'line 1\n'])
+    eq_(sy.path.tail(p, 2), ['line 9998\n', 'line 9999\n'])
+    eq_(sy.path.tail(p, 1, newline=False), ['line 9999'])
+    eq_(len(sy.path.tail(p, 20000)), 10000)
+    eq_(sy.path.tail(p, 0), [])
+    eq_(sy.path.head(p, 0), [])
+
+def test_tail_newlines():
+    p = util.tmppath()
+    sy.path.dump(p, 'a\r\nb\rc\nd', newline=None)
+    eq_(sy.path.tail(p, 3), ['b\n', 'c\n', 'd'])
+    eq_(sy.path.tail(p, 3, newline=False), ['b', 'c', 'd'])
+    eq_(list(sy.path.iterlines(p, newline=False)), ['a', 'b', 'c', 'd'])
+
 @with_setup(setup_basic)
 def test_contains_found():
     p = util.tmppath('basic')
@@ -113,6 +357,58 @@ def test_contains_found():
     assert sy.path.contains(p, 'num.er\n')
     assert not sy.path.contains(p, 'people')
 
+@with_setup(setup_basic)
+def test_count_find_all():
+    p = util.tmppath('basic')
+    eq_(sy.path.count(p, 'This line'), 2)
+    eq_(sy.path.find_all(p, 'This line'), [1, 2])
+    eq_(sy.path.find_all(p, re.compile(r'\d')), [2])
+    eq_(sy.path.find_all(p, r'more$'), [1])
+    eq_(sy.path.find_all(p, 'people'), [])
+
+def test_contains_across_lines():
+    # the mapped file must give the same result as line by line
+    p = util.tmppath()
+    sy.path.dump(p, 'first a\nb second\n\n')
+    assert not sy.path.contains(p, r'a\s+b')
+    assert not sy.path.contains(p, 'a\nb')
+    assert sy.path.contains(p, 'a\n')
+    eq_(sy.path.find_all(p, '^'), [1, 2, 3])
+    eq_(sy.path.count(p, r'^\s*$'), 1)
+
+def test_contains_lone_cr():
+    # \r alone is a line break like when reading lines
+    p = util.tmppath()
+    sy.path.dump(p, 'one\rtwo\rthree\r', newline=None)
+    eq_(len(sy.path.lines(p)), 3)
+    eq_(sy.path.find_all(p, 't'), [2, 3])
+    eq_(sy.path.count(p, 't'), 2)
+    assert not sy.path.contains(p, 'one\rtwo')
+    sy.path.dump(p, 'one\r\ntwo\r\nthree\r\n', newline=None)
+    eq_(sy.path.find_all(p, 't'), [2, 3])
+
+def test_contains_empty():
+    p = util.tmppath()
+    sy.path.dump(p, '')
+    assert not sy.path.contains(p, 'a')
+    eq_(sy.path.find_all(p, ''), [])
+
+def test_contains_unmappable():
+    # pipes and files in /proc have no size but do have content
+    fifo = util.tmppath() + '.fifo'
+    os.mkfifo(fifo)
+    try:
+        writer = threading.Thread(target=sy.path.dump, 
+                                  args=(fifo, 'a\nb\na\n'))
+        writer.start()
+        eq_(sy.path.find_all(fifo, 'a'), [1, 3])
+        writer.join()
+    finally:
+        os.remove(fifo)
+
+    if os.path.exists('/proc/self/mounts'):
+        assert sy.path.contains('/proc/self/mounts', 'proc')
+
 @with_setup(setup_basic)
 def test_md5sum():
     p = util.tmppath('basic')
@@ -130,6 +426,36 @@ def test_md5sum():
     ossum, _ = out.split()
     eq_(sy.path.md5sum(p), ossum)
 
+@with_setup(setup_basic)
+def test_checksum():
+    p = util.tmppath('basic')
+    eq_(sy.path.checksum(p, 'sha256'), 
+        hashlib.sha256(sy.path.slurp(p, binary=True)).hexdigest())
+    assert_raises(ValueError, sy.path.checksum, p, 'nosuchhash')
+
+def test_checksums():
+    paths = []
+    for i in range(10):
+        p = util.tmppath('sum%d' % i)
+        sy.path.dump(p, str(i) * 100000)
+        paths.append(p)
+    sums = sy.path.checksums(paths, workers=3)
+    eq_(sums, dict((p, sy.path.md5sum(p)) for p in paths))
+    assert_raises(IOError, sy.path.checksums, paths + [paths[0] + '.nosum'])
+
+def test_checksum_cache():
+    p = util.tmppath()
+    sy.path.dump(p, 'hello')
+    cache = sy.path.ChecksumCache()
+    first = sy.path.md5sum(p, cache=cache)
+    eq_(sy.path.md5sum(p, cache=cache), first)
+    eq_((cache.hits, cache.misses), (1, 1))
+
+    sy.path.dump(p, 'hello world')
+    eq_(sy.path.md5sum(p, cache=cache), hashlib.md5('hello world').hexdigest())
+    eq_(cache.misses, 2)
+    eq_(len(cache), 1)
+
 
 
 
@@ -243,6 +569,81 @@ def test_replace_count_replace():
  
  
 
+@with_setup(setup_replace)
+def test_edit():
+    p = util.tmppath('replace')
+    counts = sy.path.edit(p, [
+        ('remove', 'first'),
+        ('replace', r'column(\d)', r'col\1'),
+        ('replace_line', 'third', 'third_line_replaced'),
+        ('ensure', 'fourth_line'),
+        ('ensure', 'second_line col2'),
+        ('ensure', 'fifth_line', '^fifth'),
+        ('append', 'last_line'),
+    ])
+    eq_(counts, [1, 3, 1, 1, 0, 1, 1])
+    eq_(sy.path.slurp(p), 'second_line col2\n'
+                          'third_line_replaced\n'
+                          'fourth_line\n'
+                          'fifth_line\n'
+                          'last_line\n')
+
+def test_edit_ensure_replaces():
+    p = util.tmppath()
+    sy.path.dump(p, 'a=1\nb=2\nno newline')
+    eq_(sy.path.edit(p, [('ensure', 'b=3', '^b='), ('ensure', 'c=1', '^c=')]),
+        [1, 1])
+    eq_(sy.path.slurp(p), 'a=1\nb=3\nno newline\nc=1\n')
+    eq_(sy.path.edit(p, [('ensure', 'b=3', '^b='), ('ensure', 'c=1', '^c=')]),
+        [0, 0])
+
+def test_edit_bad_rule():
+    p = util.tmppath()
+    sy.path.dump(p, 'a\n')
+    assert_raises(AssertionError, sy.path.edit, p, [('delete', 'a')])
+    assert_raises(AssertionError, sy.path.edit, p, [('remove', 'a', 'b')])
+
+@with_setup(setup_replace)
+def test_replace_unchanged():
+    p = util.tmppath('replace')
+    before = os.stat(p)
+    eq_(sy.path.replace(p, 'nomatch', 'x'), 0)
+    eq_(sy.path.remove_lines(p, 'nomatch'), 0)
+    # replaced with the same line
+    eq_(sy.path.replace_lines(p, 'first', 'first_line'), 1)
+    eq_(sy.path.edit(p, [('ensure', 'first_line')]), [0])
+    after = os.stat(p)
+    eq_((after.st_ino, after.st_mtime), (before.st_ino, before.st_mtime))
+    eq_(sy.path.slurp(p), replace_given)
+    eq_([f for f in os.listdir(os.path.dirname(p)) 
+         if f.startswith(os.path.basename(p)) and f != os.path.basename(p)], 
+        [])
+
+@with_setup(setup_replace)
+def test_replace_window():
+    p = util.tmppath('replace')
+    nr = sy.path.replace(p, r'(\w+)_line', r'line_\1', window=5, overlap=12)
+    eq_(nr, 3)
+    eq_(sy.path.slurp(p), replace_expect_sub)
+
+def test_replace_window_large():
+    p = util.tmppath()
+    content = ''.join('%d password=secret%d\n' % (i, i) for i in range(20000))
+    sy.path.dump(p, content)
+    rx = re.compile(r'^(\d+) password=\S+$', re.MULTILINE)
+    nr = sy.path.replace(p, rx, r'\1 password=X', window=4096, overlap=64)
+    eq_(nr, 20000)
+    eq_(sy.path.slurp(p), rx.sub(r'\1 password=X', content))
+
+def test_replace_window_encoding():
+    p = util.tmppath()
+    sy.path.dump(p, u'\u0d0a\u0a0d column\n' * 100, encoding='utf8')
+    nr = sy.path.replace(p, u'\u0a0d col', u'\u0d15', encoding='utf8', 
+                         window=7, overlap=20)
+    eq_(nr, 100)
+    eq_(sy.path.slurp(p, encoding='utf8'), u'\u0d0a\u0d15umn\n' * 100)
+
+
 #@with_setup(setup_replace)
 #def test_replace_inplace():
     #p = tempfiles[0]
@@ -280,6 +681,153 @@ class TestExtract(object):
     def test_extract_zip(self): self._extract('ok.zip')
     def test_extract_tar_gz(self): self._extract('ok.tar.gz')
     def test_extract_tar_bz2(self): self._extract('ok.tar.bz2')
+    def test_extract_tar_z(self): self._extract('ok.tar.Z')
+
+    def test_extract_zip_workers(self):
+        eq_(sy.path.extract(os.path.join(self.archive_dir, 'ok.zip'), 
+                            self.tempdir, workers=2), 
+            ['extract_test', 'extract_test/ok'])
+        eq_(sy.path.slurp(self.ok_file), 'ok\n')
+
+    def test_extract_members(self):
+        archive = os.path.join(self.archive_dir, 'ok.tar.gz')
+        eq_(sy.path.extract(archive, self.tempdir, members=['*/nothing']), [])
+        assert not os.path.exists(self.ok_file)
+        eq_(sy.path.extract(archive, self.tempdir, 
+                            members=lambda name: name.endswith('ok')), 
+            ['extract_test/ok'])
+        eq_(sy.path.slurp(self.ok_file), 'ok\n')
+
+    def _tar(self, *members):
+        archive = os.path.join(self.tempdir, 'evil.tar')
+        tar = tarfile.open(archive, 'w')
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if linkname:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+            else:
+                info.size = 2
+                tar.addfile(info, StringIO('x\n'))
+        tar.close()
+        return archive
+
+    def test_extract_outside(self):
+        out = os.path.join(self.tempdir, 'out')
+        for members in ([('../evil', None)],
+                        [('/tmp/evil', None)],
+                        [('link', '/tmp')],
+                        [('link', '..'), ('link/evil', None)]):
+            assert_raises(RuntimeError, sy.path.extract, self._tar(*members),
+                          out)
+        assert not os.path.exists(os.path.join(self.tempdir, 'evil'))
+
+        eq_(sy.path.extract(self._tar(('a', None), ('link', 'a')), out), 
+            ['a', 'link'])
+        eq_(sy.path.slurp(os.path.join(out, 'link')), 'x\n')
+
+    def test_extract_piped(self):
+        # compress is not read by Python, it is uncompressed by zcat
+        archive = os.path.join(self.archive_dir, 'ok.tar.Z')
+        eq_(sy.path.extract(archive, self.tempdir, members=['*/nothing']), [])
+        eq_(sy.path.extract(archive, self.tempdir), 
+            ['extract_test', 'extract_test/ok'])
+        eq_(sy.path.slurp(self.ok_file), 'ok\n')
+
+    def test_extract_piped_stderr(self):
+        # more warnings than a pipe holds must not block the decompressor
+        noisy = os.path.join(self.tempdir, 'noisy')
+        sy.path.dump(noisy, '#!/bin/sh\n'
+                            'head -c 200000 /dev/zero | tr "\\0" w >&2\n'
+                            'cat "$1"\n')
+        os.chmod(noisy, 0755)
+        archive = os.path.join(self.archive_dir, 'ok.tar')
+        out = os.path.join(self.tempdir, 'out')
+        eq_(sy.path._extract_piped(noisy, archive, out, None), 
+            ['extract_test', 'extract_test/ok'])
+        eq_(sy.path.slurp(os.path.join(out, 'extract_test', 'ok')), 'ok\n')
+
+    def test_extract_piped_outside(self):
+        try:
+            sy.cmd.find('xz')
+        except sy.cmd.CommandError:
+            raise SkipTest('xz is not installed')
+        archive = self._tar(('../evil', None))
+        sy.cmd.do('xz {}', archive)
+        assert_raises(RuntimeError, sy.path.extract, archive + '.xz', 
+                      os.path.join(self.tempdir, 'out'))
+        assert not os.path.exists(os.path.join(self.tempdir, 'evil'))
+
+    def _tree(self):
+        src = os.path.join(self.tempdir, 'src')
+        os.makedirs(os.path.join(src, 'a'))
+        sy.path.dump(os.path.join(src, 'a', 'one'), 'one')
+        sy.path.dump(os.path.join(src, 'two'), 'two')
+        os.symlink('one', os.path.join(src, 'a', 'link'))
+        return src
+
+    def test_pack(self):
+        src = self._tree()
+        for name in ('src.tar.gz', 'src.zip'):
+            archive = os.path.join(self.tempdir, name)
+            eq_(sy.path.pack(src, archive), ['a', 'a/link', 'a/one', 'two'])
+            out = os.path.join(self.tempdir, 'out_' + name)
+            sy.path.extract(archive, out)
+            eq_(sy.path.slurp(os.path.join(out, 'a', 'one')), 'one')
+            eq_(os.readlink(os.path.join(out, 'a', 'link')), 'one')
+
+    def test_pack_mode(self):
+        src = self._tree()
+        archive = os.path.join(self.tempdir, 'src.tar')
+        manifest = os.path.join(self.tempdir, 'manifest')
+        umask = os.umask(027)
+        try:
+            sy.path.pack(src, archive, manifest=manifest)
+        finally:
+            os.umask(umask)
+        eq_(sy.path.mode(archive), '0640')
+        eq_(sy.path.mode(manifest), '0640')
+
+    def test_pack_manifest(self):
+        src = self._tree()
+        archive = os.path.join(self.tempdir, 'src.tar')
+        manifest = os.path.join(self.tempdir, 'manifest')
+        eq_(sy.path.pack(src, archive, manifest=manifest),
+            ['a', 'a/link', 'a/one', 'two'])
+        eq_(sy.path.pack(src, archive, manifest=manifest), ['a', 'a/link'])
+
+        # touched but not changed
+        os.utime(os.path.join(src, 'two'), (0, 0))
+        sy.path.dump(os.path.join(src, 'a', 'one'), 'changed')
+        eq_(sy.path.pack(src, archive, manifest=manifest),
+            ['a', 'a/link', 'a/one'])
+        eq_(tarfile.open(archive).getnames(), ['a', 'a/link', 'a/one'])
+        eq_(sy.path.pack(src, archive, manifest=manifest), ['a', 'a/link'])
+
+    def test_pack_manifest_checksums(self):
+        src = self._tree()
+        for name in ('src.tar.gz', 'src.zip'):
+            archive = os.path.join(self.tempdir, name)
+            manifest = os.path.join(self.tempdir, name + '.manifest')
+            sy.path.pack(src, archive, manifest=manifest)
+            sums = dict((member, entry[2]) for member, entry in 
+                        json.loads(sy.path.slurp(manifest)).items()
+                        if entry[2])
+            eq_(sums, {'a/one': hashlib.md5('one').hexdigest(), 
+                       'two': hashlib.md5('two').hexdigest()})
+            out = os.path.join(self.tempdir, 'out_' + name)
+            sy.path.extract(archive, out)
+            eq_(sy.path.slurp(os.path.join(out, 'two')), 'two')
+            eq_(sy.path.mode(os.path.join(out, 'two')), 
+                sy.path.mode(os.path.join(src, 'two')))
+
+    def test_pack_unsupported(self):
+        if 'xz' in tarfile.TarFile.OPEN_METH:
+            raise SkipTest('tarfile supports xz')
+        archive = os.path.join(self.tempdir, 'src.tar.xz')
+        assert_raises(sy.exception.Error, sy.path.pack, self._tree(), archive)
+        assert not os.path.exists(archive)
  
 
 